@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+import functools
+import os
+import threading
+
+import cvs
+
+# Number of operations of one repository run in executor at once
+DEFAULT_CONCURRENCY = 4
+
+
+class _RepositoryGate:
+    """Lets threads work with one repository at a time. Paths of
+    repository are module globals of cvs, so threads of another
+    repository wait, until all threads of the current one exit"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._root = None
+        self._users = 0
+        self._stack = None
+
+    @contextlib.contextmanager
+    def enter(self, root):
+        with self._condition:
+            self._condition.wait_for(lambda: self._root in (None, root))
+            if not self._users:
+                self._root = root
+                self._stack = contextlib.ExitStack()
+                self._stack.enter_context(cvs._use_repository(root))
+            self._users += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._users -= 1
+                if not self._users:
+                    self._stack.close()
+                    self._root = None
+                    self._condition.notify_all()
+
+
+_gate = _RepositoryGate()
+
+
+class ReadWriteLock:
+    """Asyncio lock, which is held by many readers or one writer.
+    Waiting writer stops new readers, so writers are not starved"""
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._condition:
+            self._waiting_writers += 1
+            try:
+                await self._condition.wait_for(
+                    lambda: not self._writer and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+                self._condition.notify_all()
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class Repository:
+    """Coroutines for operations of repository in root directory.
+    Blocking work runs in executor (default executor of loop, if it is
+    None), at most concurrency operations at once. Reading operations
+    run concurrently, changing ones wait for all others.
+
+    Progress is called in event loop with stage name and numbers of
+    processed and all files. Cancelled operation stops at the next file
+    it hashes, if it has not started writing yet, otherwise it finishes.
+    In both cases CancelledError is raised after its thread is done.
+    Synchronous cvs functions must not be called, while operations run"""
+
+    def __init__(self, root, executor=None, concurrency=DEFAULT_CONCURRENCY):
+        self.root = os.path.abspath(root)
+        self._executor = executor
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock = ReadWriteLock()
+
+    async def init(self):
+        return await self._run(cvs._init, write=True)
+
+    async def status(self, pathspecs=None, progress=None):
+        return await self._run(cvs._status, pathspecs, progress=progress)
+
+    async def log(self, paths=None, progress=None):
+        return await self._run(cvs._log, paths, progress=progress)
+
+    async def diff(self, first=None, second=None, mode=None, progress=None):
+        return await self._run(cvs._diff, first, second, mode, progress=progress)
+
+    async def add(self, files, progress=None):
+        return await self._run(cvs._add, files, write=True, progress=progress)
+
+    async def commit(self, message, pathspecs=None, no_verify=False,
+                     progress=None):
+        return await self._run(cvs._commit, message, pathspecs, no_verify,
+                               write=True, progress=progress)
+
+    async def branch(self, branch_name):
+        return await self._run(cvs._branch, branch_name, write=True)
+
+    async def checkout(self, branch_name, progress=None):
+        return await self._run(cvs._checkout, branch_name, write=True,
+                               progress=progress)
+
+    async def _run(self, function, *args, write=False, progress=None):
+        loop = asyncio.get_running_loop()
+        callback = functools.partial(_report_progress, loop, progress) \
+            if progress else None
+        cancelled = threading.Event()
+        lock = self._lock.write() if write else self._lock.read()
+        async with lock, self._semaphore:
+            future = loop.run_in_executor(self._executor, functools.partial(
+                self._call, function, args, callback, cancelled))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                cancelled.set()
+                # Locks are kept, until the thread stops
+                await _wait_quietly(future)
+                raise
+
+    def _call(self, function, args, callback, cancelled):
+        with _gate.enter(self.root), cvs._progress_context(callback, cancelled):
+            return function(*args)
+
+
+def _report_progress(loop, progress, stage, done, total):
+    # Called in executor thread, progress runs in event loop
+    loop.call_soon_threadsafe(progress, stage, done, total)
+
+
+async def _wait_quietly(future):
+    while not future.done():
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            continue
+        except Exception:
+            return
@@ -0,0 +1,89 @@
+"""Compares memory used by branch log loaded as JSON dicts and as compact
+records. Run from repository root:
+
+    python benchmarks/memory_benchmark.py --files 100000 --commits 20
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import records  # noqa: E402
+import utils as ut  # noqa: E402
+
+
+def make_branch_log(files_number, commits_number, changed_share):
+    """Returns branch log, where every commit changes part of files
+    and keeps other entries of previous commit"""
+    commits = dict()
+    files = dict()
+    parent_id = None
+    changed_number = max(1, int(files_number * changed_share))
+    for i in range(commits_number):
+        commit_id = str(1715000000000 + i)
+        changed = range(files_number) if i == 0 else \
+            range((i * changed_number) % files_number,
+                  (i * changed_number) % files_number + changed_number)
+        files = {path: [info[0], info[1], "UNCHANGED"]
+                 for path, info in files.items()}
+        for j in changed:
+            path = f"src/module{j % 100}/file{j}.py"
+            files[path] = [f".cvs/branches/main/{commit_id}/file{j}.py",
+                           hashlib.sha256(f"{i}:{j}".encode()).hexdigest(),
+                           "MODIFIED" if i else "NEW"]
+        commits[commit_id] = {
+            "time": time.ctime(), "parent_commit_branch": "main" if parent_id else None,
+            "parent_commit_id": parent_id, "branch": "main", "id": commit_id,
+            "message": f"commit {i}", "files": files
+        }
+        parent_id = commit_id
+    return {"branch": "main", "parent_branch": None, "parent_commit_id": None,
+            "staging_area": ".cvs/branches/main/staging_area.json",
+            "head": parent_id, "commits": commits}
+
+
+def measure(load, path):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    data = load(path)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return retained, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--commits", type=int, default=20)
+    parser.add_argument("--changed", type=float, default=0.01,
+                        help="Share of files changed by every commit")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "main.json")
+        with open(path, "w") as f:
+            json.dump(make_branch_log(args.files, args.commits, args.changed), f)
+        print(f"Branch log: {args.files} files x {args.commits} commits, "
+              f"{os.path.getsize(path) / 2 ** 20:.1f} MiB of JSON")
+        results = {"dicts": measure(ut.read_json_file, path),
+                   "records": measure(records.read_branch_log, path)}
+    for name, (retained, peak, elapsed) in results.items():
+        print(f"{name:>8}: retained {retained / 2 ** 20:8.1f} MiB, "
+              f"peak {peak / 2 ** 20:8.1f} MiB, {elapsed:.2f} s")
+    print(f"Retained memory is {results['dicts'][0] / results['records'][0]:.1f} "
+          f"times smaller, peak memory is "
+          f"{results['dicts'][1] / results['records'][1]:.1f} times smaller")
+
+
+if __name__ == "__main__":
+    main()
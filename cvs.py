@@ -1,5 +1,21 @@
+import bisect
+import collections
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import heapq
+import json
 import os
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
 
 import click
 import exceptions
@@ -7,6 +23,8 @@ from pathlib import Path
 from enum import Enum
 import utils as ut
 import gui as g
+import profiler as prof
+import records
 import tkinter as tk
 
 MAIN_BRANCH = ".cvs/branches/main"
@@ -14,8 +32,219 @@ BRANCHES = ".cvs/branches"
 BRANCHES_LOG = ".cvs/branches_log"
 STAGING_AREA = ".cvs/staging_area.json"
 GITIGNORE = ".cvs/cvsignore.json"
+CONFIG = ".cvs/config.json"
+INDEX = ".cvs/index.json"
+CHUNKS = ".cvs/chunks"
+SPARSE_CHECKOUT = ".cvs/sparse_checkout.json"
+COMMIT_GRAPH = ".cvs/commit_graph.jsonl"
+COMMIT_IDS = ".cvs/commit_ids"
+NEW_COMMIT_IDS = ".cvs/commit_ids_new"
+REMOTES = ".cvs/remotes.json"
+PATH_HISTORY = ".cvs/path_history"
+REFS = ".cvs/refs.json"
+REF_UPDATES = ".cvs/ref_updates.jsonl"
+NOTES = ".cvs/notes.jsonl"
+HOOKS = ".cvs/hooks.json"
+HOOK_CACHE = ".cvs/hook_cache.json"
+ALTERNATES = ".cvs/alternates.json"
+WORKTREE = ".cvs/worktree.json"
+WORKTREES = ".cvs/worktrees.json"
+STATS = ".cvs/stats.json"
+STATS_CONTENTS = ".cvs/stats"
+LOCK = ".cvs/lock"
 CURRENT_DIR = "."
 
+# Paths inside repository, which are switched by _set_repository
+REPOSITORY_PATHS = {
+    "MAIN_BRANCH": MAIN_BRANCH,
+    "BRANCHES": BRANCHES,
+    "BRANCHES_LOG": BRANCHES_LOG,
+    "STAGING_AREA": STAGING_AREA,
+    "GITIGNORE": GITIGNORE,
+    "CONFIG": CONFIG,
+    "INDEX": INDEX,
+    "CHUNKS": CHUNKS,
+    "SPARSE_CHECKOUT": SPARSE_CHECKOUT,
+    "COMMIT_GRAPH": COMMIT_GRAPH,
+    "COMMIT_IDS": COMMIT_IDS,
+    "NEW_COMMIT_IDS": NEW_COMMIT_IDS,
+    "REMOTES": REMOTES,
+    "PATH_HISTORY": PATH_HISTORY,
+    "REFS": REFS,
+    "REF_UPDATES": REF_UPDATES,
+    "NOTES": NOTES,
+    "HOOKS": HOOKS,
+    "HOOK_CACHE": HOOK_CACHE,
+    "ALTERNATES": ALTERNATES,
+    "WORKTREE": WORKTREE,
+    "WORKTREES": WORKTREES,
+    "STATS": STATS,
+    "STATS_CONTENTS": STATS_CONTENTS,
+    "LOCK": LOCK
+}
+# Paths, which every working tree has its own
+WORKTREE_PATHS = {"STAGING_AREA", "INDEX", "SPARSE_CHECKOUT", "WORKTREE"}
+# Directories, which are linked from working trees to repository, so
+# stored paths relative to repository root are valid in them too
+LINKED_PATHS = {"BRANCHES", "BRANCHES_LOG", "PATH_HISTORY", "CHUNKS"}
+
+# Suffix of stored file, which contains list of chunks instead of content
+CHUNKS_SUFFIX = ".chunks"
+# Files, which were changed so recently, are not cached in the index,
+# because the next change can keep the same modification time
+INDEX_RACY_NS = 2 * 10 ** 9
+# Diffs of fewer files are made without process pool
+DIFF_POOL_THRESHOLD = 8
+# Number of hex digits of path hash, which select file of path history
+PATH_HISTORY_BUCKET_DIGITS = 2
+# Fewer stored objects are hashed by fsck without process pool
+FSCK_POOL_THRESHOLD = 8
+# Fewer file versions are searched by grep without process pool
+GREP_POOL_THRESHOLD = 8
+# Fewer branch logs and stored files are read by stats without process pool
+STATS_POOL_THRESHOLD = 8
+# Number of hex digits of content hash, which select file of stored
+# contents of stats
+STATS_BUCKET_DIGITS = 2
+# Number of the largest stored contents kept in stats
+STATS_LARGEST = 10
+# Every time notes log grows by this size, it is compacted, if most
+# of its lines are overridden by later ones
+NOTES_COMPACTION_SIZE = 64 * 1024
+# Size of ref updates log, after which it is merged into ref table
+REF_UPDATES_COMPACTION_SIZE = 64 * 1024
+# Number of files passed to one run of hook, if hook doesn't set it
+HOOK_BATCH_SIZE = 64
+# Commit ids are sha1 hex digests, shorter ids of old commits are padded
+# with spaces in id index, so it has records of equal size
+COMMIT_ID_WIDTH = 40
+# Seconds between attempts to take lock of repository, held by another
+# process
+LOCK_RETRY_INTERVAL = 0.05
+# Number of unsorted ids added to id index, after which they are merged
+# into its sorted part
+NEW_COMMIT_IDS_LIMIT = 256
+MIN_COMMIT_PREFIX = 4
+# Prefix of names of shared objects in bundles
+SHARED_OBJECTS_NAME = "objects/.shared/"
+# Archive formats by suffix of output file, tar is used for others
+ARCHIVE_SUFFIXES = {".tar.gz": "tar.gz", ".tgz": "tar.gz", ".tar": "tar",
+                    ".zip": "zip"}
+
+DEFAULT_CONFIG = {
+    # Files of this size or larger are stored as chunks, None disables it
+    "chunk_threshold": None,
+    "chunk_min_size": 256 * 1024,
+    "chunk_avg_size": 1024 * 1024,
+    "chunk_max_size": 4 * 1024 * 1024,
+    # Changed files are detected as renamed, if share of their equal lines
+    # is at least this number, None detects only renames without changes
+    "rename_similarity": None,
+    # Number of hook processes run at once, None uses thread pool default
+    "hook_workers": None,
+    # Seconds, which changing command waits for repository lock held by
+    # another process, None waits without limit
+    "lock_timeout": 10
+}
+# Ignore patterns of new repository
+DEFAULT_IGNORE = {
+    "START": [".", "_"],
+    "FORMATS": [".md"],
+    "FILES": ["cvs.py", "cvs_test.py", "utils.py", "setup.py",
+              "gui.py", "requirements.txt", "exceptions.py"],
+    "DIRECTORIES": ["venv"]
+}
+
+# Progress callback and cancellation event of operation run by thread,
+# they are set by async_api
+_progress_state = threading.local()
+# Numbers of nested holds of repository locks by thread, by lock path
+_lock_state = threading.local()
+
+
+@contextlib.contextmanager
+def _repository_lock(root=None):
+    """Holds lock file of repository (None root is the current one), so
+    only one process changes repository and its working trees at a time.
+    Thread, which holds the lock, can take it again"""
+    with _use_repository(root):
+        _check_repository_existence()
+        path = os.path.abspath(LOCK)
+        if not hasattr(_lock_state, "holds"):
+            _lock_state.holds = collections.Counter()
+        if not _lock_state.holds[path]:
+            _create_lock_file(path, _get_config()["lock_timeout"])
+    _lock_state.holds[path] += 1
+    try:
+        yield
+    finally:
+        _lock_state.holds[path] -= 1
+        if not _lock_state.holds[path]:
+            del _lock_state.holds[path]
+            os.remove(path)
+
+
+def _create_lock_file(path, timeout):
+    """Creates lock file with process id and host name. Lock of process,
+    which is not running on this host any more, is removed"""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if _remove_stale_lock(path):
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                raise exceptions.LockException(f"Repository is locked by another "
+                                               f"process. If no process is "
+                                               f"running, remove '{path}'")
+            time.sleep(LOCK_RETRY_INTERVAL)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"pid": os.getpid(), "host": socket.gethostname()}, f)
+
+
+def _remove_stale_lock(path):
+    """Removes lock file, which process isn't running. Returns True,
+    if it was removed"""
+    try:
+        with open(path) as f:
+            owner = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # Lock is being written or was just released
+        return False
+    if not isinstance(owner, dict) or owner.get("host") != socket.gethostname() \
+            or _is_process_running(owner.get("pid")):
+        return False
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _is_process_running(pid):
+    # Without signals on Windows process can't be checked, it is
+    # considered running
+    if not isinstance(pid, int) or os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _locked(function):
+    """Runs changing operation under lock of the current repository"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with _repository_lock():
+            return function(*args, **kwargs)
+    return wrapper
+
 
 class FileState(Enum):
     UNTRACKED = 1
@@ -28,8 +257,29 @@ class FileState(Enum):
 # region Click
 
 @click.group()
-def cli():
+@click.option('--profile', is_flag=True,
+              help="Print time of each phase and counters after command")
+@click.pass_context
+def cli(ctx, profile):
     """Local Version Control System"""
+    if os.path.exists(WORKTREE):
+        _set_repository(CURRENT_DIR)
+    trace_path = os.environ.get(prof.TRACE_ENV)
+    if not (profile or trace_path):
+        return
+    prof.enable()
+    command_span = prof.span(f"command.{ctx.invoked_subcommand}")
+    command_span.__enter__()
+
+    def report():
+        command_span.__exit__(None, None, None)
+        if profile:
+            click.echo("".join(prof.summary()), err=True)
+        if trace_path:
+            prof.write_trace(trace_path)
+        prof.disable()
+
+    ctx.call_on_close(report)
 
 
 @cli.command()
@@ -41,7 +291,7 @@ def init():
 @cli.command()
 @click.argument('files', nargs=-1)
 def add(files):
-    """Add files to the staging area"""
+    """Add files, directories or glob patterns to the staging area"""
     _add(files, console_info=True)
 
 
@@ -53,9 +303,11 @@ def reset():
 
 @cli.command()
 @click.argument('message')
-def commit(message):
-    """Commit changes to the repository"""
-    _commit(message, console_info=True)
+@click.argument('pathspecs', nargs=-1)
+@click.option('--no-verify', is_flag=True, help="Don't run pre-commit hooks")
+def commit(message, pathspecs, no_verify):
+    """Commit changes (only of matching files, if pathspecs are given)"""
+    _commit(message, pathspecs, no_verify, console_info=True)
 
 
 @cli.command(name='update-message')
@@ -67,22 +319,109 @@ def change_commit_message(commit_id, message):
 
 
 @cli.command()
-def status():
-    """Display commit history"""
-    click.echo("".join(_status()))
+@click.argument('pathspecs', nargs=-1)
+@click.option('-r', '--recursive', is_flag=True,
+              help="Show summary of every repository under directory")
+@click.option('--dirty-only', is_flag=True,
+              help="Show only repositories with changes (with --recursive)")
+def status(pathspecs, recursive, dirty_only):
+    """Display states of files (only matching ones, if pathspecs are given)"""
+    if not recursive:
+        click.echo("".join(_status(pathspecs)))
+        return
+    if len(pathspecs) > 1:
+        raise click.UsageError("Recursive status receives one directory")
+    directory = pathspecs[0] if pathspecs else "."
+    for summary in _status_recursive(directory, dirty_only):
+        click.echo(_format_summary(summary, directory))
+
+
+@cli.command()
+@click.argument('paths', nargs=-1)
+def log(paths):
+    """Display commit history (of files, if paths are given after --)"""
+    click.echo("".join(_log(paths)))
 
 
 @cli.command()
-def log():
-    """Display commit history"""
-    click.echo("".join(_log()))
+@click.argument('commits', nargs=-1)
+@click.option('--stat', 'mode', flag_value='stat',
+              help="Show changed files with their sizes")
+@click.option('--name-only', 'mode', flag_value='name-only',
+              help="Show only names of changed files")
+def diff(commits, mode):
+    """Show changes between commits or commit and working directory"""
+    if len(commits) > 2:
+        raise click.UsageError("Diff receives at most two commits")
+    click.echo("".join(_diff(*commits, mode=mode)), nl=False)
 
 
 @cli.command()
-@click.argument('branch_name')
-def branch(branch_name):
-    """Create a new branch"""
-    _branch(branch_name, console_info=True)
+@click.argument('revision')
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              help="Path of archive, stdout by default")
+@click.option('--format', 'archive_format',
+              type=click.Choice(sorted(set(ARCHIVE_SUFFIXES.values()))),
+              help="Archive format, by default it is taken from output suffix")
+def archive(revision, output, archive_format):
+    """Write files of commit or branch to archive without checkout"""
+    if output is None:
+        _archive(revision, click.open_file('-', 'wb'), archive_format)
+    else:
+        _archive(revision, output, archive_format, console_info=True)
+
+
+@cli.command()
+@click.argument('spec')
+def show(spec):
+    """Print file of commit or branch given as <commit>:<path>"""
+    revision, separator, path = spec.partition(":")
+    if not separator or not path:
+        raise click.UsageError("Expected <commit>:<path>")
+    _show(revision, path, click.open_file('-', 'wb'))
+
+
+@cli.command()
+@click.argument('pattern')
+@click.argument('commits', nargs=-1)
+@click.option('--all-branches', is_flag=True,
+              help="Search all commits of all branches")
+@click.option('-F', '--fixed-strings', 'fixed', is_flag=True,
+              help="Pattern is a literal string, not a regular expression")
+@click.option('-i', '--ignore-case', is_flag=True)
+@click.option('-p', '--path', 'paths', multiple=True,
+              help="Search only files matching path pattern")
+def grep(pattern, commits, all_branches, fixed, ignore_case, paths):
+    """Search files of commits (current branch by default) for pattern"""
+    try:
+        lines = _grep(pattern, commits, all_branches, fixed, ignore_case, paths)
+    except exceptions.GrepException as e:
+        raise click.BadParameter(str(e), param_hint="'PATTERN'")
+    click.echo("".join(lines), nl=False)
+
+
+@cli.command()
+@click.argument('branch_name', required=False)
+@click.option('-d', '--delete', 'action', flag_value='delete',
+              help="Delete branch, its files are removed by gc")
+@click.option('--archive', 'action', flag_value='archive',
+              help="Hide branch from lists, keeping its commits")
+@click.option('--unarchive', 'action', flag_value='unarchive',
+              help="Show archived branch again")
+@click.option('-a', '--all', 'show_all', is_flag=True,
+              help="List archived branches too")
+def branch(branch_name, action, show_all):
+    """Create a new branch, list, delete or archive branches"""
+    if not branch_name:
+        if action:
+            raise click.UsageError("Branch name is required")
+        click.echo("".join(_list_branches(show_all)), nl=False)
+    elif action == 'delete':
+        _delete_branch(branch_name, console_info=True)
+    elif action:
+        _archive_branch(branch_name, action == 'archive', console_info=True)
+    else:
+        _branch(branch_name, console_info=True)
 
 
 @cli.command()
@@ -93,10 +432,181 @@ def checkout(branch_name):
 
 
 @cli.command(name='cherry-pick')
-@click.argument('commit_id')
-def cherry_pick(commit_id):
-    """Applies a commit to the current branch"""
-    _cherry_pick(commit_id, console_info=True)
+@click.argument('commit_ids', nargs=-1, required=True)
+def cherry_pick(commit_ids):
+    """Applies commits or ranges 'A..B' to the current branch"""
+    _cherry_pick(list(commit_ids), console_info=True)
+
+
+@cli.command()
+@click.argument('branch_name')
+def merge(branch_name):
+    """Merge branch into the current branch"""
+    _merge(branch_name, console_info=True)
+
+
+@cli.command(name='sparse-checkout')
+@click.argument('patterns', nargs=-1)
+@click.option('--disable', is_flag=True, help="Materialize all files again")
+def sparse_checkout(patterns, disable):
+    """Set path patterns of files, which are kept in working directory"""
+    if disable or patterns:
+        _sparse_checkout([] if disable else patterns, console_info=True)
+    else:
+        click.echo("".join(f"{i}\n" for i in _get_sparse_patterns()))
+
+
+@cli.group(invoke_without_command=True)
+@click.pass_context
+def remote(ctx):
+    """Show or change remote repositories"""
+    if ctx.invoked_subcommand is None:
+        click.echo("".join(f"{name} {path}\n"
+                           for name, path in _get_remotes().items()))
+
+
+@remote.command(name='add')
+@click.argument('name')
+@click.argument('path')
+def remote_add(name, path):
+    """Add repository at local path as remote"""
+    _add_remote(name, path, console_info=True)
+
+
+@cli.group(invoke_without_command=True)
+@click.pass_context
+def hook(ctx):
+    """Show or change pre-commit hooks"""
+    if ctx.invoked_subcommand is None:
+        click.echo("".join(_list_hooks()), nl=False)
+
+
+@hook.command(name='add')
+@click.argument('name')
+@click.argument('command')
+@click.option('--files', 'patterns', multiple=True,
+              help="Run hook only on files matching this glob pattern")
+@click.option('--batch-size', type=click.IntRange(min=1),
+              help="Maximum number of files passed to one run of hook")
+def hook_add(name, command, patterns, batch_size):
+    """Add hook, which is run with changed files as arguments"""
+    _add_hook(name, command, patterns, batch_size, console_info=True)
+
+
+@hook.command(name='remove')
+@click.argument('name')
+def hook_remove(name):
+    """Remove hook"""
+    _remove_hook(name, console_info=True)
+
+
+@cli.group(invoke_without_command=True)
+@click.pass_context
+def alternates(ctx):
+    """Show or add shared object stores"""
+    if ctx.invoked_subcommand is None:
+        click.echo("".join(f"{path}\n" for path in _get_alternates()), nl=False)
+
+
+@alternates.command(name='add')
+@click.argument('path')
+def alternates_add(path):
+    """Use directory as shared object store"""
+    _add_alternate(path, console_info=True)
+
+
+@cli.command()
+@click.option('--shared', is_flag=True,
+              help="Move stored files to shared object store")
+@click.option('--store', help="Shared object store (the first one by default)")
+def repack(shared, store):
+    """Move content of stored files to shared object store"""
+    if not shared:
+        raise click.UsageError("Only shared repack is supported, use --shared")
+    _repack_shared(store, console_info=True)
+
+
+@cli.group(invoke_without_command=True)
+@click.pass_context
+def worktree(ctx):
+    """Show or change working trees of repository"""
+    if ctx.invoked_subcommand is None:
+        click.echo("".join(f"{path} [{branch}]\n" for path, branch
+                           in _get_checked_out_branches().items()), nl=False)
+
+
+@worktree.command(name='add')
+@click.argument('path')
+@click.argument('branch_name')
+def worktree_add(path, branch_name):
+    """Create working tree with files of branch in directory"""
+    _add_worktree(path, branch_name, console_info=True)
+
+
+@worktree.command(name='remove')
+@click.argument('path')
+def worktree_remove(path):
+    """Remove working tree without uncommited changes"""
+    _remove_worktree(path, console_info=True)
+
+
+@cli.command()
+@click.argument('remote_name')
+@click.argument('branch_name', required=False)
+def push(remote_name, branch_name):
+    """Send branch (current by default) to remote repository. Branch
+    checked out in remote can be pushed only to remote without commits"""
+    _push(remote_name, branch_name, console_info=True)
+
+
+@cli.command()
+@click.argument('remote_name')
+@click.argument('branch_name', required=False)
+def fetch(remote_name, branch_name):
+    """Receive branch (all branches by default) from remote repository"""
+    _fetch(remote_name, branch_name, console_info=True)
+
+
+@cli.command()
+@click.argument('key')
+@click.argument('value', required=False)
+def config(key, value):
+    """Show or change repository option"""
+    click.echo(_config(key, value, console_info=True))
+
+
+@cli.command()
+@click.option('--keep-last', type=click.IntRange(min=1),
+              help="Keep only this number of last commits on every branch")
+@click.option('--keep-since', type=click.DateTime(formats=["%Y-%m-%d"]),
+              help="Keep commits, which are newer than this date")
+@click.option('--dry-run', is_flag=True,
+              help="Only report, what would be removed")
+@click.option('--time-budget', type=float,
+              help="Stop after this number of seconds, next run continues")
+def gc(keep_last, keep_since, dry_run, time_budget):
+    """Remove stored files, which are not reachable from branches"""
+    _gc(keep_last, keep_since, dry_run, time_budget, console_info=True)
+
+
+@cli.command()
+@click.option('--quick', is_flag=True,
+              help="Check only existence and sizes of stored files and links")
+@click.pass_context
+def fsck(ctx, quick):
+    """Verify stored files, commit links and staging area, print JSON report"""
+    report = _fsck(quick)
+    click.echo(json.dumps(report, indent=2))
+    if report["errors"]:
+        ctx.exit(1)
+
+
+@cli.command()
+@click.option('--recompute', is_flag=True,
+              help="Rebuild statistics from branch logs and stored files")
+def stats(recompute):
+    """Show numbers of commits, files and stored bytes"""
+    click.echo("".join(_format_stats(_get_stats(recompute))), nl=False)
 
 
 @cli.command()
@@ -118,6 +628,7 @@ def _init(console_info=False):
         raise exceptions.RepositoryException("Repository has been already initialized")
     else:
         os.makedirs(BRANCHES_LOG, exist_ok=True)
+        os.makedirs(PATH_HISTORY, exist_ok=True)
         _create_branch("main", None, None)
         staging_area_obj = {
             "current_branch": "main",
@@ -129,15 +640,9 @@ def _init(console_info=False):
                 "DELETED": []
             }
         }
-        gitignore_obj = {
-            "START": [".", "_"],
-            "FORMATS": [".md"],
-            "FILES": ["cvs.py", "cvs_test.py", "utils.py", "setup.py",
-                      "gui.py", "requirements.txt", "exceptions.py"],
-            "DIRECTORIES": ["venv"]
-        }
         ut.write_json_file(STAGING_AREA, staging_area_obj)
-        ut.write_json_file(GITIGNORE, gitignore_obj)
+        ut.write_json_file(GITIGNORE, DEFAULT_IGNORE)
+        ut.write_json_file(CONFIG, DEFAULT_CONFIG)
 
         staging_area_path = os.path.join(BRANCHES, "main", "staging_area.json")
         with open(staging_area_path, "w"):
@@ -147,27 +652,35 @@ def _init(console_info=False):
             click.echo("Repository was initialized\n")
 
 
+@_locked
 def _add(files, console_info=False):
-    """Add files to the staging area"""
+    """Add files to the staging area. Files are pathspecs: paths,
+    directories or glob patterns, only they are scanned"""
     _check_repository_existence()
-    staging_area = _update_staging_area()
-    untracked = set(staging_area["staging_files"][FileState.UNTRACKED.name])
-
-    files_to_add = []
-    if len(files) == 1 and files[0] == ".":
-        files_to_add = staging_area["staging_files"][FileState.UNTRACKED.name]
-        untracked = set()
+    pathspecs = _get_pathspec_patterns(files)
+    staging_area = _update_staging_area(pathspecs)
+    untracked = staging_area["staging_files"][FileState.UNTRACKED.name]
+
+    if not files:
+        files_to_add = []
+    elif pathspecs is None:
+        files_to_add = untracked
+        untracked = []
     else:
-        for file in files:
-            if file not in untracked:
-                raise exceptions.AddException(f"There is no file '{file}'")
-            files_to_add.append(file)
-            untracked.remove(file)
+        files_to_add = set()
+        for file, pathspec in zip(files, pathspecs):
+            matched = [f for f in untracked if _matches_patterns(f, [pathspec])]
+            if not matched:
+                raise exceptions.AddException(f"There is no untracked file "
+                                              f"matching '{file}'")
+            files_to_add.update(matched)
+        untracked = [f for f in untracked if f not in files_to_add]
+        files_to_add = sorted(files_to_add)
 
     if not files_to_add and console_info:
         click.echo("There are not any files to add\n")
 
-    staging_area["staging_files"][FileState.UNTRACKED.name] = list(untracked)
+    staging_area["staging_files"][FileState.UNTRACKED.name] = untracked
     staging_area["staging_files"][FileState.NEW.name] += files_to_add
 
     ut.write_json_file(STAGING_AREA, staging_area)
@@ -176,6 +689,7 @@ def _add(files, console_info=False):
                    f"staging area: {', '.join(files_to_add)}\n")
 
 
+@_locked
 def _reset(console_info=False):
     """Reset the staging area"""
     _check_repository_existence()
@@ -183,25 +697,40 @@ def _reset(console_info=False):
     staging_files = staging_area["staging_files"]
     for key in staging_files.keys():
         staging_files[key] = []
+    staging_area.pop("merge", None)
 
     ut.write_json_file(STAGING_AREA, staging_area)
     if console_info:
         click.echo(f"Staging area was reset\n")
 
 
-def _commit(message, console_info=False):
-    """Commit changes to the repository"""
+@_locked
+def _commit(message, pathspecs=None, no_verify=False, console_info=False):
+    """Commit changes to the repository. If pathspecs are given, only
+    changes of matching files are scanned and commited, others stay
+    in the staging area. Pre-commit hooks are run on new and modified
+    files, unless no_verify is set"""
     _check_repository_existence()
-    staging_area = _update_staging_area()
+    pathspecs = _get_pathspec_patterns(pathspecs)
+    staging_area = _update_staging_area(pathspecs)
     staging_files = staging_area["staging_files"]
-
-    if not (staging_files[FileState.NEW.name]
-            or staging_files[FileState.MODIFIED.name]
-            or staging_files[FileState.DELETED.name]):
+    # Merge with resolved conflicts is commited even without changes
+    merge_parent = staging_area.pop("merge", None)
+    if merge_parent and pathspecs:
+        raise exceptions.CommitException(f"Merge can't be commited partially")
+
+    changes = {state.name: [file for file in staging_files[state.name]
+                            if _matches_patterns(file, pathspecs)]
+               for state in (FileState.NEW, FileState.MODIFIED, FileState.DELETED)}
+    if not (any(changes.values()) or merge_parent):
         raise exceptions.CommitException(f"There are not any changes to commit")
+    if not no_verify:
+        report = _run_hooks(changes[FileState.NEW.name]
+                            + changes[FileState.MODIFIED.name])
+        if console_info and report:
+            click.echo("".join(_format_hooks_report(report)), nl=False)
 
     last_commit = _get_last_commit(staging_area["current_branch"])
-    commit_id = str(time.time() * 1000)[:13]
     prev_files = dict()
     parent_commit_id = None
     parent_commit_branch = None
@@ -209,95 +738,439 @@ def _commit(message, console_info=False):
         parent_commit_id = last_commit["id"]
         parent_commit_branch = last_commit["branch"]
         prev_files = last_commit['files']
-
-    commit_files, files_to_copy = _get_commit_files(prev_files, staging_area, commit_id)
-
-    staging_files[FileState.UNCHANGED.name] += staging_files[FileState.NEW.name]
-    staging_files[FileState.UNCHANGED.name] += staging_files[FileState.MODIFIED.name]
-    staging_files[FileState.DELETED.name] = []
-    staging_files[FileState.MODIFIED.name] = []
-    staging_files[FileState.NEW.name] = []
+    commit_id = _generate_commit_id([parent_commit_id,
+                                     merge_parent and merge_parent["id"],
+                                     staging_area["current_branch"], message,
+                                     changes])
+
+    index = _read_index()
+    renames = _detect_renames(changes[FileState.DELETED.name],
+                              changes[FileState.NEW.name], prev_files, index)
+    _write_index(index)
+    commit_area = dict(staging_area, staging_files=dict(staging_files, **changes))
+    commit_files, files_to_copy, manifests = _get_commit_files(
+        prev_files, commit_area, commit_id)
+
+    for state, files in changes.items():
+        files = set(files)
+        staging_files[state] = [f for f in staging_files[state] if f not in files]
+    staging_files[FileState.UNCHANGED.name] += changes[FileState.NEW.name]
+    staging_files[FileState.UNCHANGED.name] += changes[FileState.MODIFIED.name]
 
     ut.write_json_file(STAGING_AREA, staging_area)
-    commit_path = _create_commit(staging_area["current_branch"], commit_id,
-                                 message, commit_files, parent_commit_id,
-                                 parent_commit_branch)
-    ut.copy_files(commit_path, files_to_copy)
+    _create_commit(staging_area["current_branch"], commit_id, message,
+                   commit_files, parent_commit_id, parent_commit_branch,
+                   merge_parent, {"/".join(_relative_parts(new)):
+                                  "/".join(_relative_parts(old))
+                                  for new, old in renames.items()})
+    files_to_copy = [(file, _get_stored_file(commit_files[file][0]))
+                     for file in files_to_copy]
+    manifest_files = {path: _get_stored_file(path) for path in manifests}
+    for path in [i[1] for i in files_to_copy] + list(manifest_files.values()):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    ut.copy_files_as(files_to_copy, _get_progress("copy"))
+    for manifest_path, chunks in manifests.items():
+        ut.write_json_file(manifest_files[manifest_path], chunks)
+    stored = {i[0] for i in files_to_copy}
+    added = {info[0]: (_get_stored_hash(_get_stored_file(info[0]), info[1]),
+                       os.path.getsize(_get_stored_file(info[0])), file)
+             for file, info in commit_files.items()
+             if file in stored or info[0] in manifests}
+    _add_to_stats([{"branch": staging_area["current_branch"],
+                    "files": commit_files}], list(added.values()))
     if console_info:
         click.echo(f"Changes were commited with message: {message}\n")
 
 
+@_locked
 def _change_commit_message(commit_id, message, console_info=False):
     _check_repository_existence()
-    _update_staging_area()
-    success = False
-    for file in Path(BRANCHES_LOG).iterdir():
-        branch_log = ut.read_json_file(file)
-        if commit_id in branch_log['commits']:
-            success = True
-            branch_log['commits'][commit_id]["message"] = message
-            ut.write_json_file(file, branch_log)
-    if not success:
-        raise FileNotFoundError(f"There is no commit with id '{commit_id}'")
+    # Id is found in sorted id index, working directory isn't scanned
+    commit_id = _resolve_commit_id(commit_id)
+    # Branch logs are not rewritten, the message is applied at read time
+    _add_note(commit_id, {"message": message})
     if console_info:
         click.echo(f"Commit message was changed")
 
 
-def _status():
+def _status(pathspecs=None):
+    """Returns lines with states of files, only files matching
+    pathspecs are scanned and shown, if they are given"""
     _check_repository_existence()
-    staging_area = _update_staging_area()
+    pathspecs = _get_pathspec_patterns(pathspecs)
+    staging_area = _update_staging_area(pathspecs, save=False)
     staging_files = staging_area["staging_files"]
     status_list = [f"Current branch is '{staging_area['current_branch']}'\n"]
+    last_commit = _get_last_commit(staging_area["current_branch"])
+    index = _read_index()
+    renames = _detect_renames(
+        [f for f in staging_files[FileState.DELETED.name]
+         if _matches_patterns(f, pathspecs)],
+        [f for f in staging_files[FileState.NEW.name]
+         if _matches_patterns(f, pathspecs)],
+        last_commit["files"] if last_commit else dict(), index)
+    _write_index(index)
+    renamed = set(renames) | set(renames.values())
     for key, files in staging_files.items():
+        files = [file for file in files
+                 if _matches_patterns(file, pathspecs) and file not in renamed]
         if files:
             status_list.append(f"{key} FILES:\n")
             for file in files:
                 status_list.append(f"- {file}\n")
+    if renames:
+        status_list.append("RENAMED FILES:\n")
+        for new, old in sorted(renames.items()):
+            status_list.append(f"- {old} -> {new}\n")
     return status_list
 
 
-def _log():
-    """Display commit history"""
+def _status_recursive(directory, dirty_only=False, max_workers=None):
+    """Finds repositories under directory and yields their summaries
+    (see _get_repository_summary) as soon as they are ready. Status of
+    repository starts, when it is found, while search goes on"""
+    # Every status runs in its own process, because it changes
+    # working directory and repository paths
+    with ProcessPoolExecutor(max_workers) as executor:
+        pending = set()
+        for root in _find_repositories(directory):
+            pending.add(executor.submit(_get_repository_summary, root))
+            done = {future for future in pending if future.done()}
+            pending -= done
+            for future in done:
+                summary = future.result()
+                if summary["dirty"] or not dirty_only:
+                    yield summary
+        for future in as_completed(pending):
+            summary = future.result()
+            if summary["dirty"] or not dirty_only:
+                yield summary
+
+
+def _find_repositories(directory):
+    """Yields roots of repositories in directory and below it. Search
+    doesn't go into found repositories and skips directories, which are
+    ignored by repository around directory or by default patterns"""
+    ignore = DEFAULT_IGNORE
+    directory = os.path.abspath(directory)
+    for parent in [directory, *Path(directory).parents]:
+        ignore_path = os.path.join(parent, REPOSITORY_PATHS["GITIGNORE"])
+        if os.path.exists(ignore_path):
+            ignore = ut.read_json_file(ignore_path)
+            break
+    dirs = [directory]
+    while dirs:
+        current = dirs.pop()
+        if os.path.exists(os.path.join(current, REPOSITORY_PATHS["STAGING_AREA"])):
+            yield current
+            continue
+        try:
+            entries = list(os.scandir(current))
+        except OSError:
+            continue
+        for entry in entries:
+            if (entry.is_dir(follow_symlinks=False)
+                    and not ut.item_in_ignore(entry.path, ignore)):
+                dirs.append(entry.path)
+
+
+def _get_repository_summary(root):
+    """Returns dict with path, current branch, numbers of files in every
+    state and dirty flag of repository, or error message"""
+    summary = {"path": root, "branch": None, "dirty": True, "error": None}
+    try:
+        os.chdir(root)
+        with _use_repository(os.curdir):
+            staging_area = _update_staging_area(save=False)
+    except Exception as e:
+        summary["error"] = str(e) or type(e).__name__
+        return summary
+    staging_files = staging_area["staging_files"]
+    summary["branch"] = staging_area["current_branch"]
+    for state in (FileState.NEW, FileState.MODIFIED, FileState.DELETED,
+                  FileState.UNTRACKED):
+        summary[state.name.lower()] = len(staging_files[state.name])
+    summary["dirty"] = bool("merge" in staging_area or any(
+        summary[state.name.lower()] for state in
+        (FileState.NEW, FileState.MODIFIED, FileState.DELETED, FileState.UNTRACKED)))
+    return summary
+
+
+def _format_summary(summary, directory):
+    path = os.path.relpath(summary["path"], os.path.abspath(directory))
+    if summary["error"]:
+        return f"{path}: error: {summary['error']}"
+    if not summary["dirty"]:
+        return f"{path} [{summary['branch']}] clean"
+    return (f"{path} [{summary['branch']}] new {summary['new']}, "
+            f"modified {summary['modified']}, deleted {summary['deleted']}, "
+            f"untracked {summary['untracked']}")
+
+
+def _log(paths=None):
+    """Display commit history. If paths are given, only commits, which
+    changed them, are shown using path history index"""
     _check_repository_existence()
-    _update_staging_area()
+    if paths:
+        return _get_paths_log(paths)
+    _update_staging_area(save=False)
+    notes = _load_notes()
     log_list = ["Commit History:\n"]
-    log_path = Path(BRANCHES_LOG)
-    for branch_log_file in log_path.iterdir():
-        path = os.path.join(BRANCHES_LOG, branch_log_file.name)
-        branch_log_obj = ut.read_json_file(path)
+    for name, ref in _load_refs().items():
+        if ref["archived"]:
+            continue
+        path = os.path.join(BRANCHES_LOG, f"{name}.json")
+        branch_log_obj = records.read_branch_log(path)
         log_list.append(f"- {branch_log_obj['branch']}\n")
         dummy = branch_log_obj['head']
         if not dummy:
             continue
         commits = branch_log_obj["commits"]
         while True:
-            date = time.strptime(commits[dummy]["time"])
+            date = time.strptime(commits[dummy].time)
             str_date = f"{date.tm_mon:0>2}.{date.tm_mday:0>2}.{date.tm_year}"
-            message = commits[dummy]["message"]
+            message = _get_note(notes, dummy, "message", commits[dummy].message)
             log_list.append(f" - {str_date} {dummy} '{message}'\n")
-            if commits[dummy]["parent_commit_branch"] != branch_log_file.stem:
+            if commits[dummy].parent_commit_branch != name:
                 break
-            dummy = commits[dummy]["parent_commit_id"]
+            dummy = commits[dummy].parent_commit_id
+    return log_list
+
+
+def _get_paths_log(paths):
+    graph = _load_commit_graph()
+    notes = _load_notes()
+    branch_logs = dict()
+    log_list = []
+    for pattern, path in zip(_get_pathspec_patterns(paths) or ["."], paths):
+        if pattern == ".":
+            raise FileNotFoundError(f"Path '{path}' is not a file")
+        log_list.append(f"History of '{pattern}':\n")
+        for commit_id, file_hash, entry_path in reversed(
+                _get_path_history(pattern, graph)):
+            branch = graph[commit_id][0]
+            if branch not in branch_logs:
+                branch_logs[branch] = ut.read_json_file(
+                    os.path.join(BRANCHES_LOG, f"{branch}.json"))
+            commit = _apply_notes(branch_logs[branch]["commits"][commit_id], notes)
+            date = time.strptime(commit["time"])
+            str_date = f"{date.tm_mon:0>2}.{date.tm_mday:0>2}.{date.tm_year}"
+            note = "" if file_hash else " (deleted)"
+            if entry_path in commit.get("renames", dict()):
+                note = f" (renamed from '{commit['renames'][entry_path]}')"
+            elif entry_path != pattern:
+                note += f" ('{entry_path}')"
+            log_list.append(f" - {str_date} {commit_id} [{branch}] "
+                            f"'{commit['message']}'{note}\n")
     return log_list
 
 
+def _diff(first=None, second=None, mode=None):
+    """Returns lines with changes between two commits, or commit and
+    working directory, if the second one is not given. Working directory
+    is compared with the last commit of current branch by default. Mode
+    can be 'stat' or 'name-only', they don't read content of files"""
+    _check_repository_existence()
+    staging_area = _update_staging_area(save=False)
+    graph = _load_commit_graph()
+    if first:
+        old_files = _find_commit(_resolve_commit_id(first), graph)["files"]
+    else:
+        last_commit = _get_last_commit(staging_area["current_branch"])
+        old_files = last_commit["files"] if last_commit else dict()
+    old_files = {file: info for file, info in old_files.items()
+                 if info[2] != FileState.DELETED.name}
+
+    if second:
+        new_files = {file: info
+                     for file, info in _find_commit(_resolve_commit_id(second),
+                                                    graph)["files"].items()
+                     if info[2] != FileState.DELETED.name}
+        new_hashes = {file: info[1] for file, info in new_files.items()}
+        new_sources = {file: (_get_stored_file(info[0]),
+                              info[0].endswith(CHUNKS_SUFFIX))
+                       for file, info in new_files.items()}
+    else:
+        staging_files = staging_area["staging_files"]
+        index = _read_index()
+        config = _get_config()
+        patterns = _get_sparse_patterns()
+        new_hashes = dict()
+        new_sources = dict()
+        for state in (FileState.NEW, FileState.UNCHANGED, FileState.MODIFIED):
+            for file in staging_files[state.name]:
+                if os.path.exists(file):
+                    new_hashes[file], _ = _hash_file(file, index, config)
+                    new_sources[file] = (file, False)
+                elif not _matches_patterns(file, patterns):
+                    # Files outside of sparse checkout are not changed
+                    old_files.pop(file, None)
+        _write_index(index)
+
+    changes = []
+    for file in sorted(old_files.keys() | new_hashes.keys()):
+        old_hash = old_files[file][1] if file in old_files else None
+        if old_hash == new_hashes.get(file):
+            continue
+        old_source = None
+        if file in old_files:
+            old_source = (_get_stored_file(old_files[file][0]),
+                          old_files[file][0].endswith(CHUNKS_SUFFIX))
+        changes.append((file, old_source, new_sources.get(file)))
+
+    if mode == "name-only":
+        return [f"{os.path.relpath(file, CURRENT_DIR)}\n"
+                for file, _, _ in changes]
+    if mode == "stat":
+        return _get_diff_stat(changes)
+
+    olds = [old for _, old, _ in changes]
+    news = [new for _, _, new in changes]
+    old_labels = [f"a/{os.path.relpath(file, CURRENT_DIR)}" for file, _, _ in changes]
+    new_labels = [f"b/{os.path.relpath(file, CURRENT_DIR)}" for file, _, _ in changes]
+    with prof.span("diff"):
+        if len(changes) < DIFF_POOL_THRESHOLD:
+            diffs = map(ut.diff_files, olds, news, old_labels, new_labels,
+                        repeat(CHUNKS))
+            return [line for lines in diffs for line in lines]
+        with ProcessPoolExecutor() as executor:
+            diffs = executor.map(ut.diff_files, olds, news, old_labels,
+                                 new_labels, repeat(CHUNKS), chunksize=4)
+            return [line for lines in diffs for line in lines]
+
+
+def _get_diff_stat(changes):
+    lines = []
+    for file, old, new in changes:
+        old_size = ut.get_stored_size(*old) if old else 0
+        new_size = ut.get_stored_size(*new) if new else 0
+        state = "M" if old and new else ("A" if new else "D")
+        lines.append(f" {os.path.relpath(file, CURRENT_DIR)} | {state} | "
+                     f"{new_size - old_size:+d} bytes\n")
+    lines.append(f" {len(changes)} file(s) changed\n")
+    return lines
+
+
+def _archive(revision, output, archive_format=None, console_info=False):
+    """Writes files of commit (or the last commit of branch) to archive
+    straight from storage, working directory and staging area are not
+    touched. Output is path or binary file object. Returns number of
+    archived files"""
+    _check_repository_existence()
+    commit = _resolve_revision(revision)
+    files = [(name, _get_stored_file(info[0]), info[0].endswith(CHUNKS_SUFFIX))
+             for name, info in sorted(_get_commit_tree(commit).items())]
+    if archive_format is None:
+        archive_format = "tar"
+        for suffix, suffix_format in ARCHIVE_SUFFIXES.items():
+            if isinstance(output, str) and output.endswith(suffix):
+                archive_format = suffix_format
+                break
+    mtime = time.mktime(time.strptime(commit["time"]))
+    if isinstance(output, str):
+        temp_path = f"{output}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                ut.write_archive(f, files, archive_format, mtime, CHUNKS)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, output)
+    else:
+        ut.write_archive(output, files, archive_format, mtime, CHUNKS)
+    if console_info:
+        click.echo(f"Archived {len(files)} file(s) of commit "
+                   f"'{commit['id']}' to '{output}'\n")
+    return len(files)
+
+
+def _show(revision, path, f):
+    """Writes content of file in commit (or the last commit of branch)
+    to binary file object"""
+    _check_repository_existence()
+    commit = _resolve_revision(revision)
+    name = Path(os.path.normpath(path)).as_posix()
+    info = _get_commit_tree(commit).get(name)
+    if info is None:
+        raise FileNotFoundError(f"There is no file '{path}' in commit "
+                                f"'{commit['id']}'")
+    ut.copy_stored_file(f, _get_stored_file(info[0]), CHUNKS,
+                        info[0].endswith(CHUNKS_SUFFIX))
+
+
+def _grep(pattern, commits=None, all_branches=False, fixed=False,
+          ignore_case=False, paths=None):
+    """Returns lines 'commit:path:line number:line' with matches of pattern
+    in files of commits (the last commit of current branch by default).
+    Every stored version of file is searched once, however many commits
+    refer to it"""
+    _check_repository_existence()
+    regex = re.escape(pattern) if fixed else pattern
+    flags = re.IGNORECASE if ignore_case else 0
+    try:
+        re.compile(regex.encode(), flags)
+    except re.error as e:
+        raise exceptions.GrepException(f"Invalid regular expression "
+                                       f"'{pattern}': {e}")
+    graph = _load_commit_graph()
+    if all_branches:
+        branch_logs = [ut.read_json_file(file)
+                       for file in Path(BRANCHES_LOG).iterdir()]
+        found = {commit_id: commit for branch_log in branch_logs
+                 for commit_id, commit in branch_log["commits"].items()}
+        # The newest commits go first
+        found = [found[i] for i in sorted(found, key=lambda i: -graph[i][2])]
+    elif commits:
+        found = [_resolve_revision(commit, graph) for commit in commits]
+    else:
+        current_branch = ut.read_json_file(STAGING_AREA)["current_branch"]
+        found = [_resolve_revision(current_branch, graph)]
+
+    patterns = _get_pathspec_patterns(paths)
+    versions = dict()
+    references = []
+    for commit in found:
+        for path, info in sorted(_get_commit_tree(commit).items()):
+            if patterns and not _matches_patterns(path, patterns):
+                continue
+            versions.setdefault(info[1], _get_stored_file(info[0]))
+            references.append((commit["id"], path, info[1]))
+
+    hashes = list(versions)
+    sources = [versions[i] for i in hashes]
+    chunked = [i.endswith(CHUNKS_SUFFIX) for i in sources]
+    arguments = (sources, repeat(regex.encode()), repeat(CHUNKS), chunked,
+                 repeat(flags))
+    with prof.span("grep"):
+        if len(hashes) < GREP_POOL_THRESHOLD:
+            results = list(map(ut.grep_stored_file, *arguments))
+        else:
+            with ProcessPoolExecutor() as executor:
+                results = list(executor.map(ut.grep_stored_file, *arguments,
+                                            chunksize=4))
+    matches = dict(zip(hashes, results))
+    return [f"{commit_id}:{path}:{line_number}:{line}\n"
+            for commit_id, path, file_hash in references
+            for line_number, line in matches[file_hash]]
+
+
+@_locked
 def _branch(branch_name, console_info=False):
     """Create a new branch"""
     _check_repository_existence()
-    if os.path.exists(os.path.join(BRANCHES, branch_name)):
+    if branch_name in _load_refs():
         raise exceptions.BranchException(f"You can't create branch with name "
                                          f"'{branch_name}', because it already "
                                          f"exists")
     staging_area = _update_staging_area()
     current_branch = staging_area["current_branch"]
-    branch_log_path = os.path.join(BRANCHES_LOG, f"{current_branch}.json")
-    branch_log_obj = ut.read_json_file(branch_log_path)
-    if not branch_log_obj["commits"]:
+    head = _load_refs()[current_branch]["head"]
+    if not head:
         raise exceptions.BranchException(f"`There are no commits "
                                          f"on branch '{current_branch}'")
 
-    last_commit = branch_log_obj["commits"][branch_log_obj["head"]]
-    _create_branch(branch_name, last_commit["branch"], last_commit["id"])
+    _create_branch(branch_name, current_branch, head)
 
     _save_staging_area_state(staging_area)
     staging_area["current_branch"] = branch_name
@@ -306,6 +1179,77 @@ def _branch(branch_name, console_info=False):
         click.echo(f"Branch '{branch_name}' was created\n")
 
 
+def _list_branches(show_all=False):
+    """Returns lines with names of branches from ref table,
+    current branch is marked with '*'"""
+    _check_repository_existence()
+    current_branch = ut.read_json_file(STAGING_AREA)["current_branch"]
+    lines = []
+    for name, ref in sorted(_load_refs().items()):
+        if ref["archived"] and not show_all:
+            continue
+        mark = "*" if name == current_branch else " "
+        archived = " (archived)" if ref["archived"] else ""
+        lines.append(f"{mark} {name}{archived}\n")
+    return lines
+
+
+@_locked
+def _delete_branch(branch_name, console_info=False):
+    """Removes branch log and ref. Branch, which commits are parents of
+    other branches, can't be deleted. Stored files are left for gc,
+    because other branches can refer to them after cherry-pick or merge"""
+    _check_repository_existence()
+    refs = _load_refs()
+    if branch_name not in refs:
+        raise exceptions.BranchException(f"Branch '{branch_name}' does not exist")
+    if branch_name in _get_checked_out_branches().values():
+        raise exceptions.BranchException(f"You can't delete the current branch "
+                                         f"of working tree")
+    graph = _load_commit_graph()
+    dependent = {name for name, ref in refs.items()
+                 if ref["parent_branch"] == branch_name and name != branch_name}
+    dependent.update(info[0] for info in graph.values()
+                     if info[0] != branch_name
+                     and any(graph[i][0] == branch_name for i in info[1] if i in graph))
+    if dependent:
+        raise exceptions.BranchException(f"Branch '{branch_name}' can't be deleted, "
+                                         f"because branches "
+                                         f"{', '.join(sorted(dependent))} "
+                                         f"are based on it")
+
+    os.remove(os.path.join(BRANCHES_LOG, f"{branch_name}.json"))
+    staging_area_path = os.path.join(BRANCHES, branch_name, "staging_area.json")
+    if os.path.exists(staging_area_path):
+        os.remove(staging_area_path)
+    _remove_empty_directory(os.path.join(BRANCHES, branch_name))
+    _add_ref_updates([(branch_name, None)])
+    _write_commit_graph({commit_id: info for commit_id, info in graph.items()
+                         if info[0] != branch_name})
+    _compact_notes()
+    # Stored files are counted, until gc removes them
+    _update_stats(lambda stats: stats["branches"].pop(branch_name, None))
+    if console_info:
+        click.echo(f"Branch '{branch_name}' was deleted\n")
+
+
+@_locked
+def _archive_branch(branch_name, archived=True, console_info=False):
+    """Hides branch from lists and log or shows it again"""
+    _check_repository_existence()
+    refs = _load_refs()
+    if branch_name not in refs:
+        raise exceptions.BranchException(f"Branch '{branch_name}' does not exist")
+    if branch_name in _get_checked_out_branches().values():
+        raise exceptions.BranchException(f"You can't archive the current branch "
+                                         f"of working tree")
+    _add_ref_updates([(branch_name, {"archived": archived})])
+    if console_info:
+        action = "archived" if archived else "unarchived"
+        click.echo(f"Branch '{branch_name}' was {action}\n")
+
+
+@_locked
 def _checkout(branch_name, console_info=False):
     """Switch to a different branch"""
     _check_repository_existence()
@@ -313,10 +1257,17 @@ def _checkout(branch_name, console_info=False):
     branch_log_path = os.path.join(BRANCHES_LOG, f"{branch_name}.json")
     if not os.path.exists(branch_log_path):
         raise exceptions.CheckoutException(f"Branch '{branch_name}' does not exist")
+    if _load_refs()[branch_name]["archived"]:
+        raise exceptions.CheckoutException(f"Branch '{branch_name}' is archived. "
+                                           f"Unarchive it before checkout")
 
     staging_area = _update_staging_area()
     if branch_name == staging_area["current_branch"]:
         raise exceptions.CheckoutException(f"You are already on branch '{branch_name}'")
+    for path, branch in _get_checked_out_branches().items():
+        if branch == branch_name:
+            raise exceptions.CheckoutException(f"Branch '{branch_name}' is checked "
+                                               f"out in working tree '{path}'")
 
     staging_files = staging_area["staging_files"]
     if (staging_files[FileState.NEW.name] or staging_files[FileState.DELETED.name]
@@ -332,45 +1283,93 @@ def _checkout(branch_name, console_info=False):
     ignores = ut.read_json_file(GITIGNORE)
     ut.clear_directory(CURRENT_DIR, ignores)
     last_commit = _get_last_commit(branch_name)
-    ut.copy_files(CURRENT_DIR, [val[0] for _, val in last_commit["files"].items()
-                                if val[2] != FileState.DELETED.name])
+    patterns = _get_sparse_patterns()
+    _restore_files({file: val for file, val in last_commit["files"].items()
+                    if val[2] != FileState.DELETED.name
+                    and _matches_patterns(file, patterns)})
 
     if console_info:
         click.echo(f"Switched to branch '{branch_name}'\n")
 
 
-def _cherry_pick(commit_id, console_info=False):
+@_locked
+def _cherry_pick(commit_ids, console_info=False):
+    """Applies commits to the current branch. Receives commit id, range
+    'A..B' (commits after A up to B) or list of them. All commits are
+    composed in memory, written to branch log at once and only the final
+    version of every file is written to working directory"""
     _check_repository_existence()
     staging_area = _update_staging_area()
-    commit_log = None
-    success = False
-    for file in Path(BRANCHES_LOG).iterdir():
-        branch_log = ut.read_json_file(file)
-        if commit_id in branch_log['commits']:
-            success = True
-            commit_log = branch_log['commits'][commit_id]
-            break
-    if not success:
-        raise FileNotFoundError(f"There is no commit with id '{commit_id}'")
-    last_commit = _get_last_commit(staging_area["current_branch"])
-    if last_commit["id"] == commit_id:
+    graph = _load_commit_graph()
+    if isinstance(commit_ids, str):
+        commit_ids = [commit_ids]
+    picked_ids = []
+    for commit_id in commit_ids:
+        picked_ids += _resolve_commit_range(commit_id, graph)
+
+    current_branch = staging_area["current_branch"]
+    last_commit = _get_last_commit(current_branch)
+    if not last_commit:
+        raise exceptions.CherryPickException(f"There are no commits "
+                                             f"on branch '{current_branch}'")
+    if last_commit["id"] in picked_ids:
         raise exceptions.CherryPickException(f"You can not cherry pick current commit")
-    commit_id = str(time.time() * 1000)[:13]
+
+    branch_logs = dict()
     commit_files = {key: [val[0], val[1], FileState.UNCHANGED.name]
-                    for key, val in last_commit["files"].items()}
-    files_to_copy = []
+                    for key, val in last_commit["files"].items()
+                    if val[2] != FileState.DELETED.name}
+    initial_hashes = {key: val[1] for key, val in commit_files.items()}
+    changed_files = set()
+    new_commits = []
+    parent = last_commit
+    taken_ids = set(graph)
+    notes = _load_notes()
+    for picked_id in picked_ids:
+        branch = graph[picked_id][0]
+        if branch not in branch_logs:
+            branch_logs[branch] = ut.read_json_file(
+                os.path.join(BRANCHES_LOG, f"{branch}.json"))
+        commit_log = branch_logs[branch]["commits"][picked_id]
+        commit_files = {key: [val[0], val[1], FileState.UNCHANGED.name]
+                        for key, val in commit_files.items()
+                        if val[2] != FileState.DELETED.name}
+        for file, info in commit_log["files"].items():
+            if (info[2] == FileState.MODIFIED.name and file in commit_files
+                    or info[2] == FileState.NEW.name):
+                commit_files[file] = list(info)
+                changed_files.add(file)
+            elif info[2] == FileState.DELETED.name and file in commit_files:
+                commit_files[file][2] = FileState.DELETED.name
+                changed_files.add(file)
+        commit_id = _generate_commit_id([parent["id"], picked_id, current_branch],
+                                        taken_ids)
+        taken_ids.add(commit_id)
+        new_commits.append({
+            "time": time.ctime(),
+            "parent_commit_branch": parent["branch"],
+            "parent_commit_id": parent["id"],
+            "branch": current_branch,
+            "id": commit_id,
+            "message": _get_note(notes, picked_id, "message", commit_log["message"]),
+            "files": commit_files
+        })
+        parent = new_commits[-1]
+
+    files_to_copy = dict()
     unchanged = set(staging_area["staging_files"][FileState.UNCHANGED.name])
-    for file, info in commit_log["files"].items():
-        if (info[2] == FileState.MODIFIED.name and file in commit_files
-                or info[2] == FileState.NEW.name):
-            commit_files[file] = info
-            files_to_copy.append(info[0])
-            unchanged.add(file)
-        elif info[2] == FileState.DELETED.name and file in commit_files:
-            commit_files[file][2] = FileState.DELETED.name
-            os.remove(file)
-            if file in unchanged:
-                unchanged.remove(file)
+    patterns = _get_sparse_patterns()
+    for file in changed_files:
+        info = commit_files[file]
+        in_sparse_checkout = _matches_patterns(file, patterns)
+        if info[2] == FileState.DELETED.name:
+            unchanged.discard(file)
+            if in_sparse_checkout and os.path.exists(file):
+                os.remove(file)
+            continue
+        unchanged.add(file)
+        if in_sparse_checkout and initial_hashes.get(file) != info[1]:
+            files_to_copy[file] = info
 
     staging_area["staging_files"][FileState.UNCHANGED.name] = list(unchanged)
     staging_area["staging_files"][FileState.DELETED.name] = []
@@ -379,19 +1378,1089 @@ def _cherry_pick(commit_id, console_info=False):
     staging_area["staging_files"][FileState.NEW.name] = []
 
     ut.write_json_file(STAGING_AREA, staging_area)
-    _create_commit(staging_area["current_branch"], commit_id,
-                   commit_log["message"], commit_files,
-                   last_commit["id"], last_commit["branch"])
-    ut.copy_files(CURRENT_DIR, files_to_copy)
+    _create_commits(current_branch, new_commits)
+    _add_to_stats(new_commits)
+    _restore_files(files_to_copy)
 
     if console_info:
         click.echo(f"Cherry pick was made successfully")
 
 
+@_locked
+def _merge(branch_name, console_info=False):
+    """Merges last commit of branch into the current branch. Files, which
+    were changed only on one side, are taken by hash comparison, files,
+    which were changed on both sides, are merged line by line. Merge is
+    commited at once, if there are no conflicts, otherwise conflicts are
+    written to working directory and must be resolved and commited"""
+    _check_repository_existence()
+    branch_log_path = os.path.join(BRANCHES_LOG, f"{branch_name}.json")
+    if not os.path.exists(branch_log_path):
+        raise exceptions.MergeException(f"Branch '{branch_name}' does not exist")
+    staging_area = _update_staging_area()
+    current_branch = staging_area["current_branch"]
+    if branch_name == current_branch:
+        raise exceptions.MergeException(f"You can't merge branch into itself")
+    staging_files = staging_area["staging_files"]
+    if (staging_files[FileState.NEW.name] or staging_files[FileState.DELETED.name]
+            or staging_files[FileState.MODIFIED.name]
+            or staging_area.get("merge")):
+        raise exceptions.MergeException(f"You have uncommited changes. "
+                                        f"Commit them before merge")
+
+    ours = _get_last_commit(current_branch)
+    theirs = _get_last_commit(branch_name)
+    if not ours or not theirs:
+        raise exceptions.MergeException(f"There are no commits to merge")
+    graph = _load_commit_graph()
+    base_id = _get_merge_base(graph, ours["id"], theirs["id"])
+    if base_id == theirs["id"]:
+        raise exceptions.MergeException(f"Branch '{branch_name}' "
+                                        f"is already merged")
+    base_files = _find_commit(base_id, graph)["files"] if base_id else dict()
+
+    commit_id = _generate_commit_id([ours["id"], theirs["id"], current_branch])
+    commit_files = {file: [info[0], info[1], FileState.UNCHANGED.name]
+                    for file, info in ours["files"].items()
+                    if info[2] != FileState.DELETED.name}
+    files_to_restore = dict()
+    merged_contents = dict()
+    conflicts = []
+    for file in ours["files"].keys() | theirs["files"].keys():
+        base_hash = _get_existing_hash(base_files.get(file))
+        ours_hash = _get_existing_hash(ours["files"].get(file))
+        theirs_hash = _get_existing_hash(theirs["files"].get(file))
+        if ours_hash == theirs_hash or base_hash == theirs_hash:
+            continue
+        if base_hash == ours_hash:
+            if theirs_hash is None:
+                commit_files[file][2] = FileState.DELETED.name
+            else:
+                state = FileState.NEW if ours_hash is None else FileState.MODIFIED
+                commit_files[file] = [theirs["files"][file][0], theirs_hash,
+                                      state.name]
+                files_to_restore[file] = commit_files[file]
+            continue
+
+        content = None
+        if ours_hash is not None and theirs_hash is not None:
+            content = _merge_file_versions(
+                base_files.get(file) if base_hash else None,
+                ours["files"][file], theirs["files"][file],
+                current_branch, branch_name)
+        if content is None or content[1]:
+            conflicts.append(file)
+            if content is not None:
+                merged_contents[file] = content[0]
+            elif ours_hash is None:
+                files_to_restore[file] = theirs["files"][file]
+            continue
+        stored_path = _get_stored_path(current_branch, commit_id, file)
+        merged_contents[file] = content[0]
+        commit_files[file] = [stored_path, hashlib.sha256(content[0]).hexdigest(),
+                              FileState.MODIFIED.name]
+
+    patterns = _get_sparse_patterns()
+    _restore_files({file: info for file, info in files_to_restore.items()
+                    if _matches_patterns(file, patterns)})
+    for file, info in commit_files.items():
+        if (info[2] == FileState.DELETED.name and file in ours["files"]
+                and os.path.exists(file)):
+            os.remove(file)
+    for file, content in merged_contents.items():
+        if _matches_patterns(file, patterns) or file in conflicts:
+            with open(file, "wb") as f:
+                f.write(content)
+
+    if conflicts:
+        staging_files[FileState.NEW.name] += [
+            file for file in files_to_restore if file not in ours["files"]]
+        staging_area["merge"] = {"id": theirs["id"], "branch": theirs["branch"]}
+        ut.write_json_file(STAGING_AREA, staging_area)
+        raise exceptions.MergeException(f"Merge conflicts in: "
+                                        f"{', '.join(sorted(conflicts))}. "
+                                        f"Resolve them and commit")
+
+    staging_files[FileState.UNCHANGED.name] = [
+        file for file, info in commit_files.items()
+        if info[2] != FileState.DELETED.name]
+    staging_files[FileState.UNTRACKED.name] = [
+        file for file in staging_files[FileState.UNTRACKED.name]
+        if file not in commit_files]
+    ut.write_json_file(STAGING_AREA, staging_area)
+    _create_commit(current_branch, commit_id,
+                   f"Merge branch '{branch_name}' into '{current_branch}'",
+                   commit_files, ours["id"], ours["branch"],
+                   {"id": theirs["id"], "branch": theirs["branch"]})
+    for file, content in merged_contents.items():
+        stored_file = _get_stored_file(commit_files[file][0])
+        os.makedirs(os.path.dirname(stored_file), exist_ok=True)
+        with open(stored_file, "wb") as f:
+            f.write(content)
+    added = {commit_files[file][0]: (commit_files[file][1], len(content), file)
+             for file, content in merged_contents.items()}
+    _add_to_stats([{"branch": current_branch, "files": commit_files}],
+                  list(added.values()))
+    if console_info:
+        click.echo(f"Branch '{branch_name}' was merged into "
+                   f"'{current_branch}'\n")
+
+
+@_locked
+def _gc(keep_last=None, keep_since=None, dry_run=False, time_budget=None,
+        console_info=False):
+    """Removes commits, which are out of retention, and stored files and
+    chunks, which are not referenced by remaining commits. Returns dict
+    with numbers of removed commits, files and bytes. Time budget limits
+    only removal of files and chunks, branch logs are always read and
+    pruned completely, because every reference must be marked first"""
+    _check_repository_existence()
+    deadline = time.monotonic() + time_budget if time_budget else None
+    branch_logs = {file.stem: ut.read_json_file(file)
+                   for file in Path(BRANCHES_LOG).iterdir()}
+    kept = _get_retained_commits(branch_logs, keep_last, keep_since)
+    report = {"commits": 0, "files": 0, "chunks": 0, "bytes": 0,
+              "complete": True}
+
+    marked_files = set()
+    marked_chunks = set()
+    # Hashes of stored files, which statistics know them by
+    known_hashes = dict()
+    pruned_numbers = dict()
+    pruned_ids = {commit_id for branch_log in branch_logs.values()
+                  for commit_id in branch_log["commits"] if commit_id not in kept}
+    changed_logs = []
+    for name, branch_log in branch_logs.items():
+        commits = branch_log["commits"]
+        pruned = [i for i in commits if i not in kept]
+        report["commits"] += len(pruned)
+        pruned_numbers[name] = len(pruned)
+        # Branch, which oldest commits are pruned, isn't based on removed
+        # commit of its parent branch any more
+        based_on_pruned = branch_log["parent_commit_id"] in pruned_ids
+        if based_on_pruned:
+            branch_log["parent_branch"] = None
+            branch_log["parent_commit_id"] = None
+        for commit_id in pruned:
+            for info in commits[commit_id]["files"].values():
+                known_hashes[os.path.abspath(_get_stored_file(info[0]))] = info[1]
+            del commits[commit_id]
+        for commit in commits.values():
+            if (commit["parent_commit_branch"] == name
+                    and commit["parent_commit_id"] not in commits):
+                commit["parent_commit_id"] = None
+                commit["parent_commit_branch"] = None
+            for info in commit["files"].values():
+                stored_file = _get_stored_file(info[0])
+                marked_files.add(os.path.abspath(stored_file))
+                if info[0].endswith(CHUNKS_SUFFIX) and os.path.exists(stored_file):
+                    marked_chunks.update(i[0] for i in ut.read_json_file(stored_file))
+        if (pruned or based_on_pruned) and not dry_run:
+            ut.write_json_file(os.path.join(BRANCHES_LOG, f"{name}.json"),
+                               branch_log)
+        if based_on_pruned:
+            changed_logs.append(branch_log)
+    if changed_logs and not dry_run:
+        _update_refs(changed_logs)
+    if report["commits"] and not dry_run:
+        _rebuild_commit_graph(branch_logs.values())
+        _rebuild_path_history(branch_logs.values())
+    if not dry_run:
+        _compact_notes(force=True)
+
+    removed = []
+    for path in _get_stored_files():
+        if deadline and time.monotonic() > deadline:
+            report["complete"] = False
+            break
+        if os.path.abspath(path) in marked_files:
+            continue
+        size = os.path.getsize(path)
+        report["files"] += 1
+        report["bytes"] += size
+        if not dry_run:
+            removed.append((_get_stored_hash(
+                path, known_hashes.get(os.path.abspath(path))), size, path))
+            os.remove(path)
+            _remove_empty_directories(path)
+
+    if report["complete"] and not dry_run:
+        # Directories of deleted branches are removed after their files
+        for branch_dir in Path(BRANCHES).iterdir():
+            if branch_dir.is_dir() and branch_dir.name not in branch_logs:
+                _remove_empty_directory(branch_dir)
+
+    if not dry_run:
+        def remove_commits(stats):
+            for name, number in pruned_numbers.items():
+                if name in stats["branches"]:
+                    stats["branches"][name]["commits"] -= number
+        _update_stats(remove_commits, removed=removed)
+
+    if report["complete"] and os.path.exists(CHUNKS):
+        for path in ut.get_files(CHUNKS, {"START": [], "FORMATS": [],
+                                          "FILES": [], "DIRECTORIES": []}):
+            if deadline and time.monotonic() > deadline:
+                report["complete"] = False
+                break
+            if Path(path).name in marked_chunks:
+                continue
+            report["chunks"] += 1
+            report["bytes"] += os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+
+    if console_info:
+        action = "Would remove" if dry_run else "Removed"
+        click.echo(f"{action} {report['commits']} commit(s), "
+                   f"{report['files']} file(s), {report['chunks']} chunk(s), "
+                   f"{report['bytes']} byte(s)\n")
+        if not report["complete"]:
+            click.echo("Time budget is over, run gc again to continue\n")
+    return report
+
+
+def _fsck(quick=False):
+    """Checks branch logs, links between commits, commit graph, staging
+    area and stored files. Every stored file and chunk is checked once,
+    however many commits refer to it. Contents are hashed in parallel,
+    quick mode checks only existence of files and sizes of chunks.
+    Returns report with list of found errors"""
+    _check_repository_existence()
+    branch_logs = {file.stem: ut.read_json_file(file)
+                   for file in Path(BRANCHES_LOG).iterdir()}
+    errors = _check_branch_logs(branch_logs)
+    errors += _check_commit_graph(branch_logs)
+    errors += _check_staging_area(branch_logs)
+
+    # Stored file is referenced by every commit, where it is unchanged
+    objects = dict()
+    for branch_log in branch_logs.values():
+        for commit_id, commit in branch_log["commits"].items():
+            for file, info in commit["files"].items():
+                if info[2] == FileState.DELETED.name:
+                    continue
+                path = os.path.abspath(_get_stored_file(info[0]))
+                if path not in objects:
+                    objects[path] = (info[1], commit_id)
+                elif objects[path][0] != info[1]:
+                    errors.append(_fsck_error(
+                        "object_conflict", "Stored file has different hashes "
+                                           "in commits", path=info[0],
+                        commit=commit_id))
+    object_errors, chunks = _check_objects(objects, quick)
+    errors += object_errors
+    return {"quick": quick,
+            "commits": sum(len(i["commits"]) for i in branch_logs.values()),
+            "objects": len(objects), "chunks": chunks, "errors": errors}
+
+
+def _get_stats(recompute=False):
+    """Returns statistics of repository, which commands keep up to date,
+    so only one small file is read. With recompute they are rebuilt
+    from branch logs and stored files"""
+    _check_repository_existence()
+    if recompute or not os.path.exists(STATS):
+        _recompute_stats()
+    return ut.read_json_file(STATS)
+
+
+def _format_stats(stats):
+    lines = [f"Stored files: {stats['stored_files']}, "
+             f"{stats['stored_bytes']} byte(s)\n",
+             f"Unique contents: {stats['unique_contents']}, "
+             f"{stats['unique_bytes']} byte(s)\n",
+             "Branches:\n"]
+    for name, branch in sorted(stats["branches"].items()):
+        lines.append(f" - {name}: {branch['commits']} commit(s), "
+                     f"{branch['files']} file(s)\n")
+    if stats["largest"]:
+        lines.append("Largest contents:\n")
+        for size, file_hash, path in stats["largest"]:
+            lines.append(f" - {path} {file_hash[:8]}: {size} byte(s)\n")
+    return lines
+
+
+def _get_repository_root():
+    """Returns absolute path of repository, which is shared by
+    working trees"""
+    if os.path.exists(WORKTREE):
+        return ut.read_json_file(WORKTREE)["repository"]
+    return os.path.abspath(CURRENT_DIR)
+
+
+def _get_worktrees():
+    if not os.path.exists(WORKTREES):
+        return []
+    return ut.read_json_file(WORKTREES)
+
+
+def _get_checked_out_branches():
+    """Returns dict where key is absolute path of repository or working
+    tree and value is its current branch"""
+    root = _get_repository_root()
+    branches = dict()
+    for path in [root] + _get_worktrees():
+        staging_area_path = os.path.join(path, REPOSITORY_PATHS["STAGING_AREA"])
+        if os.path.exists(staging_area_path):
+            branches[path] = ut.read_json_file(staging_area_path)["current_branch"]
+    return branches
+
+
+@_locked
+def _add_worktree(path, branch_name, console_info=False):
+    """Creates working tree in directory with files of branch. It has its
+    own staging area and index, while commits and stored files are shared
+    with repository. Repository can be opened by absolute path (GUI, async
+    API), but file paths of its commits must be relative to its root"""
+    _check_repository_existence()
+    refs = _load_refs()
+    if branch_name not in refs or refs[branch_name]["archived"]:
+        raise exceptions.WorktreeException(f"Branch '{branch_name}' does not "
+                                           f"exist or is archived")
+    last_commit = _get_last_commit(branch_name)
+    if last_commit and any(map(os.path.isabs, last_commit["files"])):
+        raise exceptions.WorktreeException(f"Working trees are supported only "
+                                           f"for commits with paths relative "
+                                           f"to repository")
+    for checked_out_path, branch in _get_checked_out_branches().items():
+        if branch == branch_name:
+            raise exceptions.WorktreeException(f"Branch '{branch_name}' is checked "
+                                               f"out in '{checked_out_path}'")
+    path = os.path.abspath(path)
+    if os.path.exists(path) and any(Path(path).iterdir()):
+        raise exceptions.WorktreeException(f"Directory '{path}' is not empty")
+    root = _get_repository_root()
+    # Nested working tree would be scanned as files of the enclosing one
+    for tree in [root] + _get_worktrees():
+        real_tree = os.path.realpath(tree)
+        if os.path.commonpath([real_tree, os.path.realpath(path)]) == real_tree:
+            raise exceptions.WorktreeException(f"Directory '{path}' is inside "
+                                               f"working tree '{tree}'")
+
+    os.makedirs(CHUNKS, exist_ok=True)
+    os.makedirs(os.path.join(path, os.path.dirname(REPOSITORY_PATHS["WORKTREE"])))
+    for name in LINKED_PATHS:
+        os.symlink(os.path.join(root, REPOSITORY_PATHS[name]),
+                   os.path.join(path, REPOSITORY_PATHS[name]),
+                   target_is_directory=True)
+    ut.write_json_file(os.path.join(path, REPOSITORY_PATHS["WORKTREE"]),
+                       {"repository": root})
+    ut.write_json_file(WORKTREES, _get_worktrees() + [path])
+
+    files = {file: info for file, info in last_commit["files"].items()
+             if info[2] != FileState.DELETED.name} if last_commit else dict()
+    staging_area = {"current_branch": branch_name,
+                    "staging_files": {state.name: [] for state in FileState}}
+    staging_area["staging_files"][FileState.UNCHANGED.name] = list(files)
+    # Files of the new working tree are written from its directory
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with _use_repository(os.curdir):
+            ut.write_json_file(STAGING_AREA, staging_area)
+            _restore_files(files)
+    finally:
+        os.chdir(cwd)
+    if console_info:
+        click.echo(f"Working tree '{path}' with branch '{branch_name}' "
+                   f"was created\n")
+
+
+@_locked
+def _remove_worktree(path, console_info=False):
+    """Removes directory of working tree, which has no uncommited changes
+    and untracked files. Its staging area is kept for its branch"""
+    _check_repository_existence()
+    path = os.path.abspath(path)
+    worktrees = _get_worktrees()
+    if path not in worktrees:
+        raise exceptions.WorktreeException(f"There is no working tree '{path}'")
+    if path == os.path.abspath(CURRENT_DIR):
+        raise exceptions.WorktreeException(f"You can't remove the current "
+                                           f"working tree")
+    if os.path.exists(path):
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            with _use_repository(os.curdir):
+                staging_area = _update_staging_area()
+                if any(staging_area["staging_files"][state.name]
+                       for state in FileState if state != FileState.UNCHANGED):
+                    raise exceptions.WorktreeException(
+                        f"Working tree '{path}' has uncommited changes "
+                        f"or untracked files")
+                _save_staging_area_state(staging_area)
+        finally:
+            os.chdir(cwd)
+        shutil.rmtree(path)
+    worktrees.remove(path)
+    ut.write_json_file(WORKTREES, worktrees)
+    if console_info:
+        click.echo(f"Working tree '{path}' was removed\n")
+
+
+def _get_alternates():
+    """Returns list of absolute paths of shared object stores. Objects
+    there are named by hashes of their content and are never removed
+    by this repository"""
+    if not os.path.exists(ALTERNATES):
+        return []
+    return ut.read_json_file(ALTERNATES)
+
+
+@_locked
+def _add_alternate(path, console_info=False):
+    _check_repository_existence()
+    path = os.path.abspath(path)
+    alternates = _get_alternates()
+    if path in alternates:
+        raise exceptions.RepackException(f"Store '{path}' is already used")
+    os.makedirs(path, exist_ok=True)
+    alternates.append(path)
+    ut.write_json_file(ALTERNATES, alternates)
+    if console_info:
+        click.echo(f"Shared store '{path}' was added\n")
+
+
+def _get_shared_path(store, file_hash):
+    return os.path.join(store, file_hash[:2], file_hash)
+
+
+def _find_shared_object(file_hash, alternates=None):
+    """Returns path of object with content hash in shared stores or None"""
+    if alternates is None:
+        alternates = _get_alternates()
+    for store in alternates:
+        path = _get_shared_path(store, file_hash)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+@_locked
+def _repack_shared(store=None, console_info=False):
+    """Moves content of stored files to shared object store and points
+    commits to it, so repositories using one store keep one copy of
+    every content. Local copies are removed by gc. Chunked files stay
+    in chunk store. Returns dict with numbers of files copied to store,
+    files, which content store already had, and freed bytes"""
+    _check_repository_existence()
+    alternates = _get_alternates()
+    if store is None:
+        if not alternates:
+            raise exceptions.RepackException(f"There is no shared store, add "
+                                              f"it with 'cvs alternates add'")
+        store = alternates[0]
+    elif os.path.abspath(store) not in alternates:
+        _add_alternate(store)
+        alternates = _get_alternates()
+    store = os.path.abspath(store)
+
+    report = {"copied": 0, "shared": 0, "bytes": 0}
+    moved = dict()
+    for file in Path(BRANCHES_LOG).iterdir():
+        branch_log = ut.read_json_file(file)
+        changed = False
+        for commit in branch_log["commits"].values():
+            for info in commit["files"].values():
+                stored_path = _get_stored_file(info[0])
+                if stored_path not in moved:
+                    if stored_path.endswith(CHUNKS_SUFFIX) \
+                            or _get_stored_name(os.path.abspath(stored_path)) \
+                            .startswith(SHARED_OBJECTS_NAME) \
+                            or not os.path.exists(stored_path):
+                        moved[stored_path] = None
+                        continue
+                    shared_path = _find_shared_object(info[1], alternates)
+                    if shared_path:
+                        report["shared"] += 1
+                    else:
+                        shared_path = _get_shared_path(store, info[1])
+                        ut.store_shared_object(stored_path, shared_path)
+                        report["copied"] += 1
+                    moved[stored_path] = shared_path
+                if moved[stored_path]:
+                    info[0] = moved[stored_path]
+                    changed = True
+        if changed:
+            ut.write_json_file_atomic(file, branch_log)
+
+    report["bytes"] = _gc()["bytes"]
+    if console_info:
+        click.echo(f"Copied {report['copied']} file(s) to shared store, "
+                   f"{report['shared']} file(s) were already there, "
+                   f"freed {report['bytes']} byte(s)\n")
+    return report
+
+
+@_locked
+def _add_remote(name, path, console_info=False):
+    _check_repository_existence()
+    path = os.path.abspath(path)
+    if not os.path.exists(os.path.join(path, REPOSITORY_PATHS["MAIN_BRANCH"])):
+        raise exceptions.RemoteException(f"There is no repository in '{path}'")
+    remotes = _get_remotes()
+    if name in remotes:
+        raise exceptions.RemoteException(f"Remote '{name}' already exists")
+    remotes[name] = path
+    ut.write_json_file(REMOTES, remotes)
+    if console_info:
+        click.echo(f"Remote '{name}' was added\n")
+
+
+def _get_hooks():
+    if not os.path.exists(HOOKS):
+        return dict()
+    return ut.read_json_file(HOOKS)
+
+
+@_locked
+def _add_hook(name, command, patterns=(), batch_size=None, console_info=False):
+    _check_repository_existence()
+    hooks = _get_hooks()
+    if name in hooks:
+        raise exceptions.HookException(f"Hook '{name}' already exists")
+    hooks[name] = {"command": command, "files": list(patterns),
+                   "batch_size": batch_size}
+    ut.write_json_file(HOOKS, hooks)
+    if console_info:
+        click.echo(f"Hook '{name}' was added\n")
+
+
+@_locked
+def _remove_hook(name, console_info=False):
+    _check_repository_existence()
+    hooks = _get_hooks()
+    if name not in hooks:
+        raise exceptions.HookException(f"There is no hook '{name}'")
+    del hooks[name]
+    ut.write_json_file(HOOKS, hooks)
+    if console_info:
+        click.echo(f"Hook '{name}' was removed\n")
+
+
+def _list_hooks():
+    _check_repository_existence()
+    lines = []
+    for name, hook in _get_hooks().items():
+        files = f" [{', '.join(hook['files'])}]" if hook["files"] else ""
+        lines.append(f"{name}: {hook['command']}{files}\n")
+    return lines
+
+
+def _run_hooks(files, max_workers=None):
+    """Runs hooks on files, which match their patterns, in batches by
+    thread pool. Files, which content has passed the same hook command
+    before, are skipped. Returns dict where key is hook name and value is
+    dict with numbers of checked and cached files, batches and time in
+    seconds. Raises HookException with output of failed hooks"""
+    hooks = _get_hooks()
+    if not hooks or not files:
+        return dict()
+    index = _read_index()
+    config = _get_config()
+    with prof.span("hooks.hash"):
+        hashes = {file: _hash_file(file, index, config)[0] for file in files}
+    _write_index(index)
+    paths = {file: "/".join(_relative_parts(file)) for file in files}
+
+    cache = ut.read_json_file(HOOK_CACHE) if os.path.exists(HOOK_CACHE) else dict()
+    passed = dict()
+    report = dict()
+    batches = []
+    for name, hook in hooks.items():
+        entry = cache.get(name)
+        passed[name] = set(entry["hashes"]) if entry and \
+            entry["command"] == hook["command"] else set()
+        matched = [file for file in files
+                   if _matches_hook_patterns(paths[file], hook["files"])]
+        checked = [file for file in matched if hashes[file] not in passed[name]]
+        report[name] = {"files": len(checked),
+                        "cached": len(matched) - len(checked),
+                        "batches": 0, "time": 0.0}
+        size = hook["batch_size"] or HOOK_BATCH_SIZE
+        batches += [(name, checked[i:i + size])
+                    for i in range(0, len(checked), size)]
+    prof.count("hook_files_cached", sum(i["cached"] for i in report.values()))
+
+    failures = []
+    max_workers = max_workers or config["hook_workers"]
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(_run_hook_batch, hooks[name]["command"],
+                                   [paths[file] for file in batch]): (name, batch)
+                   for name, batch in batches}
+        for future in as_completed(futures):
+            name, batch = futures[future]
+            returncode, output, elapsed = future.result()
+            report[name]["batches"] += 1
+            report[name]["time"] += elapsed
+            if returncode:
+                failures.append(f"Hook '{name}' failed:\n{output}")
+            else:
+                passed[name].update(hashes[file] for file in batch)
+
+    ut.write_json_file(HOOK_CACHE, {name: {"command": hook["command"],
+                                           "hashes": sorted(passed[name])}
+                                    for name, hook in hooks.items()})
+    if failures:
+        raise exceptions.HookException("".join(failures))
+    return report
+
+
+def _run_hook_batch(command, paths):
+    """Runs hook command with paths relative to repository root, returns
+    exit code, output and time in seconds"""
+    start = time.perf_counter()
+    with prof.span("hooks.run"):
+        try:
+            result = subprocess.run(shlex.split(command) + paths, cwd=CURRENT_DIR,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, text=True)
+            returncode, output = result.returncode, result.stdout
+        except OSError as e:
+            returncode, output = 1, f"{e}\n"
+    return returncode, output, time.perf_counter() - start
+
+
+def _matches_hook_patterns(path, patterns):
+    # Pattern without slash matches file name in any directory
+    return not patterns or any(
+        fnmatch.fnmatch(path if "/" in pattern else path.rsplit("/", 1)[-1], pattern)
+        for pattern in patterns)
+
+
+def _format_hooks_report(report):
+    lines = []
+    for name, info in report.items():
+        lines.append(f"Hook '{name}': {info['files']} file(s) in "
+                     f"{info['batches']} batch(es), {info['cached']} cached, "
+                     f"{info['time']:.2f} s\n")
+    return lines
+
+
+def _get_remotes():
+    _check_repository_existence()
+    if not os.path.exists(REMOTES):
+        return dict()
+    return ut.read_json_file(REMOTES)
+
+
+def _get_remote_path(name):
+    remotes = _get_remotes()
+    if name not in remotes:
+        raise exceptions.RemoteException(f"There is no remote '{name}'")
+    return remotes[name]
+
+
+def _push(remote_name, branch_name=None, console_info=False):
+    """Sends commits of branch, which remote repository lacks,
+    and moves remote branch head. Branch, which is checked out in remote
+    repository, can be moved only, if it has no commits and remote working
+    directory has no files, then the files are written there"""
+    remote_path = _get_remote_path(remote_name)
+    if not branch_name:
+        branch_name = ut.read_json_file(STAGING_AREA)["current_branch"]
+    with _repository_lock(remote_path):
+        with _use_repository(remote_path):
+            remote_branch = ut.read_json_file(STAGING_AREA)["current_branch"]
+            staging_files = _update_staging_area(save=False)["staging_files"]
+            empty = _get_head(remote_branch) is None \
+                and not any(staging_files.values())
+        protected = None if empty else (
+            remote_branch, f"Branch '{remote_branch}' is checked out in "
+                           f"remote repository")
+        report = _transfer(None, remote_path, [branch_name], protected)
+        with _use_repository(remote_path):
+            new_commit = _get_last_commit(remote_branch)
+        if empty and new_commit:
+            # File paths of remote commits are relative to its root
+            cwd = os.getcwd()
+            os.chdir(remote_path)
+            try:
+                with _use_repository(os.curdir):
+                    _update_working_directory(None, new_commit)
+            finally:
+                os.chdir(cwd)
+    if console_info:
+        click.echo(f"Pushed {report['commits']} commit(s) and "
+                   f"{report['files']} file(s) to '{remote_name}'\n")
+    return report
+
+
+@_locked
+def _fetch(remote_name, branch_name=None, console_info=False):
+    """Receives commits of branch (all branches by default), which local
+    repository lacks, and moves local branch heads. Working directory
+    is updated, if the current branch is fetched"""
+    remote_path = _get_remote_path(remote_name)
+    with _use_repository(remote_path):
+        branches = [branch_name] if branch_name else _get_branches()
+    staging_area = _update_staging_area()
+    current_branch = staging_area["current_branch"]
+    staging_files = staging_area["staging_files"]
+    protected = None
+    if (staging_files[FileState.NEW.name] or staging_files[FileState.DELETED.name]
+            or staging_files[FileState.MODIFIED.name]):
+        protected = (current_branch, f"You have uncommited changes. "
+                                     f"Commit them before fetch")
+    old_commit = _get_last_commit(current_branch)
+
+    report = _transfer(remote_path, None, branches, protected)
+    new_commit = _get_last_commit(current_branch)
+    if (new_commit and new_commit["id"]) != (old_commit and old_commit["id"]):
+        _update_working_directory(old_commit, new_commit)
+    if console_info:
+        click.echo(f"Fetched {report['commits']} commit(s) and "
+                   f"{report['files']} file(s) from '{remote_name}'\n")
+    return report
+
+
+def _transfer(source_root, destination_root, branches, protected=None):
+    """Copies commits reachable from branch heads of source repository,
+    which destination lacks, with their stored files as one stream and
+    fast-forwards destination branches. Branches of transferred ancestor
+    commits are fast-forwarded to the newest of them too. Protected is
+    pair of branch, which head must not move, and error message. None
+    root means the current repository. Returns dict with numbers of
+    transferred commits and files"""
+    if source_root is None:
+        source_root = os.path.abspath(CURRENT_DIR)
+    with _use_repository(source_root):
+        _check_repository_existence()
+        source_graph = _load_commit_graph()
+        source_logs = dict()
+        for branch in branches:
+            path = os.path.join(BRANCHES_LOG, f"{branch}.json")
+            if not os.path.exists(path):
+                raise exceptions.RemoteException(f"Branch '{branch}' does not exist")
+            source_logs[branch] = ut.read_json_file(path)
+
+    with _use_repository(destination_root):
+        _check_repository_existence()
+        destination_graph = _load_commit_graph()
+        destination_refs = _load_refs()
+        for branch, branch_log in source_logs.items():
+            if branch not in destination_refs or not branch_log["head"]:
+                continue
+            head = destination_refs[branch]["head"]
+            if head and head not in _get_ancestors(source_graph, branch_log["head"]):
+                raise exceptions.RemoteException(f"Branch '{branch}' has commits, "
+                                                 f"which are not in the other "
+                                                 f"repository")
+
+    missing = [commit_id for branch_log in source_logs.values()
+               if branch_log["head"]
+               for commit_id in _get_ancestors(source_graph, branch_log["head"],
+                                               destination_graph)]
+    missing = sorted(set(missing), key=lambda i: source_graph[i][2])
+    heads = {branch: log["head"] for branch, log in source_logs.items()}
+    newest = {source_graph[commit_id][0]: commit_id for commit_id in missing}
+    for branch, commit_id in newest.items():
+        head = destination_refs[branch]["head"] if branch in destination_refs \
+            else None
+        if branch not in heads and (head is None or head in _get_ancestors(
+                source_graph, commit_id)):
+            heads[branch] = commit_id
+    if protected and heads.get(protected[0]) and (
+            protected[0] not in destination_refs
+            or destination_refs[protected[0]]["head"] != heads[protected[0]]):
+        raise exceptions.RemoteException(protected[1])
+
+    with _use_repository(source_root):
+        commits = []
+        files = dict()
+        hashes = dict()
+        chunks = set()
+        # Notes are not transferred, they are applied to sent commits
+        notes = _load_notes()
+        for commit_id in missing:
+            commit = _apply_notes(_find_commit(commit_id, source_graph), notes)
+            commits.append(_export_commit(commit, source_root))
+            hashes.update((info[0], (info[1], file))
+                          for file, info in commits[-1]["files"].items())
+            for info in commit["files"].values():
+                stored_path = _get_absolute_path(info[0], source_root)
+                files[_get_stored_name(stored_path)] = stored_path
+                if info[0].endswith(CHUNKS_SUFFIX):
+                    chunks.update(i[0] for i in ut.read_json_file(stored_path))
+        chunk_files = {f"chunks/{i}": ut.get_chunk_path(CHUNKS, i) for i in chunks}
+        chunk_files = {name: os.path.abspath(path)
+                       for name, path in chunk_files.items()}
+        bases = {branch: [log["parent_branch"], log["parent_commit_id"]]
+                 for branch, log in source_logs.items()}
+
+    with _use_repository(destination_root):
+        # Files, which destination already has, are not sent
+        bundle_files = [(name, path) for name, path in files.items()
+                        if not os.path.exists(_get_bundle_destination(name))]
+        bundle_files += [(name, path) for name, path in chunk_files.items()
+                         if not os.path.exists(_get_bundle_destination(name))]
+        metadata = {
+            "commits": commits,
+            "heads": heads,
+            "bases": bases
+        }
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def write_bundle():
+            try:
+                with os.fdopen(write_fd, "wb") as f:
+                    ut.write_bundle(f, metadata, bundle_files)
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write_bundle)
+        writer.start()
+        try:
+            with os.fdopen(read_fd, "rb") as f:
+                metadata = ut.read_bundle(f, _get_bundle_destination)
+        finally:
+            writer.join()
+        if errors:
+            raise errors[0]
+        # Paths in remote repository are written relative to its root
+        _apply_bundle(metadata, relative=destination_root is not None,
+                      added=[(_get_stored_hash(path, hashes[name][0]),
+                              os.path.getsize(path), hashes[name][1])
+                             for name, path in bundle_files if name in hashes])
+
+    return {"commits": len(commits), "files": len(bundle_files)}
+
+
+def _apply_bundle(metadata, relative=False, added=()):
+    """Adds commits of bundle to branch logs and moves branch heads.
+    Every branch log is replaced atomically. Added are stored files
+    of bundle for statistics (see _update_stats)"""
+    commits = [_import_commit(commit, relative) for commit in metadata["commits"]]
+    branch_logs = dict()
+    created = set()
+    for branch in {commit["branch"] for commit in commits} | metadata["heads"].keys():
+        path = os.path.join(BRANCHES_LOG, f"{branch}.json")
+        if os.path.exists(path):
+            branch_logs[branch] = ut.read_json_file(path)
+            continue
+        parent_branch, parent_commit_id = metadata["bases"].get(branch, (None, None))
+        _create_branch(branch, parent_branch, parent_commit_id)
+        branch_logs[branch] = ut.read_json_file(path)
+        created.add(branch)
+    heads = dict(metadata["heads"])
+    for commit in commits:
+        branch_logs[commit["branch"]]["commits"][commit["id"]] = commit
+        os.makedirs(os.path.join(BRANCHES, commit["branch"], commit["id"]),
+                    exist_ok=True)
+        if commit["branch"] in created and commit["branch"] not in metadata["heads"]:
+            # New branch, which commits are ancestors of transferred ones,
+            # gets the newest of them as head
+            heads[commit["branch"]] = commit["id"]
+
+    current_branch = ut.read_json_file(STAGING_AREA)["current_branch"]
+    head_files = dict()
+    for branch, head in heads.items():
+        if not head or branch_logs[branch]["head"] == head:
+            continue
+        branch_logs[branch]["head"] = head
+        files = branch_logs[branch]["commits"][head]["files"] \
+            if head in branch_logs[branch]["commits"] \
+            else _find_commit(head)["files"]
+        head_files[branch] = files
+        if branch != current_branch:
+            # Saved staging area of branch must describe its new head
+            _save_staging_area_state(_get_clean_staging_area(branch, files))
+    for branch, branch_log in branch_logs.items():
+        ut.write_json_file_atomic(os.path.join(BRANCHES_LOG, f"{branch}.json"),
+                                  branch_log)
+    _update_refs(branch_logs.values())
+    _add_to_commit_graph(commits)
+    _add_to_path_history(commits, branch_logs)
+    _add_to_stats(commits, added, head_files)
+
+
+def _get_clean_staging_area(branch, files):
+    staging_area = {
+        "current_branch": branch,
+        "staging_files": {state.name: [] for state in FileState}
+    }
+    staging_area["staging_files"][FileState.UNCHANGED.name] = [
+        file for file, info in files.items()
+        if info[2] != FileState.DELETED.name]
+    return staging_area
+
+
+def _update_working_directory(old_commit, new_commit):
+    """Writes files, which differ between commits, to working directory
+    and marks all files of new commit as unchanged"""
+    old_files = old_commit["files"] if old_commit else dict()
+    new_files = new_commit["files"] if new_commit else dict()
+    patterns = _get_sparse_patterns()
+    files_to_restore = dict()
+    for file in old_files.keys() | new_files.keys():
+        old_hash = _get_existing_hash(old_files.get(file))
+        new_hash = _get_existing_hash(new_files.get(file))
+        if old_hash == new_hash or not _matches_patterns(file, patterns):
+            continue
+        if new_hash is None:
+            if os.path.exists(file):
+                os.remove(file)
+        else:
+            files_to_restore[file] = new_files[file]
+    _restore_files(files_to_restore)
+    staging_area = ut.read_json_file(STAGING_AREA)
+    clean_staging_area = _get_clean_staging_area(staging_area["current_branch"],
+                                                 new_files)
+    staging_area["staging_files"] = clean_staging_area["staging_files"]
+    ut.write_json_file(STAGING_AREA, staging_area)
+    _update_staging_area()
+
+
 # endregion
 
 # region Utils
 
+@contextlib.contextmanager
+def _progress_context(callback=None, cancelled=None):
+    """Sets progress callback (stage, done, total) and threading.Event,
+    which cancels operations run by the current thread"""
+    _progress_state.callback = callback
+    _progress_state.cancelled = cancelled
+    try:
+        yield
+    finally:
+        _progress_state.callback = None
+        _progress_state.cancelled = None
+
+
+def _get_progress(stage, cancellable=False):
+    """Returns function (done, total), which passes progress of stage to
+    callback of the current thread and raises CancelledException at
+    cancellable stages, or None if nobody listens"""
+    callback = getattr(_progress_state, "callback", None)
+    cancelled = getattr(_progress_state, "cancelled", None) if cancellable else None
+    if callback is None and cancelled is None:
+        return None
+
+    def progress(done, total):
+        if cancelled is not None and cancelled.is_set():
+            raise exceptions.CancelledException(f"Operation was cancelled")
+        if callback is not None:
+            callback(stage, done, total)
+    return progress
+
+
+def _set_repository(root):
+    """Points all repository paths to repository in root directory.
+    In working tree only its own files and linked directories are
+    taken from root, other paths point to the repository"""
+    global CURRENT_DIR
+    for name, path in REPOSITORY_PATHS.items():
+        globals()[name] = os.path.join(root, path)
+    CURRENT_DIR = os.path.join(root)
+    if os.path.exists(WORKTREE):
+        repository = ut.read_json_file(WORKTREE)["repository"]
+        for name, path in REPOSITORY_PATHS.items():
+            if name not in WORKTREE_PATHS and name not in LINKED_PATHS \
+                    and name != "MAIN_BRANCH":
+                globals()[name] = os.path.join(repository, path)
+
+
+@contextlib.contextmanager
+def _use_repository(root):
+    """Temporarily points repository paths to another repository,
+    None root keeps the current one"""
+    if root is None:
+        yield
+        return
+    saved = {name: globals()[name] for name in [*REPOSITORY_PATHS, "CURRENT_DIR"]}
+    _set_repository(root)
+    try:
+        yield
+    finally:
+        globals().update(saved)
+
+
+def _get_absolute_path(path, root):
+    return path if os.path.isabs(path) else os.path.join(root, path)
+
+
+def _get_stored_file(stored_path):
+    """Returns path of stored file of commit in the current repository.
+    Stored paths are relative to repository root, so repository can be
+    moved, commits of older versions can have absolute ones"""
+    return _get_absolute_path(stored_path, CURRENT_DIR)
+
+
+def _get_stored_name(stored_path):
+    """Returns name of stored file, which doesn't depend on repository
+    location, for example 'objects/main/1715000000000/file.txt'"""
+    relative = os.path.relpath(stored_path, os.path.abspath(BRANCHES))
+    if relative.startswith(".."):
+        # Object of shared store, its name is its hash
+        return SHARED_OBJECTS_NAME + "/".join(Path(stored_path).parts[-2:])
+    return "objects/" + Path(relative).as_posix()
+
+
+def _get_bundle_destination(name):
+    if name.startswith(SHARED_OBJECTS_NAME):
+        # Destination without this object in its shared stores keeps it
+        # in its own directory
+        shared_path = _find_shared_object(name.rsplit("/", 1)[-1])
+        if shared_path:
+            return shared_path
+    kind, relative = name.split("/", 1)
+    if kind == "chunks":
+        path = ut.get_chunk_path(CHUNKS, relative)
+        base = CHUNKS
+    else:
+        path = os.path.join(BRANCHES, *relative.split("/"))
+        base = BRANCHES
+    if os.path.relpath(path, base).startswith(".."):
+        raise exceptions.RemoteException(f"Wrong file name in bundle: '{name}'")
+    return path
+
+
+def _export_commit(commit, root):
+    """Returns copy of commit, which paths are relative to repository"""
+    commit = dict(commit)
+    commit["files"] = {
+        Path(os.path.relpath(_get_absolute_path(file, root), root)).as_posix():
+            [_get_stored_name(_get_absolute_path(info[0], root)), info[1], info[2]]
+        for file, info in commit["files"].items()}
+    return commit
+
+
+def _import_commit(commit, relative=False):
+    """Returns copy of exported commit with paths of current repository.
+    Paths are relative to repository root, if relative is set"""
+    current_dir = "." if relative else CURRENT_DIR
+    branches = REPOSITORY_PATHS["BRANCHES"]
+    alternates = _get_alternates()
+    commit = dict(commit)
+    commit["files"] = {
+        str(Path(current_dir, *file.split("/"))):
+            [(info[0].startswith(SHARED_OBJECTS_NAME)
+              and _find_shared_object(info[1], alternates))
+             or os.path.join(branches, *info[0].split("/")[1:]), info[1], info[2]]
+        for file, info in commit["files"].items()}
+    return commit
+
+
+def _get_ancestors(graph, commit_id, known=None):
+    """Returns ids of commit and its ancestors, which are not in known"""
+    known = known or dict()
+    result = []
+    visited = set()
+    stack = [commit_id]
+    while stack:
+        current = stack.pop()
+        if current in visited or current in known or current not in graph:
+            continue
+        visited.add(current)
+        result.append(current)
+        stack += graph[current][1]
+    return result
+
+
 def _check_repository_existence():
     if not os.path.exists(MAIN_BRANCH):
         raise exceptions.RepositoryException("There is no initialized repository")
@@ -405,40 +2474,182 @@ def _save_staging_area_state(staging_area=None):
     ut.write_json_file(st_area_path, staging_area)
 
 
-def _update_staging_area():
+def _update_staging_area(pathspecs=None, save=True):
+    """Scans working directory and updates states of files. If pathspec
+    patterns are given, only matching files are scanned and hashed.
+    Read-only commands don't save it, so they don't overwrite staging
+    area, which changing command writes under repository lock"""
     staging_area = ut.read_json_file(STAGING_AREA)
     ignore = ut.read_json_file(GITIGNORE)
     staging_files = staging_area["staging_files"]
+    patterns = _get_sparse_patterns()
+
+    # Files outside of sparse checkout are not materialized and files
+    # outside of pathspecs are not requested, so they keep their states
+    # without scanning
+    outside_files = dict()
+    if patterns or pathspecs:
+        states = [FileState.NEW, FileState.UNCHANGED, FileState.MODIFIED]
+        if pathspecs:
+            states.append(FileState.UNTRACKED)
+        for state in states:
+            outside_files[state.name] = [
+                file for file in staging_files[state.name]
+                if not (_matches_patterns(file, patterns)
+                        and _matches_patterns(file, pathspecs))]
 
     added_files = set(staging_files[FileState.NEW.name])
     unchanged_files = set(staging_files[FileState.UNCHANGED.name])
     modified_files = set(staging_files[FileState.MODIFIED.name])
+    for files in outside_files.values():
+        added_files.difference_update(files)
+        unchanged_files.difference_update(files)
+        modified_files.difference_update(files)
     staging_files[FileState.UNTRACKED.name] = []
     staging_files[FileState.NEW.name] = []
     staging_files[FileState.UNCHANGED.name] = []
     staging_files[FileState.MODIFIED.name] = []
 
-    for file in ut.get_files(CURRENT_DIR, ignore):
-        if file in added_files:
-            added_files.remove(file)
-            staging_files[FileState.NEW.name].append(file)
-        elif file in unchanged_files:
-            unchanged_files.remove(file)
-            staging_files[FileState.UNCHANGED.name].append(file)
-        elif file in modified_files:
-            modified_files.remove(file)
-            staging_files[FileState.MODIFIED.name].append(file)
-        else:
-            staging_files[FileState.UNTRACKED.name].append(file)
+    filters = [_get_patterns_filter(p) for p in (patterns, pathspecs) if p]
+    include = (lambda item, is_dir: all(f(item, is_dir) for f in filters)) \
+        if filters else None
+    with prof.span("scan"):
+        for file in ut.get_files(CURRENT_DIR, ignore, include):
+            if file in added_files:
+                added_files.remove(file)
+                staging_files[FileState.NEW.name].append(file)
+            elif file in unchanged_files:
+                unchanged_files.remove(file)
+                staging_files[FileState.UNCHANGED.name].append(file)
+            elif file in modified_files:
+                modified_files.remove(file)
+                staging_files[FileState.MODIFIED.name].append(file)
+            else:
+                staging_files[FileState.UNTRACKED.name].append(file)
 
     for file in unchanged_files.union(modified_files):
         staging_files[FileState.DELETED.name].append(file)
 
     _update_changes(staging_area)
-    ut.write_json_file(STAGING_AREA, staging_area)
+    for state, files in outside_files.items():
+        staging_files[state] += files
+    if save:
+        with _repository_lock():
+            ut.replace_json_file(STAGING_AREA, staging_area)
     return staging_area
 
 
+def _get_sparse_patterns():
+    """Returns list of sparse checkout patterns, empty list means
+    that all files are materialized"""
+    if not os.path.exists(SPARSE_CHECKOUT):
+        return []
+    return ut.read_json_file(SPARSE_CHECKOUT)
+
+
+def _get_pathspec_patterns(pathspecs):
+    """Returns pathspecs as patterns relative to repository root or None,
+    if they cover the whole repository"""
+    if not pathspecs:
+        return None
+    patterns = []
+    for pathspec in pathspecs:
+        path = os.path.relpath(_get_absolute_path(pathspec, CURRENT_DIR),
+                               CURRENT_DIR)
+        if path == ".":
+            return None
+        patterns.append(Path(path).as_posix())
+    return patterns
+
+
+def _relative_parts(path):
+    # Paths of staging area are made by joining CURRENT_DIR, so prefix
+    # is cut without slow relpath in most cases. Relative paths are
+    # relative to repository root, even if CURRENT_DIR is absolute
+    if not os.path.isabs(path):
+        return Path(path).parts
+    prefix = os.path.join(CURRENT_DIR, "")
+    if path.startswith(prefix):
+        return tuple(path[len(prefix):].split(os.sep))
+    return Path(os.path.relpath(path, CURRENT_DIR)).parts
+
+
+def _matches_patterns(file, patterns):
+    """Checks, whether file or one of its directories matches a pattern.
+    Empty or None patterns match every file"""
+    if not patterns:
+        return True
+    parts = _relative_parts(file)
+    relative = "/".join(parts)
+    globs = []
+    for pattern in patterns:
+        if any(c in pattern for c in "*?["):
+            globs.append(pattern)
+        elif relative == pattern or relative.startswith(pattern + "/"):
+            return True
+    for i in range(1, len(parts) + 1):
+        path = "/".join(parts[:i])
+        if any(fnmatch.fnmatchcase(path, p) for p in globs):
+            return True
+    return False
+
+
+def _get_patterns_filter(patterns):
+    """Returns function for utils.get_files, which skips directories
+    without files matching patterns"""
+    pattern_parts = [p.strip("/").split("/") for p in patterns]
+
+    def include(item, is_dir):
+        if _matches_patterns(item, patterns):
+            return True
+        if not is_dir:
+            return False
+        parts = _relative_parts(item)
+        # Directory can contain matching files, if it matches
+        # beginning of a pattern
+        return any(len(p) > len(parts)
+                   and all(fnmatch.fnmatchcase(part, p_part)
+                           for part, p_part in zip(parts, p))
+                   for p in pattern_parts)
+
+    return include
+
+
+@_locked
+def _sparse_checkout(patterns, console_info=False):
+    """Sets sparse checkout patterns, materializes files, which got inside
+    and removes unchanged files, which got outside"""
+    _check_repository_existence()
+    staging_area = _update_staging_area()
+    staging_files = staging_area["staging_files"]
+    if (staging_files[FileState.NEW.name] or staging_files[FileState.DELETED.name]
+            or staging_files[FileState.MODIFIED.name]):
+        raise exceptions.CheckoutException(f"You have uncommited changes. "
+                                           f"Commit them before changing "
+                                           f"sparse checkout")
+    patterns = [p.replace(os.sep, "/").strip("/") for p in patterns]
+    ut.write_json_file(SPARSE_CHECKOUT, patterns)
+
+    last_commit = _get_last_commit(staging_area["current_branch"])
+    files = last_commit["files"] if last_commit else dict()
+    files_to_restore = dict()
+    for file, info in files.items():
+        if info[2] == FileState.DELETED.name:
+            continue
+        if _matches_patterns(file, patterns):
+            if not os.path.exists(file):
+                files_to_restore[file] = info
+        elif os.path.exists(file):
+            os.remove(file)
+    _restore_files(files_to_restore)
+    _update_staging_area()
+    if console_info:
+        if patterns:
+            click.echo(f"Sparse checkout was set to: {', '.join(patterns)}\n")
+        else:
+            click.echo("Sparse checkout was disabled\n")
+
+
 def _update_changes(staging_area=None):
     if not staging_area:
         staging_area = ut.read_json_file(STAGING_AREA)
@@ -450,23 +2661,174 @@ def _update_changes(staging_area=None):
     prev_files = prev_commit["files"]
     new_unchanged_files = set()
     new_modified_files = set()
-
-    for file in staging_files[FileState.UNCHANGED.name]:
-        new_hash = ut.get_file_hash(file)
-        if new_hash != prev_files[file][1]:
-            new_modified_files.add(file)
-        else:
-            new_unchanged_files.add(file)
-
-    for file in staging_files[FileState.MODIFIED.name]:
-        new_hash = ut.get_file_hash(file)
-        if new_hash != prev_files[file][1]:
-            new_modified_files.add(file)
-        else:
-            new_unchanged_files.add(file)
+    index = _read_index()
+    config = _get_config()
+
+    files = staging_files[FileState.UNCHANGED.name] + staging_files[FileState.MODIFIED.name]
+    # Nothing is written before hashing is finished, so it can be cancelled
+    progress = _get_progress("hash", cancellable=True)
+    with prof.span("hash"):
+        for i, file in enumerate(files):
+            if progress:
+                progress(i, len(files))
+            new_hash, _ = _hash_file(file, index, config)
+            if new_hash != prev_files[file][1]:
+                new_modified_files.add(file)
+            else:
+                new_unchanged_files.add(file)
 
     staging_files[FileState.MODIFIED.name] = list(new_modified_files)
     staging_files[FileState.UNCHANGED.name] = list(new_unchanged_files)
+    _write_index(index)
+
+
+def _detect_renames(deleted, added, prev_files, index):
+    """Returns dict of new and old path of files, which were moved.
+    Content of new file is equal to the deleted one or, if
+    rename_similarity option is set, similar enough. Only new files
+    with size of a deleted file are hashed"""
+    renames = dict()
+    deleted = [file for file in deleted if file in prev_files]
+    if not deleted or not added:
+        return renames
+    config = _get_config()
+    old_sizes = dict()
+    by_hash = collections.defaultdict(list)
+    for file in deleted:
+        stored_path = _get_stored_file(prev_files[file][0])
+        if os.path.exists(stored_path):
+            old_sizes[file] = ut.get_stored_size(stored_path,
+                                                 stored_path.endswith(CHUNKS_SUFFIX))
+            by_hash[prev_files[file][1]].append(file)
+
+    sizes = set(old_sizes.values())
+    unmatched = []
+    with prof.span("renames"):
+        for file in sorted(added):
+            if not os.path.exists(file):
+                continue
+            size = os.path.getsize(file)
+            if size in sizes:
+                file_hash, _ = _hash_file(file, index, config)
+                candidates = by_hash.get(file_hash)
+                if candidates:
+                    # File with the same name is preferred for moves
+                    old = next((i for i in candidates
+                                if Path(i).name == Path(file).name), candidates[0])
+                    candidates.remove(old)
+                    renames[file] = old
+                    continue
+            unmatched.append((file, size))
+
+        threshold = config["rename_similarity"]
+        if threshold is None:
+            return renames
+        remaining = [file for file in old_sizes if file not in renames.values()]
+        for file, size in unmatched:
+            best, best_ratio = None, threshold
+            for old in remaining:
+                # Similarity can't reach threshold with too different sizes
+                if min(size, old_sizes[old]) < threshold * max(size, old_sizes[old]):
+                    continue
+                stored_path = _get_stored_file(prev_files[old][0])
+                ratio = ut.get_similarity(file, stored_path, CHUNKS,
+                                          stored_path.endswith(CHUNKS_SUFFIX),
+                                          best_ratio)
+                if ratio >= best_ratio:
+                    best, best_ratio = old, ratio
+            if best:
+                renames[file] = best
+                remaining.remove(best)
+    return renames
+
+
+def _get_config():
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(CONFIG):
+        config.update(ut.read_json_file(CONFIG))
+    return config
+
+
+@_locked
+def _config(key, value=None, console_info=False):
+    """Returns repository option, changes it before if value is given.
+    Value is parsed as JSON, so numbers and null can be passed"""
+    _check_repository_existence()
+    config = _get_config()
+    if key not in config:
+        raise exceptions.ConfigException(f"There is no option '{key}'")
+    if value is not None:
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
+        config[key] = value
+        ut.write_json_file(CONFIG, config)
+        if console_info:
+            click.echo(f"Option '{key}' was changed")
+    return config[key]
+
+
+def _read_index():
+    """Returns dict where key is file path and value is list of
+    four elements (size, modification time, hash, chunks or None)"""
+    if not os.path.exists(INDEX):
+        return dict()
+    return ut.read_json_file(INDEX)
+
+
+def _write_index(index):
+    ut.replace_json_file(INDEX, index)
+
+
+def _hash_file(file, index, config):
+    """Returns file hash and list of its chunks (None for files, which are
+    stored entirely). Result is taken from the index, if file size and
+    modification time were not changed since it was hashed. Chunks are
+    not written, so reading commands don't change the store"""
+    stat = os.stat(file)
+    entry = index.get(file)
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+        return entry[2], entry[3]
+
+    threshold = config["chunk_threshold"]
+    chunks = None
+    if threshold is not None and stat.st_size >= threshold:
+        # Chunks of the previous version let unchanged beginning of file
+        # skip boundary search, it is still hashed
+        file_hash, chunks = ut.hash_chunks(
+            file, config["chunk_min_size"], config["chunk_avg_size"],
+            config["chunk_max_size"], entry[3] if entry else None)
+    else:
+        file_hash = ut.get_file_hash(file)
+
+    if time.time_ns() - stat.st_mtime_ns > INDEX_RACY_NS:
+        index[file] = [stat.st_size, stat.st_mtime_ns, file_hash, chunks]
+    else:
+        index.pop(file, None)
+    return file_hash, chunks
+
+
+def _restore_files(files):
+    """Writes files to their places in working directory. Receives dict
+    where key is file path and value is commit file info"""
+    index = _read_index()
+    files_to_copy = []
+    for file, info in files.items():
+        index.pop(file, None)
+        directory = os.path.dirname(file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        stored_file = _get_stored_file(info[0])
+        if info[0].endswith(CHUNKS_SUFFIX):
+            ut.join_chunks(file, CHUNKS, ut.read_json_file(stored_file))
+        elif not os.path.exists(stored_file) and _find_shared_object(info[1]):
+            # Stored copy was removed after content was moved to shared store
+            files_to_copy.append((_find_shared_object(info[1]), file))
+        else:
+            files_to_copy.append((stored_file, file))
+    ut.copy_files_as(files_to_copy, _get_progress("restore"))
+    _write_index(index)
 
 
 def _create_branch(name, parent_branch, parent_commit_id):
@@ -482,15 +2844,22 @@ def _create_branch(name, parent_branch, parent_commit_id):
     }
     branch_log_path = os.path.join(BRANCHES_LOG, f"{name}.json")
     ut.write_json_file(branch_log_path, branch_log_obj)
+    _update_refs([branch_log_obj])
     os.makedirs(branch_path, exist_ok=True)
+
+    def add_branch(stats):
+        # New branch has files of its parent commit, which is usually
+        # the head of parent branch
+        files = stats["branches"].get(parent_branch, {"files": 0})["files"]
+        stats["branches"][name] = {"commits": 0, "files": files}
+    _update_stats(add_branch)
     with open(staging_area_path, "w"):
         pass
 
 
 def _create_commit(branch_name, commit_id, message, files,
-                   parent_commit_id=None, parent_commit_branch=None):
-    branch_log_path = os.path.join(BRANCHES_LOG, f"{branch_name}.json")
-    branch_log_obj = ut.read_json_file(branch_log_path)
+                   parent_commit_id=None, parent_commit_branch=None,
+                   merge_parent=None, renames=None):
     commit_info_obj = {
         "time": time.ctime(),
         "parent_commit_branch": parent_commit_branch,
@@ -500,9 +2869,28 @@ def _create_commit(branch_name, commit_id, message, files,
         "message": message,
         "files": files
     }
-    branch_log_obj["commits"][commit_id] = commit_info_obj
+    if merge_parent:
+        commit_info_obj["merge_parent_id"] = merge_parent["id"]
+        commit_info_obj["merge_parent_branch"] = merge_parent["branch"]
+    if renames:
+        # New and old paths relative to repository root
+        commit_info_obj["renames"] = renames
+    return _create_commits(branch_name, [commit_info_obj])
+
+
+def _create_commits(branch_name, commits):
+    """Appends commits to branch log in one write, the last one becomes
+    head. Returns path of directory for files of the last commit"""
+    branch_log_path = os.path.join(BRANCHES_LOG, f"{branch_name}.json")
+    branch_log_obj = ut.read_json_file(branch_log_path)
+    for commit_info_obj in commits:
+        branch_log_obj["commits"][commit_info_obj["id"]] = commit_info_obj
+    commit_id = commits[-1]["id"]
     branch_log_obj["head"] = commit_id
     ut.write_json_file(branch_log_path, branch_log_obj)
+    _update_refs([branch_log_obj])
+    _add_to_commit_graph(commits)
+    _add_to_path_history(commits, {branch_name: branch_log_obj})
     commit_path = os.path.join(BRANCHES, branch_name, commit_id)
     os.makedirs(commit_path, exist_ok=True)
     return commit_path
@@ -511,14 +2899,24 @@ def _create_commit(branch_name, commit_id, message, files,
 def _get_commit_files(prev_files, staging_area, commit_id):
     """Returns dict where key is file path in current directory
     and value is list of two elements (file path in repository,
-    file hash, file status) and also it returns list of files, which must be
-    copied"""
+    file hash, file status), list of files, which must be copied,
+    and dict of chunk lists, which must be written for chunked files"""
     commit_files = dict()
     staging_files = staging_area["staging_files"]
     deleted_files = set(staging_files[FileState.DELETED.name])
     modified_files = set(staging_files[FileState.MODIFIED.name])
     added_files = set(staging_files[FileState.NEW.name])
     files_to_copy = modified_files.union(added_files)
+    files_to_store = []
+    manifests = dict()
+    index = _read_index()
+    config = _get_config()
+    alternates = _get_alternates()
+
+    # Files with content of some file of previous commit, for example
+    # moved ones, refer to its stored copy
+    stored_by_hash = {data[1]: data[0] for data in prev_files.values()
+                      if data[2] != FileState.DELETED.name}
 
     if prev_files:
         for file, data in prev_files.items():
@@ -529,14 +2927,32 @@ def _get_commit_files(prev_files, staging_area, commit_id):
             data[2] = FileState.UNCHANGED.name
             commit_files[file] = data
 
-    for file in files_to_copy:
-        file_hash = ut.get_file_hash(file)
-        file_path = os.path.join(BRANCHES, staging_area["current_branch"],
-                                 commit_id, Path(file).name)
-        state = FileState.NEW if file in added_files else FileState.MODIFIED
-        commit_files[file] = [file_path, file_hash, state.name]
-
-    return commit_files, files_to_copy
+    with prof.span("hash"):
+        for file in files_to_copy:
+            file_hash, chunks = _hash_file(file, index, config)
+            file_path = _get_stored_path(staging_area["current_branch"],
+                                         commit_id, file)
+            if file_hash in stored_by_hash:
+                file_path = stored_by_hash[file_hash]
+                prof.count("files_reused")
+            elif chunks is None and _find_shared_object(file_hash, alternates):
+                file_path = _find_shared_object(file_hash, alternates)
+                prof.count("files_shared")
+            elif chunks is None:
+                files_to_store.append(file)
+            else:
+                if not ut.store_chunks(file, CHUNKS, chunks):
+                    # File was changed after its chunks were cached
+                    index.pop(file, None)
+                    file_hash, chunks = _hash_file(file, index, config)
+                    ut.store_chunks(file, CHUNKS, chunks)
+                file_path += CHUNKS_SUFFIX
+                manifests[file_path] = chunks
+            state = FileState.NEW if file in added_files else FileState.MODIFIED
+            commit_files[file] = [file_path, file_hash, state.name]
+
+    _write_index(index)
+    return commit_files, files_to_store, manifests
 
 
 def _try_get_parent_commit(current_branch):
@@ -560,45 +2976,1026 @@ def _try_get_parent_commit(current_branch):
 
 
 def _get_last_commit(current_branch):
-    branch_log_path = os.path.join(BRANCHES_LOG, f"{current_branch}.json")
-    branch_log_obj = ut.read_json_file(branch_log_path)
-    if (branch_log_obj["head"] and
-            branch_log_obj["head"] in branch_log_obj["commits"].keys()):
-        return branch_log_obj["commits"][branch_log_obj["head"]]
-    elif branch_log_obj["parent_branch"] and branch_log_obj["parent_commit_id"]:
-        parent_commit = branch_log_obj["parent_commit_id"]
-        branch_log_path = os.path.join(
-            BRANCHES_LOG,
-            f"{branch_log_obj['parent_branch']}.json"
-        )
-        branch_log_obj = ut.read_json_file(branch_log_path)
-        if parent_commit in branch_log_obj["commits"].keys():
-            return branch_log_obj["commits"][parent_commit]
+    """Returns the last commit of branch as dict. Head is resolved by the
+    ref table, so only the log, which has the commit, is read"""
+    head = _get_head(current_branch)
+    if head is None:
+        return None
+    branch_log_path = os.path.join(BRANCHES_LOG, f"{head[0]}.json")
+    return ut.read_json_file(branch_log_path)["commits"].get(head[1])
+
+
+def _load_notes():
+    """Returns dict where key is commit id and value is dict with fields
+    of commit changed by notes. Later notes override earlier ones"""
+    notes = dict()
+    if not os.path.exists(NOTES):
+        return notes
+    with open(NOTES) as f:
+        for line in f:
+            commit_id, fields = json.loads(line)
+            notes.setdefault(commit_id, dict()).update(fields)
+    return notes
+
+
+def _get_note(notes, commit_id, field, default):
+    return notes.get(commit_id, dict()).get(field, default)
+
+
+def _apply_notes(commit, notes):
+    """Returns copy of commit dict with fields changed by its notes"""
+    fields = notes.get(commit["id"])
+    return {**commit, **fields} if fields else commit
+
+
+def _add_note(commit_id, fields):
+    """Appends note to notes log, so branch logs and indexes
+    built from them stay valid"""
+    with open(NOTES, "a") as f:
+        start = f.tell()
+        f.write(json.dumps([commit_id, fields]) + "\n")
+        end = f.tell()
+    # Log is checked once per NOTES_COMPACTION_SIZE appended bytes,
+    # so the cost of check is spread over many notes
+    if end // NOTES_COMPACTION_SIZE > start // NOTES_COMPACTION_SIZE:
+        _compact_notes()
+
+
+def _compact_notes(force=False):
+    """Rewrites notes log with one line per commit and drops notes
+    of removed commits. Without force log is rewritten only, if most
+    of its lines are overridden by later ones"""
+    if not os.path.exists(NOTES):
+        return
+    with open(NOTES) as f:
+        lines_number = sum(1 for _ in f)
+    notes = _load_notes()
+    if not force and lines_number < 2 * len(notes):
+        return
+    graph = _load_commit_graph()
+    ut.write_lines_atomic(NOTES, [json.dumps([commit_id, fields]) + "\n"
+                                  for commit_id, fields in notes.items()
+                                  if commit_id in graph])
+
+
+def _load_refs():
+    """Returns ref table: dict where key is branch name and value is dict
+    with head, parent branch, parent commit id and archived flag. Table is
+    built from branch logs, if it doesn't exist"""
+    if not os.path.exists(REFS):
+        return _rebuild_refs()
+    return _read_refs()
+
+
+def _read_refs():
+    """Returns packed ref table with updates of ref updates log applied"""
+    refs = ut.read_json_file(REFS) if os.path.exists(REFS) else dict()
+    if not os.path.exists(REF_UPDATES):
+        return refs
+    with open(REF_UPDATES) as f:
+        for line in f:
+            name, fields = json.loads(line)
+            if fields is None:
+                refs.pop(name, None)
+            else:
+                refs.setdefault(name, {"archived": False}).update(fields)
+    return refs
+
+
+def _write_refs(refs):
+    """Writes packed ref table, which includes all updates"""
+    ut.write_json_file_atomic(REFS, refs)
+    if os.path.exists(REF_UPDATES):
+        os.remove(REF_UPDATES)
+
+
+def _rebuild_refs():
+    refs = dict()
+    for file in Path(BRANCHES_LOG).iterdir():
+        branch_log = ut.read_json_file(file)
+        refs[branch_log["branch"]] = dict(_get_ref_fields(branch_log),
+                                          archived=False)
+    _write_refs(refs)
+    return refs
+
+
+def _update_refs(branch_logs):
+    """Writes heads and parents of branch logs to ref table"""
+    if not os.path.exists(REFS):
+        _rebuild_refs()
+        return
+    _add_ref_updates([(branch_log["branch"], _get_ref_fields(branch_log))
+                      for branch_log in branch_logs])
+
+
+def _add_ref_updates(updates):
+    """Appends pairs of branch and changed fields of its ref (None removes
+    ref) to ref updates log, so the ref table isn't rewritten, until log
+    grows"""
+    with open(REF_UPDATES, "a") as f:
+        f.writelines(json.dumps([name, fields]) + "\n" for name, fields in updates)
+        size = f.tell()
+    if size > REF_UPDATES_COMPACTION_SIZE:
+        _write_refs(_read_refs())
+
+
+def _get_ref_fields(branch_log):
+    return {"head": branch_log["head"],
+            "parent_branch": branch_log["parent_branch"],
+            "parent_commit_id": branch_log["parent_commit_id"]}
+
+
+def _get_head(branch):
+    """Returns branch, which log has the last commit of branch, and id
+    of this commit, which are taken from the ref table. It is base commit
+    of branch without own commits. Returns None, if there are no commits"""
+    refs = _load_refs()
+    if branch not in refs:
+        raise FileNotFoundError(f"Branch '{branch}' does not exist")
+    ref = refs[branch]
+    if ref["head"]:
+        return branch, ref["head"]
+    if ref["parent_branch"] and ref["parent_commit_id"]:
+        return ref["parent_branch"], ref["parent_commit_id"]
+    return None
+
+
+def _get_commit_parents(commit):
+    parents = []
+    if commit["parent_commit_id"]:
+        parents.append(commit["parent_commit_id"])
+    if commit.get("merge_parent_id"):
+        parents.append(commit["merge_parent_id"])
+    return parents
+
+
+def _rebuild_commit_graph(branch_logs=None):
+    """Writes commit graph from branch logs and returns it"""
+    if branch_logs is None:
+        branch_logs = [ut.read_json_file(file)
+                       for file in Path(BRANCHES_LOG).iterdir()]
+    graph = _build_commit_graph(branch_logs)
+    _write_commit_graph(graph)
+    return graph
+
+
+def _write_commit_graph(graph):
+    with open(COMMIT_GRAPH, "w") as f:
+        for commit_id, (branch, parents, generation) in graph.items():
+            f.write(json.dumps([commit_id, branch, parents, generation]) + "\n")
+    _write_commit_ids(graph)
+
+
+def _build_commit_graph(branch_logs):
+    """Returns commit graph of branch logs, see _load_commit_graph"""
+    commits = {commit_id: commit for branch_log in branch_logs
+               for commit_id, commit in branch_log["commits"].items()}
+    graph = dict()
+    for commit_id in commits:
+        stack = [commit_id]
+        while stack:
+            current = stack[-1]
+            if current in graph:
+                stack.pop()
+                continue
+            parents = [i for i in _get_commit_parents(commits[current])
+                       if i in commits]
+            missing = [i for i in parents if i not in graph]
+            if missing:
+                stack += missing
+                continue
+            generation = 1 + max((graph[i][2] for i in parents), default=0)
+            graph[current] = [commits[current]["branch"], parents, generation]
+            stack.pop()
+    return graph
+
+
+def _load_commit_graph():
+    """Returns dict where key is commit id and value is list of three
+    elements (branch, parent commit ids, generation number). Generation
+    of commit is greater than generations of all its ancestors"""
+    if not os.path.exists(COMMIT_GRAPH):
+        return _rebuild_commit_graph()
+    graph = dict()
+    with prof.span("graph.read"), open(COMMIT_GRAPH) as f:
+        for line in f:
+            commit_id, branch, parents, generation = json.loads(line)
+            graph[commit_id] = [branch, parents, generation]
+    return graph
+
+
+def _add_to_commit_graph(commits):
+    if not os.path.exists(COMMIT_GRAPH):
+        _rebuild_commit_graph()
+        return
+    graph = _load_commit_graph()
+    lines = []
+    for commit in commits:
+        parents = [i for i in _get_commit_parents(commit) if i in graph]
+        generation = 1 + max((graph[i][2] for i in parents), default=0)
+        graph[commit["id"]] = [commit["branch"], parents, generation]
+        lines.append(json.dumps([commit["id"], commit["branch"],
+                                 parents, generation]) + "\n")
+    with open(COMMIT_GRAPH, "a") as f:
+        f.writelines(lines)
+    _add_to_commit_ids([commit["id"] for commit in commits], graph)
+
+
+def _get_path_history_bucket(path):
+    """Returns file of path history, which contains relative path"""
+    name = hashlib.sha256(path.encode()).hexdigest()[:PATH_HISTORY_BUCKET_DIGITS]
+    return os.path.join(PATH_HISTORY, f"{name}.jsonl")
+
+
+def _get_changed_paths(files, parent_files):
+    """Returns dict of relative path and hash (None for deleted files)
+    of files, which hashes differ from parent commit"""
+    new = {path: info[1] for path, info in _get_commit_tree({"files": files}).items()}
+    old = {path: info[1]
+           for path, info in _get_commit_tree({"files": parent_files}).items()}
+    return {path: new.get(path) for path in old.keys() | new.keys()
+            if old.get(path) != new.get(path)}
+
+
+def _get_path_history_lines(commit, parent_files):
+    """Returns list of (bucket, line) for paths changed by commit. Line of
+    renamed file has its old path as the fourth element"""
+    renames = commit.get("renames", dict())
+    lines = []
+    for path, file_hash in sorted(_get_changed_paths(commit["files"],
+                                                     parent_files).items()):
+        entry = [path, commit["id"], file_hash]
+        if path in renames:
+            entry.append(renames[path])
+        lines.append((_get_path_history_bucket(path), json.dumps(entry) + "\n"))
+    return lines
+
+
+def _add_to_path_history(commits, branch_logs):
+    """Appends paths changed by commits to path history. Branch logs
+    dict must contain commits, other parents are read from disk"""
+    if not os.path.exists(PATH_HISTORY):
+        _rebuild_path_history()
+        return
+    graph = None
+    buckets = collections.defaultdict(list)
+    for commit in commits:
+        parent_files = dict()
+        parent_id = commit["parent_commit_id"]
+        parent_log = branch_logs.get(commit["parent_commit_branch"])
+        if parent_log and parent_id in parent_log["commits"]:
+            parent_files = parent_log["commits"][parent_id]["files"]
+        elif parent_id:
+            graph = graph or _load_commit_graph()
+            if parent_id in graph:
+                parent_files = _find_commit(parent_id, graph)["files"]
+        for bucket, line in _get_path_history_lines(commit, parent_files):
+            buckets[bucket].append(line)
+    with prof.span("path_history.write"):
+        for bucket, lines in buckets.items():
+            with open(bucket, "a") as f:
+                f.writelines(lines)
+
+
+def _rebuild_path_history(branch_logs=None):
+    """Writes path history of all commits from branch logs"""
+    if branch_logs is None:
+        branch_logs = [ut.read_json_file(file)
+                       for file in Path(BRANCHES_LOG).iterdir()]
+    commits = {commit_id: commit for branch_log in branch_logs
+               for commit_id, commit in branch_log["commits"].items()}
+    graph = _build_commit_graph(branch_logs)
+    buckets = collections.defaultdict(list)
+    # Parents are written before children
+    for commit_id in sorted(graph, key=lambda i: graph[i][2]):
+        commit = commits[commit_id]
+        parent = commits.get(commit["parent_commit_id"])
+        for bucket, line in _get_path_history_lines(
+                commit, parent["files"] if parent else dict()):
+            buckets[bucket].append(line)
+    os.makedirs(PATH_HISTORY, exist_ok=True)
+    for name in os.listdir(PATH_HISTORY):
+        os.remove(os.path.join(PATH_HISTORY, name))
+    for bucket, lines in buckets.items():
+        with open(bucket, "w") as f:
+            f.writelines(lines)
+
+
+def _get_path_history(path, graph=None, follow=True):
+    """Returns list of (commit id, hash, path) from the oldest commit,
+    which changed file with path relative to repository root. Hash is
+    None, if commit deleted file. History of old path is included
+    for renamed file, if follow is set"""
+    if not os.path.exists(PATH_HISTORY):
+        _rebuild_path_history()
+    if graph is None:
+        graph = _load_commit_graph()
+    history = []
+    visited = set()
+    generation = None
+    while path not in visited:
+        visited.add(path)
+        renamed_from = None
+        for commit_id, file_hash, old_path in _read_path_history(path, graph):
+            if generation is not None and graph[commit_id][2] >= generation:
+                continue
+            history.append((commit_id, file_hash, path))
+            if old_path:
+                renamed_from = (old_path, graph[commit_id][2])
+        if not (follow and renamed_from):
+            break
+        # Older history is taken from the last rename of path
+        path, generation = renamed_from
+    return sorted(history, key=lambda entry: graph[entry[0]][2])
+
+
+def _read_path_history(path, graph):
+    """Yields (commit id, hash, old path or None) of path history lines"""
+    bucket = _get_path_history_bucket(path)
+    if not os.path.exists(bucket):
+        return
+    with prof.span("path_history.read"), open(bucket) as f:
+        for line in f:
+            entry = json.loads(line)
+            # Commits removed by gc or with branch are skipped
+            if entry[0] == path and entry[1] in graph:
+                yield entry[1], entry[2], entry[3] if len(entry) > 3 else None
+
+
+def _get_stats_bucket(file_hash):
+    return os.path.join(STATS_CONTENTS,
+                        f"{file_hash[:STATS_BUCKET_DIGITS]}.json")
+
+
+def _get_stored_hash(path, file_hash=None):
+    """Returns hash, which identifies stored file in statistics. It is
+    hash from commit, if it is known, except for chunk lists, which are
+    identified by their own content"""
+    if file_hash is None or path.endswith(CHUNKS_SUFFIX):
+        return ut.get_file_hash(path)
+    return file_hash
+
+
+def _get_tracked_number(files):
+    return sum(info[2] != FileState.DELETED.name for info in files.values())
+
+
+def _update_stats(change=None, added=(), removed=()):
+    """Applies change function to statistics and counts added and removed
+    stored files, which are tuples (hash, size, path). Only buckets of
+    their hashes are read. Missing statistics are recomputed instead,
+    so they already include the change"""
+    if not os.path.exists(STATS):
+        _recompute_stats()
+        return
+    stats = ut.read_json_file(STATS)
+    if change:
+        change(stats)
+    if added or removed:
+        _change_stored_stats(stats, added, removed)
+    ut.write_json_file_atomic(STATS, stats)
+
+
+def _add_to_stats(commits, added=(), head_files=None):
+    """Counts new commits and added stored files. Branches get number of
+    files of their heads, which are given by dict of branch and files
+    of head or are the last new commits of branches by default"""
+    if head_files is None:
+        head_files = {commit["branch"]: commit["files"] for commit in commits}
+
+    def add_commits(stats):
+        for commit in commits:
+            stats["branches"].setdefault(
+                commit["branch"], {"commits": 0, "files": 0})["commits"] += 1
+        for name, files in head_files.items():
+            stats["branches"].setdefault(
+                name, {"commits": 0, "files": 0})["files"] = \
+                _get_tracked_number(files)
+    _update_stats(add_commits, added)
+
+
+def _change_stored_stats(stats, added, removed):
+    buckets = dict()
+
+    def get_bucket(file_hash):
+        path = _get_stats_bucket(file_hash)
+        if path not in buckets:
+            buckets[path] = ut.read_json_file(path) \
+                if os.path.exists(path) else dict()
+        return buckets[path]
+
+    largest = {entry[1]: entry for entry in stats["largest"]}
+    for file_hash, size, path in added:
+        stats["stored_files"] += 1
+        stats["stored_bytes"] += size
+        bucket = get_bucket(file_hash)
+        if file_hash in bucket:
+            bucket[file_hash][1] += 1
+            continue
+        bucket[file_hash] = [size, 1, path]
+        stats["unique_contents"] += 1
+        stats["unique_bytes"] += size
+        largest[file_hash] = [size, file_hash, path]
+    refill = False
+    for file_hash, size, path in removed:
+        stats["stored_files"] -= 1
+        stats["stored_bytes"] -= size
+        bucket = get_bucket(file_hash)
+        if file_hash not in bucket:
+            continue
+        bucket[file_hash][1] -= 1
+        if bucket[file_hash][1] > 0:
+            continue
+        stats["unique_contents"] -= 1
+        stats["unique_bytes"] -= bucket.pop(file_hash)[0]
+        refill |= largest.pop(file_hash, None) is not None
+
+    os.makedirs(STATS_CONTENTS, exist_ok=True)
+    for path, bucket in buckets.items():
+        ut.write_json_file(path, bucket)
+    if refill:
+        # Only gc removes contents, so all buckets are read rarely
+        largest = {file_hash: [entry[0], file_hash, entry[2]]
+                   for path in Path(STATS_CONTENTS).iterdir()
+                   for file_hash, entry in ut.read_json_file(path).items()}
+    stats["largest"] = heapq.nlargest(STATS_LARGEST, largest.values())
+
+
+def _get_branch_stats(log_path, root):
+    """Returns branch name, head, parent commit id, dict of commit ids with
+    numbers of tracked files and dict of absolute stored paths with hashes
+    and file paths. Runs in worker process"""
+    branch_log = ut.read_json_file(log_path)
+    counts = dict()
+    stored = dict()
+    for commit_id, commit in branch_log["commits"].items():
+        counts[commit_id] = _get_tracked_number(commit["files"])
+        for file, info in commit["files"].items():
+            stored.setdefault(os.path.abspath(_get_absolute_path(info[0], root)),
+                              (info[1], file))
+    return (branch_log["branch"], branch_log["head"],
+            branch_log["parent_commit_id"], counts, stored)
+
+
+@_locked
+def _recompute_stats(max_workers=None):
+    """Rebuilds statistics. Branch logs are read and stored files, which
+    hashes are not known from them, are hashed in process pool"""
+    log_paths = [str(file) for file in Path(BRANCHES_LOG).iterdir()]
+    with prof.span("stats.logs"):
+        if len(log_paths) < STATS_POOL_THRESHOLD:
+            results = list(map(_get_branch_stats, log_paths, repeat(CURRENT_DIR)))
+        else:
+            with ProcessPoolExecutor(max_workers) as executor:
+                results = list(executor.map(_get_branch_stats, log_paths,
+                                            repeat(CURRENT_DIR)))
+    counts = dict()
+    known = dict()
+    for _, _, _, branch_counts, stored in results:
+        counts.update(branch_counts)
+        known.update(stored)
+    branches = dict()
+    for name, head, parent_commit_id, branch_counts, _ in results:
+        # Branch without commits has files of its parent commit
+        files = counts.get(head or parent_commit_id, 0)
+        branches[name] = {"commits": len(branch_counts), "files": files}
+
+    paths = list(_get_stored_files())
+    unknown = [path for path in paths
+               if os.path.abspath(path) not in known or path.endswith(CHUNKS_SUFFIX)]
+    with prof.span("stats.hash"):
+        if len(unknown) < STATS_POOL_THRESHOLD:
+            hashes = list(map(_get_stored_hash, unknown))
+        else:
+            with ProcessPoolExecutor(max_workers) as executor:
+                hashes = list(executor.map(_get_stored_hash, unknown,
+                                           chunksize=16))
+    hashes = dict(zip(unknown, hashes))
+
+    stats = {"branches": branches, "stored_files": 0, "stored_bytes": 0,
+             "unique_contents": 0, "unique_bytes": 0, "largest": []}
+    contents = dict()
+    for path in paths:
+        size = os.path.getsize(path)
+        # Files of deleted branches are named by stored path until gc
+        file_hash, file = known.get(os.path.abspath(path), (None, path))
+        file_hash = hashes.get(path, file_hash)
+        stats["stored_files"] += 1
+        stats["stored_bytes"] += size
+        if file_hash in contents:
+            contents[file_hash][1] += 1
+        else:
+            contents[file_hash] = [size, 1, file]
+    stats["unique_contents"] = len(contents)
+    stats["unique_bytes"] = sum(entry[0] for entry in contents.values())
+    stats["largest"] = heapq.nlargest(
+        STATS_LARGEST, ([entry[0], file_hash, entry[2]]
+                        for file_hash, entry in contents.items()))
+
+    buckets = collections.defaultdict(dict)
+    for file_hash, entry in contents.items():
+        buckets[_get_stats_bucket(file_hash)][file_hash] = entry
+    if os.path.exists(STATS_CONTENTS):
+        shutil.rmtree(STATS_CONTENTS)
+    os.makedirs(STATS_CONTENTS)
+    for path, bucket in buckets.items():
+        ut.write_json_file(path, bucket)
+    ut.write_json_file_atomic(STATS, stats)
+
+
+def _generate_commit_id(fields, taken_ids=None):
+    """Returns sha1 of commit fields (parents, branch, message, changes)
+    with creation time in nanoseconds. Stored paths contain commit id,
+    so content of files is presented by their paths. If id is taken,
+    counter is added"""
+    data = json.dumps([fields, time.time_ns(), os.getpid()])
+    counter = 0
+    while True:
+        commit_id = hashlib.sha1(f"{data}{counter}".encode()).hexdigest()
+        if taken_ids is not None and commit_id not in taken_ids:
+            return commit_id
+        if taken_ids is None and not _find_commit_ids(commit_id):
+            return commit_id
+        counter += 1
+
+
+class _SortedCommitIds:
+    """Sorted part of id index as sequence for bisect, only requested
+    records are read"""
+
+    def __init__(self, f):
+        self.f = f
+        self.length = os.fstat(f.fileno()).st_size // (COMMIT_ID_WIDTH + 1)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        self.f.seek(i * (COMMIT_ID_WIDTH + 1))
+        return self.f.read(COMMIT_ID_WIDTH).rstrip()
+
+
+def _find_commit_ids(prefix):
+    """Returns list of commit ids, which start with prefix. Sorted part
+    of id index is searched by bisection and new ids are scanned"""
+    if not os.path.exists(COMMIT_IDS):
+        _write_commit_ids(_load_commit_graph())
+    found = []
+    with prof.span("ids.find"), open(COMMIT_IDS) as f:
+        ids = _SortedCommitIds(f)
+        i = bisect.bisect_left(ids, prefix)
+        while i < len(ids) and ids[i].startswith(prefix):
+            found.append(ids[i])
+            i += 1
+    if os.path.exists(NEW_COMMIT_IDS):
+        with open(NEW_COMMIT_IDS) as f:
+            found += [line.strip() for line in f if line.startswith(prefix)]
+    return found
+
+
+def _resolve_commit_id(prefix):
+    """Returns full id of commit by its id or unique abbreviated id"""
+    if len(prefix) >= MIN_COMMIT_PREFIX:
+        found = _find_commit_ids(prefix)
+        if len(found) > 1 and prefix not in found:
+            raise exceptions.RevisionException(f"Commit id '{prefix}' is ambiguous: "
+                                               f"{', '.join(sorted(found))}")
+        if found:
+            return prefix if prefix in found else found[0]
+    raise FileNotFoundError(f"There is no commit with id '{prefix}'")
+
+
+def _write_commit_ids(graph):
+    """Writes sorted part of id index with all commits of graph"""
+    ut.write_lines_atomic(COMMIT_IDS, [f"{commit_id:<{COMMIT_ID_WIDTH}}\n"
+                                       for commit_id in sorted(graph)])
+    if os.path.exists(NEW_COMMIT_IDS):
+        os.remove(NEW_COMMIT_IDS)
+
+
+def _add_to_commit_ids(commit_ids, graph):
+    """Appends ids to unsorted part of id index, it is merged into
+    sorted part, when it grows"""
+    if not os.path.exists(COMMIT_IDS):
+        _write_commit_ids(graph)
+        return
+    with open(NEW_COMMIT_IDS, "a") as f:
+        f.writelines(f"{commit_id}\n" for commit_id in commit_ids)
+        added = f.tell() // (COMMIT_ID_WIDTH + 1)
+    if added > NEW_COMMIT_IDS_LIMIT:
+        _write_commit_ids(graph)
+
+
+def _resolve_commit_range(spec, graph):
+    """Returns list of commit ids from the oldest one. Spec is commit id
+    or range 'A..B' of commits, which are first parent ancestors of B
+    up to A exclusively"""
+    if ".." not in spec:
+        return [_resolve_commit_id(spec)]
+    start, end = map(_resolve_commit_id, spec.split("..", 1))
+    result = []
+    commit_id = end
+    while commit_id != start:
+        result.append(commit_id)
+        parents = graph[commit_id][1]
+        if not parents:
+            raise exceptions.CherryPickException(f"Commit '{start}' is not "
+                                                 f"an ancestor of '{end}'")
+        commit_id = parents[0]
+    return result[::-1]
+
+
+def _get_merge_base(graph, first_id, second_id):
+    """Returns the nearest common ancestor of two commits or None.
+    Commits are visited in order of decreasing generation, so the first
+    commit reachable from both sides is the nearest one"""
+    flags = {first_id: 1}
+    flags[second_id] = flags.get(second_id, 0) | 2
+    queue = [(-graph[i][2], i) for i in flags]
+    heapq.heapify(queue)
+    visited = set()
+    while queue:
+        _, commit_id = heapq.heappop(queue)
+        if commit_id in visited:
+            continue
+        visited.add(commit_id)
+        if flags[commit_id] == 3:
+            return commit_id
+        for parent in graph[commit_id][1]:
+            flags[parent] = flags.get(parent, 0) | flags[commit_id]
+            heapq.heappush(queue, (-graph[parent][2], parent))
     return None
 
 
+def _find_commit(commit_id, graph=None):
+    """Returns commit info using commit graph to find its branch"""
+    if graph is None:
+        graph = _load_commit_graph()
+    if commit_id not in graph:
+        raise FileNotFoundError(f"There is no commit with id '{commit_id}'")
+    branch_log_path = os.path.join(BRANCHES_LOG, f"{graph[commit_id][0]}.json")
+    return ut.read_json_file(branch_log_path)["commits"][commit_id]
+
+
+def _resolve_revision(revision, graph=None):
+    """Returns commit by id or the last commit of branch"""
+    if graph is None:
+        graph = _load_commit_graph()
+    if revision in graph:
+        return _find_commit(revision, graph)
+    if os.path.exists(os.path.join(BRANCHES_LOG, f"{revision}.json")):
+        commit = _get_last_commit(revision)
+        if commit is None:
+            raise FileNotFoundError(f"Branch '{revision}' has no commits")
+        return commit
+    try:
+        return _find_commit(_resolve_commit_id(revision), graph)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"There is no commit or branch '{revision}'")
+
+
+def _get_commit_tree(commit):
+    """Returns existing files of commit by paths relative to repository
+    root with '/' separators"""
+    return {"/".join(_relative_parts(file)): info
+            for file, info in commit["files"].items()
+            if info[2] != FileState.DELETED.name}
+
+
+def _get_existing_hash(info):
+    """Returns hash of commit file info or None for deleted files"""
+    if not info or info[2] == FileState.DELETED.name:
+        return None
+    return info[1]
+
+
+def _read_stored_file(info):
+    stored_file = _get_stored_file(info[0])
+    if info[0].endswith(CHUNKS_SUFFIX):
+        content = b""
+        for chunk_hash, _ in ut.read_json_file(stored_file):
+            with open(ut.get_chunk_path(CHUNKS, chunk_hash), "rb") as f:
+                content += f.read()
+        return content
+    with open(stored_file, "rb") as f:
+        return f.read()
+
+
+def _merge_file_versions(base, ours, theirs, ours_name, theirs_name):
+    """Returns merged content and flag of conflicts or None,
+    if files are binary"""
+    versions = []
+    for info in (base, ours, theirs):
+        try:
+            text = _read_stored_file(info).decode() if info else ""
+        except UnicodeDecodeError:
+            return None
+        versions.append(text.splitlines(keepends=True))
+    lines, conflict = ut.merge_lines(*versions, ours_name, theirs_name)
+    return "".join(lines).encode(), conflict
+
+
+def _fsck_error(error_type, message, **details):
+    return {"type": error_type, "message": message, **details}
+
+
+def _check_branch_logs(branch_logs):
+    """Returns errors of branch heads, commit ids and parent links"""
+    errors = []
+
+    def has_commit(branch, commit_id):
+        return branch in branch_logs and commit_id in branch_logs[branch]["commits"]
+
+    for name in branch_logs:
+        if not os.path.isdir(os.path.join(BRANCHES, name)):
+            errors.append(_fsck_error("branch_mismatch", "Branch has no "
+                                                         "directory", branch=name))
+    refs = _read_refs()
+    for name in refs.keys() | branch_logs.keys():
+        branch_log = branch_logs.get(name)
+        if (name not in refs or not branch_log
+                or refs[name]["head"] != branch_log["head"]
+                or refs[name]["parent_commit_id"] != branch_log["parent_commit_id"]):
+            errors.append(_fsck_error("ref_mismatch", "Ref table differs from "
+                                                      "branch log", branch=name))
+    for name, branch_log in branch_logs.items():
+        if branch_log["head"] and branch_log["head"] not in branch_log["commits"]:
+            errors.append(_fsck_error("bad_head", "Head commit doesn't exist",
+                                      branch=name, commit=branch_log["head"]))
+        if (branch_log["parent_commit_id"] and not has_commit(
+                branch_log["parent_branch"], branch_log["parent_commit_id"])):
+            errors.append(_fsck_error("missing_parent", "Branch base commit "
+                                                        "doesn't exist",
+                                      branch=name,
+                                      commit=branch_log["parent_commit_id"]))
+        for commit_id, commit in branch_log["commits"].items():
+            if commit["id"] != commit_id or commit["branch"] != name:
+                errors.append(_fsck_error("bad_commit", "Commit id or branch "
+                                                        "doesn't match its log",
+                                          branch=name, commit=commit_id))
+            parents = [(commit["parent_commit_branch"], commit["parent_commit_id"])]
+            if commit.get("merge_parent_id"):
+                parents.append((commit["merge_parent_branch"],
+                                commit["merge_parent_id"]))
+            for parent_branch, parent_id in parents:
+                if parent_id and not has_commit(parent_branch, parent_id):
+                    errors.append(_fsck_error(
+                        "missing_parent", f"Parent commit '{parent_id}' "
+                                          f"doesn't exist",
+                        branch=name, commit=commit_id))
+    return errors
+
+
+def _check_commit_graph(branch_logs):
+    """Returns errors of commit graph file compared with branch logs"""
+    if not os.path.exists(COMMIT_GRAPH):
+        return [_fsck_error("graph_mismatch", "Commit graph file is missing")]
+    stored = dict()
+    with open(COMMIT_GRAPH) as f:
+        for line in f:
+            commit_id, branch, parents, generation = json.loads(line)
+            stored[commit_id] = [branch, parents, generation]
+    expected = _build_commit_graph(branch_logs.values())
+    errors = []
+    for commit_id in expected.keys() | stored.keys():
+        if commit_id not in stored:
+            errors.append(_fsck_error("graph_mismatch", "Commit is missing "
+                                                        "in commit graph",
+                                      commit=commit_id))
+        elif commit_id not in expected:
+            errors.append(_fsck_error("graph_mismatch", "Commit graph has "
+                                                        "unknown commit",
+                                      commit=commit_id))
+        elif stored[commit_id][:2] != expected[commit_id][:2]:
+            errors.append(_fsck_error("graph_mismatch", "Branch or parents "
+                                                        "differ from commit",
+                                      commit=commit_id))
+        elif any(stored[commit_id][2] <= stored[i][2]
+                 for i in stored[commit_id][1] if i in stored):
+            errors.append(_fsck_error("graph_mismatch", "Generation is not "
+                                                        "greater than "
+                                                        "generations of parents",
+                                      commit=commit_id))
+    if os.path.exists(COMMIT_IDS):
+        indexed = _find_commit_ids("")
+        with open(COMMIT_IDS) as f:
+            ids = [line.rstrip() for line in f]
+        if sorted(indexed) != sorted(expected) or ids != sorted(ids):
+            errors.append(_fsck_error("id_index", "Commit id index differs "
+                                                  "from branch logs"))
+    return errors
+
+
+def _check_staging_area(branch_logs):
+    """Returns errors of staging area compared with the last commit
+    of the current branch. Working directory is not scanned"""
+    staging_area = ut.read_json_file(STAGING_AREA)
+    current_branch = staging_area["current_branch"]
+    if current_branch not in branch_logs:
+        return [_fsck_error("staging_area", "Current branch doesn't exist",
+                            branch=current_branch)]
+    errors = []
+    # Branch logs are checked, not the ref table, which can differ from them
+    branch_log = branch_logs[current_branch]
+    commit_id = branch_log["head"]
+    if not commit_id:
+        commit_id = branch_log["parent_commit_id"]
+        branch_log = branch_logs.get(branch_log["parent_branch"], {"commits": {}})
+    last_commit = branch_log["commits"].get(commit_id)
+    committed = {file for file, info in (last_commit or {"files": {}})["files"].items()
+                 if info[2] != FileState.DELETED.name}
+    staging_files = staging_area["staging_files"]
+    for state in (FileState.UNCHANGED, FileState.MODIFIED, FileState.DELETED):
+        for file in staging_files[state.name]:
+            if file not in committed:
+                errors.append(_fsck_error("staging_area", f"{state.name} file "
+                                                          f"isn't commited",
+                                          path=file))
+    for file in staging_files[FileState.NEW.name]:
+        if file in committed:
+            errors.append(_fsck_error("staging_area", "NEW file is already "
+                                                      "commited", path=file))
+    merge = staging_area.get("merge")
+    if merge and not any(merge["id"] in i["commits"] for i in branch_logs.values()):
+        errors.append(_fsck_error("staging_area", "Merged commit doesn't exist",
+                                  commit=merge["id"]))
+    return errors
+
+
+def _check_objects(objects, quick):
+    """Checks stored files, which are given by dict of path and
+    (hash, commit id), and chunks of chunked files. Returns errors
+    and number of checked chunks"""
+    errors = []
+    chunks = dict()
+    plain_files = []
+    for path, (file_hash, commit_id) in objects.items():
+        if not os.path.exists(path):
+            errors.append(_fsck_error("missing_object", "Stored file is missing",
+                                      path=path, commit=commit_id))
+        elif not path.endswith(CHUNKS_SUFFIX):
+            plain_files.append(path)
+            continue
+        else:
+            try:
+                manifest = ut.read_json_file(path)
+                chunks.update((chunk_hash, size) for chunk_hash, size in manifest)
+            except (ValueError, TypeError):
+                errors.append(_fsck_error("bad_manifest", "List of chunks "
+                                                          "can't be read",
+                                          path=path, commit=commit_id))
+
+    chunk_paths = dict()
+    for chunk_hash, size in chunks.items():
+        path = ut.get_chunk_path(CHUNKS, chunk_hash)
+        if not os.path.exists(path):
+            errors.append(_fsck_error("missing_chunk", "Chunk is missing",
+                                      path=path))
+        elif os.path.getsize(path) != size:
+            errors.append(_fsck_error("chunk_size_mismatch", "Chunk size "
+                                                             "differs from list",
+                                      path=path))
+        else:
+            chunk_paths[path] = chunk_hash
+    if quick:
+        return errors, len(chunks)
+
+    expected = {path: objects[path][0] for path in plain_files}
+    expected.update(chunk_paths)
+    paths = list(expected)
+    with prof.span("fsck.hash"):
+        if len(paths) < FSCK_POOL_THRESHOLD:
+            hashes = list(map(ut.try_get_file_hash, paths))
+        else:
+            with ProcessPoolExecutor() as executor:
+                hashes = list(executor.map(ut.try_get_file_hash, paths,
+                                           chunksize=16))
+    for path, actual in zip(paths, hashes):
+        if actual == expected[path]:
+            continue
+        if path in chunk_paths:
+            errors.append(_fsck_error("chunk_hash_mismatch", "Content doesn't "
+                                                             "match hash",
+                                      path=path))
+        else:
+            errors.append(_fsck_error("hash_mismatch", "Content doesn't "
+                                                       "match hash",
+                                      path=path, commit=objects[path][1]))
+    return errors, len(chunks)
+
+
+def _get_branch_chain(branch_log):
+    """Returns ids of own commits of branch from head to the oldest one"""
+    chain = []
+    commits = branch_log["commits"]
+    commit_id = branch_log["head"]
+    while commit_id in commits:
+        chain.append(commit_id)
+        if commits[commit_id]["parent_commit_branch"] != branch_log["branch"]:
+            break
+        commit_id = commits[commit_id]["parent_commit_id"]
+    return chain
+
+
+def _get_retained_commits(branch_logs, keep_last=None, keep_since=None):
+    """Returns set of commit ids, which are kept by retention. Commits,
+    which other branches are based on, are kept with all newer commits"""
+    chains = {name: _get_branch_chain(log) for name, log in branch_logs.items()}
+    cuts = dict()
+    for name, chain in chains.items():
+        if keep_last is None and keep_since is None:
+            cuts[name] = len(chain)
+            continue
+        cut = 1
+        for i, commit_id in enumerate(chain):
+            commit = branch_logs[name]["commits"][commit_id]
+            if ((keep_last is not None and i < keep_last)
+                    or (keep_since is not None
+                        and time.mktime(time.strptime(commit["time"]))
+                        >= keep_since.timestamp())):
+                cut = i + 1
+        cuts[name] = min(cut, len(chain))
+
+    changed = True
+    while changed:
+        changed = False
+        for name, chain in chains.items():
+            if chain and cuts[name] < len(chain):
+                continue
+            if chain:
+                oldest = branch_logs[name]["commits"][chain[-1]]
+                base_branch = oldest["parent_commit_branch"]
+                base_id = oldest["parent_commit_id"]
+            else:
+                base_branch = branch_logs[name]["parent_branch"]
+                base_id = branch_logs[name]["parent_commit_id"]
+            if base_branch not in chains or base_id not in chains[base_branch]:
+                continue
+            position = chains[base_branch].index(base_id) + 1
+            if position > cuts[base_branch]:
+                cuts[base_branch] = position
+                changed = True
+
+    return {commit_id for name, chain in chains.items()
+            for commit_id in chain[:cuts[name]]}
+
+
+def _get_stored_path(branch, commit_id, file):
+    """Returns path of stored copy of file relative to repository root.
+    It keeps directories of file, so files with the same name don't clash"""
+    return os.path.join(REPOSITORY_PATHS["BRANCHES"], branch, commit_id,
+                        *_relative_parts(file))
+
+
+def _get_stored_files():
+    """Yields paths of files stored in commit directories"""
+    for branch_dir in Path(BRANCHES).iterdir():
+        if not branch_dir.is_dir():
+            continue
+        for commit_dir in branch_dir.iterdir():
+            if commit_dir.is_dir():
+                for directory, _, files in os.walk(commit_dir):
+                    for file in files:
+                        yield os.path.join(directory, file)
+
+
+def _remove_empty_directory(directory):
+    if not any(Path(directory).iterdir()):
+        os.rmdir(directory)
+
+
+def _remove_empty_directories(path):
+    """Removes empty directories of stored file up to its commit directory"""
+    directory = os.path.dirname(path)
+    while (len(Path(os.path.relpath(directory, BRANCHES)).parts) > 1
+           and not any(Path(directory).iterdir())):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+
 def _get_branches() -> list:
-    return [i for i in os.listdir(BRANCHES) if i[0] != '.']
+    return [name for name, ref in _load_refs().items() if not ref["archived"]]
 
 
 def _get_commits(branch) -> list[tuple[str, str, str]] | None:
-    _update_staging_area()
+    _update_staging_area(save=False)
+    notes = _load_notes()
     log_list = []
     log_path = Path(BRANCHES_LOG)
     path = os.path.join(BRANCHES_LOG, f'{branch}.json')
-    branch_log_obj = ut.read_json_file(path)
+    branch_log_obj = records.read_branch_log(path)
     dummy = branch_log_obj['head']
     if not dummy:
         return
     commits = branch_log_obj["commits"]
     while True:
-        date = time.strptime(commits[dummy]["time"])
+        date = time.strptime(commits[dummy].time)
         str_date = f"{date.tm_mon:0>2}.{date.tm_mday:0>2}.{date.tm_year}"
-        message = commits[dummy]["message"]
+        message = _get_note(notes, dummy, "message", commits[dummy].message)
         log_list.append((dummy, str_date, message))
-        if commits[dummy]["parent_commit_branch"] != Path(path).stem:
+        if commits[dummy].parent_commit_branch != Path(path).stem:
             break
-        dummy = commits[dummy]["parent_commit_id"]
+        dummy = commits[dummy].parent_commit_id
     return log_list
 
 
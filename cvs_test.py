@@ -1,11 +1,23 @@
+import asyncio
+import io
+import json
 import os
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
 import time
+import zipfile
 
 import utils as ut
 import pytest
 from pathlib import Path
+import async_api
 import cvs
 import exceptions
+import profiler as prof
+import records
 
 
 class InitDirs:
@@ -13,19 +25,7 @@ class InitDirs:
     def test_setup(self, tmp_path):
         temp = tmp_path
         print(temp)
-        cvs.MAIN_BRANCH = os.path.join(temp, '.cvs/branches/main')
-        cvs.BRANCHES = os.path.join(temp, '.cvs/branches')
-        cvs.BRANCHES_LOG = os.path.join(temp, '.cvs/branches_log')
-        cvs.STAGING_AREA = os.path.join(temp, '.cvs/staging_area.json')
-        cvs.GITIGNORE = os.path.join(temp, '.cvs/cvsignore.json')
-        cvs.CURRENT_DIR = os.path.join(temp)
-
-        # cvs.MAIN_BRANCH = f"{temp}/.cvs/branches/main"
-        # cvs.BRANCHES = f"{temp}/.cvs/branches"
-        # cvs.BRANCHES_LOG = f"{temp}/.cvs/branches_log"
-        # cvs.STAGING_AREA = f"{temp}/.cvs/staging_area.json"
-        # cvs.GITIGNORE = f"{temp}/.cvs/cvsignore.json"
-        # cvs.CURRENT_DIR = f"{temp}"
+        cvs._set_repository(os.path.join(temp))
         print(cvs.CURRENT_DIR)
 
 
@@ -302,9 +302,46 @@ class TestUpdateMessageCommand(InitDirs):
         cvs._change_commit_message(commit_id, 'new_message', console_info=True)
         captured = capsys.readouterr()
         current_branch = ut.read_json_file(os.path.join(cvs.BRANCHES_LOG, 'main.json'))
-        assert current_branch['commits'][commit_id]['message'] == 'new_message'
+        assert current_branch['commits'][commit_id]['message'] == 'commit1'
+        assert cvs._get_commits('main')[0][2] == 'new_message'
+        assert f"{commit_id} 'new_message'" in "".join(cvs._log())
         assert "Commit message was changed" in captured.out
 
+    def test_compact_notes(self, monkeypatch):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        open(path1, 'a')
+        cvs._add([path1])
+        cvs._commit('commit1')
+        commit_id = cvs._get_commits('main')[0][0]
+        monkeypatch.setattr(cvs, 'NOTES_COMPACTION_SIZE', 200)
+        for i in range(10):
+            cvs._change_commit_message(commit_id, f'message{i}')
+        with open(cvs.NOTES) as f:
+            assert len(f.readlines()) < 10
+        assert cvs._get_commits('main')[0][2] == 'message9'
+
+        cvs._add_note('removed_commit', {"message": "message"})
+        cvs._gc()
+        assert cvs._load_notes() == {commit_id: {"message": "message9"}}
+
+    def test_update_message_reads_little(self, monkeypatch):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        open(path1, 'a')
+        cvs._add([path1])
+        cvs._commit('commit1')
+        commit_id = cvs._get_commits('main')[0][0]
+        checks = []
+        monkeypatch.setattr(cvs, 'NOTES_COMPACTION_SIZE', 200)
+        monkeypatch.setattr(cvs, '_compact_notes', lambda: checks.append(1))
+        monkeypatch.setattr(cvs, '_update_staging_area', None)
+        for i in range(20):
+            cvs._change_commit_message(commit_id[:8], f'message{i}')
+        # Every note is about 70 bytes, log is checked after 200 bytes
+        assert 4 <= len(checks) <= 8
+        assert cvs._load_notes()[commit_id] == {"message": "message19"}
+
     def test_update_non_existing_commit(self):
         cvs._init()
         with pytest.raises(FileNotFoundError):
@@ -363,3 +400,1673 @@ class TestCherryPickCommand(InitDirs):
         cvs._commit('commit2')
         cvs._cherry_pick(commit_id1)
         assert os.path.exists(path2)
+
+
+class TestProfiler(InitDirs):
+    def test_disabled_profiler_collects_nothing(self):
+        cvs._init()
+        open(os.path.join(cvs.CURRENT_DIR, 'test1.txt'), 'a')
+        cvs._add(['.'])
+        assert not prof.get_counters()
+        assert not prof.get_spans()
+
+    def test_profile_commit(self, tmp_path):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        with open(path1, 'w') as f:
+            f.write("test string")
+        cvs._add([path1])
+        prof.enable()
+        try:
+            cvs._commit('commit1')
+        finally:
+            prof.disable()
+        counters = prof.get_counters()
+        spans = prof.get_spans()
+        assert counters["files_scanned"] == 1
+        assert counters["bytes_hashed"] == len("test string")
+        assert counters["bytes_copied"] == len("test string")
+        assert counters["json_bytes_written"] > 0
+        assert {"scan", "hash", "copy", "json.read", "json.write"} <= spans.keys()
+
+        trace_path = os.path.join(tmp_path, 'trace.json')
+        prof.write_trace(trace_path)
+        events = ut.read_json_file(trace_path)["traceEvents"]
+        assert any(e["name"] == "copy" and e["ph"] == "X" for e in events)
+        assert any(e["ph"] == "C" for e in events)
+        prof.reset()
+
+
+class TestChunkedStorage(InitDirs):
+    @staticmethod
+    def count_chunks():
+        return sum(len(files) for _, _, files in os.walk(cvs.CHUNKS))
+
+    def test_chunked_commit_and_checkout(self):
+        cvs._init()
+        cvs._config('chunk_threshold', '1')
+        cvs._config('chunk_min_size', '64')
+        cvs._config('chunk_avg_size', '256')
+        cvs._config('chunk_max_size', '1024')
+        path1 = os.path.join(cvs.CURRENT_DIR, 'data.bin')
+        data1 = os.urandom(20000)
+        data2 = data1[:10000] + b"changed" + data1[10000:]
+        with open(path1, 'wb') as f:
+            f.write(data1)
+        cvs._add([path1])
+        cvs._commit('commit1')
+        chunks_count = self.count_chunks()
+        assert chunks_count > 10
+
+        cvs._branch('second_branch')
+        with open(path1, 'wb') as f:
+            f.write(data2)
+        cvs._commit('commit2')
+        assert self.count_chunks() - chunks_count <= 3
+        last_commit = cvs._get_last_commit('second_branch')
+        assert last_commit["files"][path1][0].endswith(cvs.CHUNKS_SUFFIX)
+        assert last_commit["files"][path1][1] == ut.get_file_hash(path1)
+
+        cvs._checkout('main')
+        with open(path1, 'rb') as f:
+            assert f.read() == data1
+        cvs._checkout('second_branch')
+        with open(path1, 'rb') as f:
+            assert f.read() == data2
+
+    def test_appended_file_reuses_chunks(self):
+        path1 = os.path.join(cvs.CURRENT_DIR, 'data.bin')
+        data1 = os.urandom(20000)
+        with open(path1, 'wb') as f:
+            f.write(data1)
+        file_hash1, chunks1 = ut.hash_chunks(path1, 64, 256, 1024)
+        assert file_hash1 == ut.get_file_hash(path1)
+        with open(path1, 'ab') as f:
+            f.write(b"appended")
+        prof.enable()
+        try:
+            file_hash2, chunks2 = ut.hash_chunks(path1, 64, 256, 1024, chunks1)
+        finally:
+            prof.disable()
+        assert prof.get_counters()["chunks_reused"] == len(chunks1) - 1
+        assert file_hash2 == ut.get_file_hash(path1)
+        assert chunks2[:-1] == chunks1[:-1]
+        assert ut.hash_chunks(path1, 64, 256, 1024) == (file_hash2, chunks2)
+
+    def test_unknown_option(self):
+        cvs._init()
+        with pytest.raises(exceptions.ConfigException):
+            cvs._config('unknown', '1')
+
+
+class TestIndex(InitDirs):
+    def test_unchanged_files_are_not_rehashed(self):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        with open(path1, 'w') as f:
+            f.write("test string")
+        os.utime(path1, (time.time() - 60, time.time() - 60))
+        cvs._add([path1])
+        cvs._commit('commit1')
+        prof.enable()
+        try:
+            cvs._update_staging_area()
+        finally:
+            prof.disable()
+        assert "files_hashed" not in prof.get_counters()
+
+        with open(path1, 'w') as f:
+            f.write("new string")
+        staging_area = cvs._update_staging_area()
+        assert path1 in staging_area["staging_files"][cvs.FileState.MODIFIED.name]
+
+    def test_checkout_restores_subdirectories(self):
+        cvs._init()
+        os.makedirs(os.path.join(cvs.CURRENT_DIR, 'sub'))
+        path1 = os.path.join(cvs.CURRENT_DIR, 'sub', 'test1.txt')
+        path2 = os.path.join(cvs.CURRENT_DIR, 'test2.txt')
+        open(path1, 'a')
+        cvs._add([path1])
+        cvs._commit('commit1')
+        cvs._branch('second_branch')
+        open(path2, 'a')
+        cvs._add([path2])
+        cvs._commit('commit2')
+        cvs._checkout('main')
+        assert os.path.exists(path1)
+        assert not os.path.exists(path2)
+
+
+class TestSparseCheckout(InitDirs):
+    @staticmethod
+    def create_tree():
+        cvs._init()
+        for directory in ('src', 'docs'):
+            os.makedirs(os.path.join(cvs.CURRENT_DIR, directory))
+        paths = [os.path.join(cvs.CURRENT_DIR, 'src', 'main.txt'),
+                 os.path.join(cvs.CURRENT_DIR, 'docs', 'guide.txt'),
+                 os.path.join(cvs.CURRENT_DIR, 'root.txt')]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write(path)
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        return paths
+
+    def test_sparse_checkout(self, capsys):
+        src, docs, root = self.create_tree()
+        cvs._sparse_checkout(['src'], console_info=True)
+        captured = capsys.readouterr()
+        assert "Sparse checkout was set to: src" in captured.out
+        assert os.path.exists(src)
+        assert not os.path.exists(docs)
+        assert not os.path.exists(root)
+        staging_files = cvs._update_staging_area()["staging_files"]
+        assert not staging_files[cvs.FileState.DELETED.name]
+        assert {src, docs, root} == set(staging_files[cvs.FileState.UNCHANGED.name])
+
+        cvs._sparse_checkout([])
+        assert os.path.exists(docs)
+        assert os.path.exists(root)
+
+    def test_checkout_materializes_only_sparse_files(self):
+        src, docs, root = self.create_tree()
+        cvs._branch('second_branch')
+        with open(src, 'w') as f:
+            f.write("changed")
+        cvs._commit('commit2')
+        cvs._sparse_checkout(['src/*.txt'])
+        cvs._checkout('main')
+        assert os.path.exists(src)
+        assert not os.path.exists(docs)
+        with open(src) as f:
+            assert f.read() == src
+
+    def test_sparse_checkout_with_uncommited_changes(self):
+        src, docs, root = self.create_tree()
+        with open(src, 'w') as f:
+            f.write("changed")
+        with pytest.raises(exceptions.CheckoutException):
+            cvs._sparse_checkout(['docs'])
+
+
+class TestGarbageCollection(InitDirs):
+    @staticmethod
+    def commit_versions(path, count):
+        for i in range(count):
+            with open(path, 'w') as f:
+                f.write(f"version {i} {time.time()}")
+            cvs._add(['.'])
+            cvs._commit(f'commit{i}')
+            time.sleep(0.002)
+
+    def test_gc_without_retention_keeps_everything(self):
+        cvs._init()
+        self.commit_versions(os.path.join(cvs.CURRENT_DIR, 'test1.txt'), 3)
+        report = cvs._gc()
+        assert report["commits"] == 0
+        assert report["files"] == 0
+
+    def test_gc_keep_last(self, capsys):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        self.commit_versions(path1, 3)
+        report = cvs._gc(keep_last=1, dry_run=True, console_info=True)
+        captured = capsys.readouterr()
+        assert report["commits"] == 2
+        assert report["files"] == 2
+        assert "Would remove 2 commit(s), 2 file(s)" in captured.out
+        assert len(ut.read_json_file(os.path.join(cvs.BRANCHES_LOG, 'main.json'))["commits"]) == 3
+
+        cvs._gc(keep_last=1)
+        branch_log = ut.read_json_file(os.path.join(cvs.BRANCHES_LOG, 'main.json'))
+        assert len(branch_log["commits"]) == 1
+        assert branch_log["commits"][branch_log["head"]]["parent_commit_id"] is None
+        assert len(list(cvs._get_stored_files())) == 1
+        assert len(cvs._log()) == 3
+
+    def test_gc_keeps_branch_base(self):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        self.commit_versions(path1, 1)
+        base_id = cvs._get_last_commit('main')["id"]
+        cvs._branch('second_branch')
+        self.commit_versions(os.path.join(cvs.CURRENT_DIR, 'test2.txt'), 1)
+        cvs._checkout('main')
+        self.commit_versions(path1, 2)
+        cvs._gc(keep_last=1)
+        branch_log = ut.read_json_file(os.path.join(cvs.BRANCHES_LOG, 'main.json'))
+        assert base_id in branch_log["commits"]
+        cvs._checkout('second_branch')
+        assert os.path.exists(os.path.join(cvs.CURRENT_DIR, 'test2.txt'))
+
+    def test_gc_truncated_branches_pass_fsck(self):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        self.commit_versions(path1, 2)
+        for name in ['side', 'feat']:
+            cvs._branch(name)
+            self.commit_versions(os.path.join(cvs.CURRENT_DIR, f'{name}.txt'), 2)
+            cvs._checkout('main')
+            self.commit_versions(path1, 1)
+        cvs._gc(keep_last=1)
+        assert cvs._fsck()["errors"] == []
+        for name in ['side', 'feat']:
+            assert cvs._load_refs()[name]["parent_commit_id"] is None
+            cvs._checkout(name)
+            assert os.path.exists(os.path.join(cvs.CURRENT_DIR, f'{name}.txt'))
+
+    def test_gc_time_budget(self):
+        cvs._init()
+        self.commit_versions(os.path.join(cvs.CURRENT_DIR, 'test1.txt'), 3)
+        report = cvs._gc(keep_last=1, time_budget=1e-9)
+        assert not report["complete"]
+        cvs._gc(keep_last=1)
+        assert len(list(cvs._get_stored_files())) == 1
+
+
+class TestMergeCommand(InitDirs):
+    @staticmethod
+    def write(path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    @staticmethod
+    def read(path):
+        with open(path) as f:
+            return f.read()
+
+    def prepare(self):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        path2 = os.path.join(cvs.CURRENT_DIR, 'test2.txt')
+        self.write(path1, "line1\nline2\nline3\n")
+        self.write(path2, "text")
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        cvs._branch('second_branch')
+        return path1, path2
+
+    def test_merge(self, capsys):
+        path1, path2 = self.prepare()
+        path3 = os.path.join(cvs.CURRENT_DIR, 'test3.txt')
+        self.write(path1, "changed1\nline2\nline3\n")
+        self.write(path3, "new file")
+        cvs._add([path3])
+        cvs._commit('commit2')
+        theirs_id = cvs._get_last_commit('second_branch')["id"]
+        cvs._checkout('main')
+        self.write(path1, "line1\nline2\nchanged3\n")
+        os.remove(path2)
+        cvs._commit('commit3')
+
+        cvs._merge('second_branch', console_info=True)
+        captured = capsys.readouterr()
+        assert "Branch 'second_branch' was merged into 'main'" in captured.out
+        assert self.read(path1) == "changed1\nline2\nchanged3\n"
+        assert self.read(path3) == "new file"
+        assert not os.path.exists(path2)
+        last_commit = cvs._get_last_commit('main')
+        assert last_commit["merge_parent_id"] == theirs_id
+        assert path2 not in last_commit["files"]
+        assert last_commit["files"][path1][1] == ut.get_file_hash(path1)
+        staging_files = cvs._update_staging_area()["staging_files"]
+        assert not staging_files[cvs.FileState.MODIFIED.name]
+        assert not staging_files[cvs.FileState.UNTRACKED.name]
+
+        cvs._checkout('second_branch')
+        cvs._checkout('main')
+        assert self.read(path1) == "changed1\nline2\nchanged3\n"
+
+    def test_merge_conflict(self):
+        path1, path2 = self.prepare()
+        self.write(path1, "theirs\nline2\nline3\n")
+        cvs._commit('commit2')
+        cvs._checkout('main')
+        self.write(path1, "ours\nline2\nline3\n")
+        cvs._commit('commit3')
+        with pytest.raises(exceptions.MergeException):
+            cvs._merge('second_branch')
+        assert self.read(path1) == ("<<<<<<< main\nours\n=======\ntheirs\n"
+                                    ">>>>>>> second_branch\nline2\nline3\n")
+        self.write(path1, "resolved\nline2\nline3\n")
+        cvs._commit('merge')
+        last_commit = cvs._get_last_commit('main')
+        assert last_commit["merge_parent_branch"] == 'second_branch'
+
+    def test_merge_already_merged(self):
+        self.prepare()
+        with pytest.raises(exceptions.MergeException):
+            cvs._merge('main')
+
+    def test_merge_base(self):
+        path1, path2 = self.prepare()
+        self.write(path2, "second")
+        cvs._commit('commit2')
+        base_id = cvs._get_last_commit('second_branch')["id"]
+        cvs._branch('third_branch')
+        self.write(path2, "third")
+        cvs._commit('commit3')
+        cvs._checkout('second_branch')
+        self.write(path1, "second")
+        cvs._commit('commit4')
+        graph = cvs._load_commit_graph()
+        ours = cvs._get_last_commit('second_branch')["id"]
+        theirs = cvs._get_last_commit('third_branch')["id"]
+        assert cvs._get_merge_base(graph, ours, theirs) == base_id
+        assert graph[ours][2] == 3
+        os.remove(cvs.COMMIT_GRAPH)
+        assert cvs._load_commit_graph() == graph
+
+
+class TestCherryPickRange(InitDirs):
+    def prepare(self):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        path2 = os.path.join(cvs.CURRENT_DIR, 'test2.txt')
+        with open(path1, 'w') as f:
+            f.write("version1")
+        cvs._add([path1])
+        cvs._commit('commit1')
+        cvs._branch('second_branch')
+        ids = []
+        for i, (path, text) in enumerate([(path1, "version2"), (path2, "new"),
+                                          (path1, "version3")]):
+            with open(path, 'w') as f:
+                f.write(text)
+            cvs._add(['.'])
+            cvs._commit(f'picked{i}')
+            ids.append(cvs._get_last_commit('second_branch')["id"])
+        cvs._checkout('main')
+        return path1, path2, ids
+
+    def test_cherry_pick_range(self):
+        path1, path2, ids = self.prepare()
+        cvs._cherry_pick(f'{ids[0]}..{ids[2]}')
+        with open(path1) as f:
+            assert f.read() == "version3"
+        assert os.path.exists(path2)
+        branch_log = ut.read_json_file(os.path.join(cvs.BRANCHES_LOG, 'main.json'))
+        assert len(branch_log["commits"]) == 3
+        messages = [commit[2] for commit in cvs._get_commits('main')]
+        assert messages == ['picked2', 'picked1', 'commit1']
+        staging_files = cvs._update_staging_area()["staging_files"]
+        assert not staging_files[cvs.FileState.MODIFIED.name]
+
+    def test_cherry_pick_list(self):
+        path1, path2, ids = self.prepare()
+        cvs._cherry_pick([ids[0], ids[2]])
+        with open(path1) as f:
+            assert f.read() == "version3"
+        assert not os.path.exists(path2)
+        assert len(cvs._get_commits('main')) == 3
+
+    def test_cherry_pick_wrong_range(self):
+        path1, path2, ids = self.prepare()
+        with pytest.raises(exceptions.CherryPickException):
+            cvs._cherry_pick(f'{ids[2]}..{ids[0]}')
+
+
+class TestDiffCommand(InitDirs):
+    def prepare(self):
+        cvs._init()
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        path2 = os.path.join(cvs.CURRENT_DIR, 'test2.txt')
+        with open(path1, 'w') as f:
+            f.write("".join(f"line{i}\n" for i in range(20)))
+        with open(path2, 'w') as f:
+            f.write("unchanged\n")
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        with open(path1, 'w') as f:
+            f.write("".join(f"line{i}\n" if i != 10 else "changed\n"
+                            for i in range(20)))
+        return path1, path2
+
+    def test_diff_working_directory(self):
+        self.prepare()
+        assert cvs._diff() == ["--- a/test1.txt\n", "+++ b/test1.txt\n",
+                               "@@ -8,7 +8,7 @@\n",
+                               " line7\n", " line8\n", " line9\n",
+                               "-line10\n", "+changed\n",
+                               " line11\n", " line12\n", " line13\n"]
+
+    def test_diff_name_only_and_stat(self):
+        path1, path2 = self.prepare()
+        path3 = os.path.join(cvs.CURRENT_DIR, 'test3.txt')
+        with open(path3, 'w') as f:
+            f.write("new\n")
+        cvs._add([path3])
+        os.remove(path2)
+        assert cvs._diff(mode='name-only') == ["test1.txt\n", "test2.txt\n",
+                                               "test3.txt\n"]
+        assert cvs._diff(mode='stat') == [" test1.txt | M | +1 bytes\n",
+                                          " test2.txt | D | -10 bytes\n",
+                                          " test3.txt | A | +4 bytes\n",
+                                          " 3 file(s) changed\n"]
+
+    def test_diff_commits(self, monkeypatch):
+        path1, path2 = self.prepare()
+        cvs._commit('commit2')
+        commits = cvs._get_commits('main')
+        monkeypatch.setattr(cvs, 'DIFF_POOL_THRESHOLD', 1)
+        lines = cvs._diff(commits[1][0], commits[0][0])
+        assert "-line10\n" in lines
+        assert "+changed\n" in lines
+        assert not cvs._diff(commits[0][0], commits[0][0])
+
+    def test_diff_chunked_file(self):
+        cvs._init()
+        cvs._config('chunk_threshold', '1')
+        cvs._config('chunk_min_size', '16')
+        cvs._config('chunk_avg_size', '64')
+        cvs._config('chunk_max_size', '256')
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        with open(path1, 'w') as f:
+            f.write("".join(f"line{i}\n" for i in range(500)))
+        cvs._add([path1])
+        cvs._commit('commit1')
+        with open(path1, 'w') as f:
+            f.write("".join(f"line{i}\n" for i in range(500) if i != 250))
+        cvs._commit('commit2')
+        commits = cvs._get_commits('main')
+        lines = cvs._diff(commits[1][0], commits[0][0])
+        assert "@@ -248,7 +248,6 @@\n" in lines
+        assert "-line250\n" in lines
+
+
+class TestArchiveCommand(InitDirs):
+    def prepare(self):
+        cvs._init()
+        os.mkdir(os.path.join(cvs.CURRENT_DIR, 'sub'))
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        path2 = os.path.join(cvs.CURRENT_DIR, 'sub', 'test2.txt')
+        with open(path1, 'w') as f:
+            f.write('text1')
+        with open(path2, 'w') as f:
+            f.write('text2')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        return path1, path2
+
+    def test_archive_tar(self):
+        path1, path2 = self.prepare()
+        commit_id = cvs._get_commits('main')[0][0]
+        with open(path1, 'w') as f:
+            f.write('changed')
+        os.remove(path2)
+        output = os.path.join(cvs.CURRENT_DIR, 'out.tar.gz')
+        assert cvs._archive(commit_id, output) == 2
+        with tarfile.open(output) as tar:
+            assert sorted(tar.getnames()) == ['sub/test2.txt', 'test1.txt']
+            assert tar.extractfile('sub/test2.txt').read() == b'text2'
+        # Working directory is not restored
+        with open(path1) as f:
+            assert f.read() == 'changed'
+        assert not os.path.exists(path2)
+
+    def test_failed_archive_is_removed(self, monkeypatch):
+        self.prepare()
+        output = os.path.join(cvs.CURRENT_DIR, 'out.tar')
+
+        def fail(*args):
+            raise OSError("No space left on device")
+        monkeypatch.setattr(ut, 'write_archive', fail)
+        with pytest.raises(OSError):
+            cvs._archive('main', output)
+        assert not os.path.exists(output)
+        assert not os.path.exists(f"{output}.tmp")
+
+    def test_archive_zip_of_branch(self):
+        self.prepare()
+        cvs._config('chunk_threshold', '1')
+        cvs._config('chunk_min_size', '16')
+        cvs._config('chunk_avg_size', '64')
+        cvs._config('chunk_max_size', '256')
+        content = "".join(f"line{i}\n" for i in range(300))
+        with open(os.path.join(cvs.CURRENT_DIR, 'test1.txt'), 'w') as f:
+            f.write(content)
+        cvs._add(['.'])
+        cvs._commit('commit2')
+        output = io.BytesIO()
+        assert cvs._archive('main', output, 'zip') == 2
+        with zipfile.ZipFile(output) as archive:
+            assert archive.read('test1.txt') == content.encode()
+        with pytest.raises(FileNotFoundError):
+            cvs._archive('unknown', io.BytesIO())
+
+    def test_show(self):
+        self.prepare()
+        commit_id = cvs._get_commits('main')[0][0]
+        output = io.BytesIO()
+        cvs._show(commit_id, 'sub/test2.txt', output)
+        assert output.getvalue() == b'text2'
+        with pytest.raises(FileNotFoundError):
+            cvs._show('main', 'missing.txt', io.BytesIO())
+
+
+class TestPathspecs(InitDirs):
+    def prepare(self):
+        cvs._init()
+        paths = dict()
+        for name in ('src/a.py', 'src/b.txt', 'docs/c.txt', 'd.txt'):
+            paths[name] = os.path.join(cvs.CURRENT_DIR, *name.split('/'))
+            os.makedirs(os.path.dirname(paths[name]), exist_ok=True)
+            with open(paths[name], 'w') as f:
+                f.write(name)
+        return paths
+
+    def test_add_directory_and_glob(self):
+        paths = self.prepare()
+        cvs._add([os.path.join(cvs.CURRENT_DIR, 'src')])
+        cvs._add([os.path.join(cvs.CURRENT_DIR, '*', 'c.txt')])
+        staging_files = ut.read_json_file(cvs.STAGING_AREA)["staging_files"]
+        assert sorted(staging_files["NEW"]) == sorted(
+            [paths['src/a.py'], paths['src/b.txt'], paths['docs/c.txt']])
+        # Files outside of pathspecs were not scanned
+        assert paths['d.txt'] not in staging_files["UNTRACKED"]
+        with pytest.raises(exceptions.AddException):
+            cvs._add([os.path.join(cvs.CURRENT_DIR, 'src')])
+
+    def test_only_requested_files_are_scanned(self):
+        paths = self.prepare()
+        prof.enable()
+        try:
+            cvs._add([paths['docs/c.txt']])
+            assert prof.get_counters()["files_scanned"] == 1
+        finally:
+            prof.disable()
+        status = cvs._status([os.path.join(cvs.CURRENT_DIR, 'docs')])
+        assert status == ["Current branch is 'main'\n", "NEW FILES:\n",
+                          f"- {paths['docs/c.txt']}\n"]
+
+    def test_commit_pathspec(self):
+        paths = self.prepare()
+        cvs._add(['.'])
+        cvs._commit('commit1', [os.path.join(cvs.CURRENT_DIR, 'src')])
+        files = cvs._get_last_commit('main')["files"]
+        assert sorted(files) == sorted([paths['src/a.py'], paths['src/b.txt']])
+        staging_files = cvs._update_staging_area()["staging_files"]
+        assert sorted(staging_files["NEW"]) == sorted([paths['docs/c.txt'],
+                                                       paths['d.txt']])
+        with open(paths['src/a.py'], 'w') as f:
+            f.write('changed')
+        cvs._commit('commit2', [paths['d.txt']])
+        files = cvs._get_last_commit('main')["files"]
+        assert files[paths['src/a.py']][2] == "UNCHANGED"
+        assert files[paths['d.txt']][2] == "NEW"
+        assert cvs._update_staging_area()["staging_files"]["MODIFIED"] == [
+            paths['src/a.py']]
+
+    def test_same_names_in_directories(self):
+        cvs._init()
+        paths = [os.path.join(cvs.CURRENT_DIR, directory, 'x.txt')
+                 for directory in ('a', 'b')]
+        for path, text in zip(paths, ('A', 'B')):
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(text)
+        cvs._add([os.path.join(cvs.CURRENT_DIR, 'a'),
+                  os.path.join(cvs.CURRENT_DIR, 'b')])
+        cvs._commit('commit1')
+        cvs._branch('second_branch')
+        cvs._checkout('main')
+        for path, text in zip(paths, ('A', 'B')):
+            with open(path) as f:
+                assert f.read() == text
+        assert not cvs._fsck()["errors"]
+
+
+class TestFsck(InitDirs):
+    def prepare(self):
+        cvs._init()
+        for i in range(3):
+            with open(os.path.join(cvs.CURRENT_DIR, f'test{i}.txt'), 'w') as f:
+                f.write(f'text{i}')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        return cvs._get_last_commit('main')
+
+    def test_fsck_clean_repository(self, monkeypatch):
+        self.prepare()
+        cvs._config('chunk_threshold', '1')
+        cvs._config('chunk_min_size', '16')
+        cvs._config('chunk_avg_size', '64')
+        cvs._config('chunk_max_size', '256')
+        with open(os.path.join(cvs.CURRENT_DIR, 'test0.txt'), 'w') as f:
+            f.write("".join(f"line{i}\n" for i in range(300)))
+        cvs._commit('commit2')
+        monkeypatch.setattr(cvs, 'FSCK_POOL_THRESHOLD', 1)
+        report = cvs._fsck()
+        assert report["errors"] == []
+        assert report["commits"] == 2
+        # Unchanged files of the second commit are stored once
+        assert report["objects"] == 4
+        assert report["chunks"] > 1
+
+    def test_fsck_corrupted_object(self):
+        commit = self.prepare()
+        stored_path = cvs._get_stored_file(
+            commit["files"][os.path.join(cvs.CURRENT_DIR, 'test1.txt')][0])
+        with open(stored_path, 'w') as f:
+            f.write('broken')
+        assert cvs._fsck(quick=True)["errors"] == []
+        errors = cvs._fsck()["errors"]
+        assert [(e["type"], e["commit"]) for e in errors] == [
+            ("hash_mismatch", commit["id"])]
+        os.remove(stored_path)
+        assert [e["type"] for e in cvs._fsck(quick=True)["errors"]] == [
+            "missing_object"]
+
+    def test_moved_repository(self, tmp_path_factory):
+        commit = self.prepare()
+        assert not any(os.path.isabs(info[0]) for info in commit["files"].values())
+        info = commit["files"][os.path.join(cvs.CURRENT_DIR, 'test1.txt')]
+        moved = str(tmp_path_factory.mktemp("moved") / 'repository')
+        os.rename(cvs.CURRENT_DIR, moved)
+        with cvs._use_repository(moved):
+            assert cvs._fsck()["errors"] == []
+            path = os.path.join(moved, 'test1.txt')
+            os.remove(path)
+            cvs._restore_files({path: info})
+            with open(path) as f:
+                assert f.read() == 'text1'
+
+    def test_fsck_links(self):
+        commit = self.prepare()
+        branch_log_path = os.path.join(cvs.BRANCHES_LOG, 'main.json')
+        branch_log = ut.read_json_file(branch_log_path)
+        branch_log["commits"][commit["id"]]["parent_commit_id"] = "1"
+        branch_log["commits"][commit["id"]]["parent_commit_branch"] = "main"
+        branch_log["head"] = "2"
+        ut.write_json_file(branch_log_path, branch_log)
+        types = sorted(e["type"] for e in cvs._fsck(quick=True)["errors"])
+        assert types == ["bad_head", "missing_parent", "ref_mismatch",
+                         "staging_area", "staging_area", "staging_area"]
+
+
+class TestPathHistory(InitDirs):
+    @staticmethod
+    def write(name, text):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+
+    def prepare(self):
+        cvs._init()
+        self.write('test1.txt', 'text1')
+        self.write('test2.txt', 'text2')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        self.write('test2.txt', 'changed')
+        cvs._commit('commit2')
+        cvs._branch('second_branch')
+        self.write('test1.txt', 'changed')
+        cvs._commit('commit3')
+        os.remove(os.path.join(cvs.CURRENT_DIR, 'test1.txt'))
+        cvs._commit('commit4')
+        return [commit[0] for commit in cvs._get_commits('second_branch')]
+
+    def test_path_history(self):
+        commit_ids = self.prepare()
+        main_ids = [commit[0] for commit in cvs._get_commits('main')]
+        history = cvs._get_path_history('test1.txt')
+        assert [commit_id for commit_id, _, _ in history] == [
+            main_ids[-1], commit_ids[1], commit_ids[0]]
+        assert history[-1][1] is None
+        assert [i for i, _, _ in cvs._get_path_history('test2.txt')] == main_ids[::-1]
+        log = cvs._log([os.path.join(cvs.CURRENT_DIR, 'test1.txt')])
+        assert log[0] == "History of 'test1.txt':\n"
+        assert log[1].endswith(f"{commit_ids[0]} [second_branch] 'commit4' (deleted)\n")
+        assert len(log) == 4
+
+    def test_rebuild_path_history(self):
+        self.prepare()
+        histories = [cvs._get_path_history(name)
+                     for name in ('test1.txt', 'test2.txt')]
+        cvs._rebuild_path_history()
+        assert [cvs._get_path_history(name)
+                for name in ('test1.txt', 'test2.txt')] == histories
+
+
+class TestGrep(InitDirs):
+    @staticmethod
+    def write(name, text):
+        path = os.path.join(cvs.CURRENT_DIR, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def prepare(self):
+        cvs._init()
+        self.write('test1.txt', 'first line\nneedle.1\n')
+        self.write('sub/test2.txt', 'needle21\n')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        self.write('sub/test2.txt', 'other\n')
+        cvs._commit('commit2')
+        return [commit[0] for commit in cvs._get_commits('main')]
+
+    def test_grep_head(self):
+        commit_ids = self.prepare()
+        assert cvs._grep('needle.1') == [f"{commit_ids[0]}:test1.txt:2:needle.1\n"]
+        assert cvs._grep('NEEDLE.1', fixed=True, ignore_case=True) == [
+            f"{commit_ids[0]}:test1.txt:2:needle.1\n"]
+        assert cvs._grep('needle.1', [commit_ids[1]],
+                         paths=[os.path.join(cvs.CURRENT_DIR, 'sub')]) == [
+            f"{commit_ids[1]}:sub/test2.txt:1:needle21\n"]
+
+    def test_grep_versions_are_searched_once(self):
+        commit_ids = self.prepare()
+        prof.enable()
+        try:
+            lines = cvs._grep('needle', all_branches=True)
+            # test1.txt is the same in both commits
+            assert prof.get_counters()["files_searched"] == 3
+        finally:
+            prof.disable()
+        assert lines == [f"{commit_ids[0]}:test1.txt:2:needle.1\n",
+                         f"{commit_ids[1]}:sub/test2.txt:1:needle21\n",
+                         f"{commit_ids[1]}:test1.txt:2:needle.1\n"]
+
+    def test_grep_process_pool(self, monkeypatch):
+        self.prepare()
+        monkeypatch.setattr(cvs, 'GREP_POOL_THRESHOLD', 1)
+        assert len(cvs._grep('needle', all_branches=True)) == 3
+
+    def test_invalid_pattern(self):
+        self.prepare()
+        with pytest.raises(exceptions.GrepException):
+            cvs._grep('needle(')
+        assert len(cvs._grep('needle(', fixed=True)) == 0
+
+
+class TestRecords(InitDirs):
+    def test_records_round_trip(self):
+        cvs._init()
+        with open(os.path.join(cvs.CURRENT_DIR, 'test1.txt'), 'w') as f:
+            f.write('text1')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        branch_log_path = os.path.join(cvs.BRANCHES_LOG, 'main.json')
+        branch_log = ut.read_json_file(branch_log_path)
+        commit = branch_log["commits"][branch_log["head"]]
+        commit["note"] = "extra field"
+        ut.write_json_file(branch_log_path, branch_log)
+
+        record = records.read_branch_log(branch_log_path)["commits"][commit["id"]]
+        assert isinstance(record, records.CommitRecord)
+        assert len(record.files.hashes) == records.HASH_SIZE
+        assert record.files.states == bytes([cvs.FileState.NEW.value])
+        assert record.to_json() == commit
+        assert cvs._get_last_commit('main') == commit
+
+    def test_files_named_like_commit_fields(self):
+        cvs._init()
+        for name in ('files', 'id'):
+            with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+                f.write(name)
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        assert [i[2] for i in cvs._get_commits('main')] == ['commit1']
+        assert len(cvs._get_last_commit('main')["files"]) == 2
+
+    def test_read_formatted_and_invalid_logs(self):
+        commit = {"time": "", "parent_commit_branch": None, "parent_commit_id": None,
+                  "branch": "main", "id": "1", "message": "m",
+                  "files": {"commits": ["a", "0" * 64, "NEW"]}}
+        branch_log = {"branch": "main", "head": "1", "commits": {"1": commit},
+                      "parent_branch": None}
+        path = os.path.join(cvs.CURRENT_DIR, 'main.json')
+        for text in (json.dumps(branch_log), json.dumps(branch_log, indent=4),
+                     json.dumps(branch_log, separators=(",", ":"))):
+            with open(path, 'w') as f:
+                f.write(text)
+            loaded = records.read_branch_log(path)
+            assert loaded["commits"]["1"].to_json() == commit
+            loaded["commits"] = branch_log["commits"]
+            assert loaded == branch_log
+        for text in ('{"commits": {}}', '{}'):
+            with open(path, 'w') as f:
+                f.write(text)
+            assert records.read_branch_log(path) == json.loads(text)
+        for text in ('{"commits": {"1": ' + json.dumps(commit) + '}',
+                     '{"head": "1",}', '{} []'):
+            with open(path, 'w') as f:
+                f.write(text)
+            with pytest.raises(json.JSONDecodeError):
+                records.read_branch_log(path)
+
+    def test_paths_are_shared(self):
+        files = {'a.txt': ['.cvs/branches/main/1/a.txt', '0' * 64, 'UNCHANGED']}
+        first = records.FileTable.from_json(files)
+        second = records.FileTable.from_json(json.loads(json.dumps(files)))
+        assert first.stored_paths[0] is second.stored_paths[0]
+        assert dict(second.items()) == files
+
+
+class TestRenames(InitDirs):
+    def prepare(self):
+        cvs._init()
+        os.mkdir(os.path.join(cvs.CURRENT_DIR, 'src'))
+        for i in range(1, 3):
+            with open(os.path.join(cvs.CURRENT_DIR, 'src', f'test{i}.txt'), 'w') as f:
+                f.write("".join(f"line{j}\n" for j in range(10 * i)))
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        os.rename(os.path.join(cvs.CURRENT_DIR, 'src'),
+                  os.path.join(cvs.CURRENT_DIR, 'lib'))
+        cvs._add([os.path.join(cvs.CURRENT_DIR, 'lib')])
+        return cvs._get_last_commit('main')
+
+    def test_moved_files(self):
+        old_commit = self.prepare()
+        status = cvs._status()
+        old1 = os.path.join(cvs.CURRENT_DIR, 'src', 'test1.txt')
+        new1 = os.path.join(cvs.CURRENT_DIR, 'lib', 'test1.txt')
+        assert status[-3:-1] == ["RENAMED FILES:\n", f"- {old1} -> {new1}\n"]
+        assert "NEW FILES:\n" not in status
+
+        cvs._commit('commit2')
+        commit = cvs._get_last_commit('main')
+        assert commit["renames"] == {'lib/test1.txt': 'src/test1.txt',
+                                     'lib/test2.txt': 'src/test2.txt'}
+        # Stored copies of the first commit are reused
+        assert commit["files"][new1][0] == old_commit["files"][old1][0]
+        assert not os.listdir(os.path.join(cvs.BRANCHES, 'main', commit["id"]))
+        history = cvs._get_path_history('lib/test1.txt')
+        assert [(i, path) for i, _, path in history] == [
+            (old_commit["id"], 'src/test1.txt'), (commit["id"], 'lib/test1.txt')]
+
+    def test_changed_rename(self):
+        self.prepare()
+        path = os.path.join(cvs.CURRENT_DIR, 'lib', 'test2.txt')
+        with open(path, 'a') as f:
+            f.write("added line\n")
+        cvs._commit('commit2')
+        assert cvs._get_last_commit('main')["renames"] == {
+            'lib/test1.txt': 'src/test1.txt'}
+        with open(path, 'a') as f:
+            f.write("one more line\n")
+        cvs._config('rename_similarity', '0.8')
+        os.rename(path, os.path.join(cvs.CURRENT_DIR, 'test2.txt'))
+        cvs._add([os.path.join(cvs.CURRENT_DIR, 'test2.txt')])
+        cvs._commit('commit3')
+        assert cvs._get_last_commit('main')["renames"] == {
+            'test2.txt': 'lib/test2.txt'}
+
+
+class TestRecursiveStatus(InitDirs):
+    def test_status_recursive(self, tmp_path):
+        for name in ('clean', os.path.join('group', 'dirty')):
+            with cvs._use_repository(str(tmp_path / name)):
+                os.makedirs(cvs.CURRENT_DIR)
+                cvs._init()
+        with open(tmp_path / 'group' / 'dirty' / 'test1.txt', 'w') as f:
+            f.write('text1')
+
+        summaries = sorted(cvs._status_recursive(str(tmp_path)),
+                           key=lambda summary: summary["path"])
+        assert [summary["path"] for summary in summaries] == [
+            str(tmp_path / 'clean'), str(tmp_path / 'group' / 'dirty')]
+        assert [summary["dirty"] for summary in summaries] == [False, True]
+        assert summaries[1]["untracked"] == 1
+        assert cvs._format_summary(summaries[1], str(tmp_path)) == os.path.join(
+            'group', 'dirty') + " [main] new 0, modified 0, deleted 0, untracked 1"
+
+        dirty = list(cvs._status_recursive(str(tmp_path), dirty_only=True))
+        assert [summary["path"] for summary in dirty] == [
+            str(tmp_path / 'group' / 'dirty')]
+
+    def test_search_stops_at_repositories(self, tmp_path):
+        for name in ('outer', os.path.join('outer', 'inner'),
+                     os.path.join('venv', 'hidden'), os.path.join('.cache', 'hidden')):
+            with cvs._use_repository(str(tmp_path / name)):
+                os.makedirs(cvs.CURRENT_DIR, exist_ok=True)
+                cvs._init()
+        # Nested repository and ignored directories are not searched
+        assert list(cvs._find_repositories(str(tmp_path))) == [
+            str(tmp_path / 'outer')]
+        assert list(cvs._find_repositories(str(tmp_path / 'outer'))) == [
+            str(tmp_path / 'outer')]
+
+
+class TestBranchTable(InitDirs):
+    @staticmethod
+    def commit_file(name, text, message):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+        cvs._add(['.'])
+        cvs._commit(message)
+
+    def prepare(self):
+        cvs._init()
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        cvs._branch('second_branch')
+        self.commit_file('test1.txt', 'text2', 'commit2')
+        cvs._checkout('main')
+
+    def test_list_and_archive(self):
+        self.prepare()
+        assert cvs._list_branches() == ["* main\n", "  second_branch\n"]
+        cvs._archive_branch('second_branch')
+        assert cvs._get_branches() == ['main']
+        assert cvs._list_branches(show_all=True) == [
+            "* main\n", "  second_branch (archived)\n"]
+        assert 'commit2' not in "".join(cvs._log())
+        with pytest.raises(exceptions.CheckoutException):
+            cvs._checkout('second_branch')
+        cvs._archive_branch('second_branch', archived=False)
+        cvs._checkout('second_branch')
+
+    def test_delete_branch(self):
+        self.prepare()
+        with pytest.raises(exceptions.BranchException):
+            cvs._delete_branch('main')
+        cvs._checkout('second_branch')
+        with pytest.raises(exceptions.BranchException):
+            cvs._delete_branch('main')
+        cvs._checkout('main')
+        cvs._delete_branch('second_branch')
+        assert cvs._get_branches() == ['main']
+        assert not os.path.exists(os.path.join(cvs.BRANCHES_LOG, 'second_branch.json'))
+        assert all(info[0] == 'main' for info in cvs._load_commit_graph().values())
+        cvs._gc()
+        assert not os.path.exists(os.path.join(cvs.BRANCHES, 'second_branch'))
+        assert not cvs._fsck()["errors"]
+        cvs._branch('second_branch')
+
+    def test_rebuild_refs(self):
+        self.prepare()
+        refs = cvs._load_refs()
+        os.remove(cvs.REFS)
+        assert cvs._load_refs() == refs
+        assert refs['second_branch']['parent_branch'] == 'main'
+        assert refs['main']['head'] == cvs._get_commits('main')[0][0]
+
+    def test_ref_updates_log(self, monkeypatch):
+        self.prepare()
+        with open(cvs.REFS) as f:
+            packed = f.read()
+        cvs._checkout('second_branch')
+        self.commit_file('test1.txt', 'text3', 'commit3')
+        # Commit appends its head to updates log, ref table isn't rewritten
+        with open(cvs.REFS) as f:
+            assert f.read() == packed
+        head = cvs._get_commits('second_branch')[0][0]
+        assert cvs._load_refs()['second_branch']['head'] == head
+        assert cvs._get_head('second_branch') == ('second_branch', head)
+
+        monkeypatch.setattr(cvs, 'REF_UPDATES_COMPACTION_SIZE', 0)
+        self.commit_file('test1.txt', 'text4', 'commit4')
+        assert not os.path.exists(cvs.REF_UPDATES)
+        assert ut.read_json_file(cvs.REFS) == cvs._load_refs()
+        assert not cvs._fsck(quick=True)["errors"]
+
+
+class TestHooks(InitDirs):
+    @pytest.fixture
+    def hook_command(self, tmp_path_factory):
+        """Hook fails on files containing 'bad' and writes names of
+        checked files to log"""
+        directory = tmp_path_factory.mktemp("hook")
+        log_path = directory / 'log.txt'
+        script = directory / 'hook.py'
+        script.write_text(
+            "import sys\n"
+            f"with open({str(log_path)!r}, 'a') as f:\n"
+            "    f.writelines(p + '\\n' for p in sys.argv[1:])\n"
+            "bad = [p for p in sys.argv[1:] if 'bad' in open(p).read()]\n"
+            "print(*bad)\n"
+            "sys.exit(1 if bad else 0)\n")
+        return f'"{sys.executable}" "{script}"', log_path
+
+    @staticmethod
+    def write(name, text):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+
+    def test_hooks_changed_files(self, hook_command):
+        command, log_path = hook_command
+        cvs._init()
+        cvs._add_hook('check', command, ['*.py'], batch_size=1)
+        cvs._add_hook('all', command)
+        self.write('test1.py', 'text1')
+        self.write('test2.txt', 'text2')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        assert sorted(log_path.read_text().split()) == [
+            'test1.py', 'test1.py', 'test2.txt']
+
+        log_path.write_text('')
+        self.write('test2.txt', 'changed')
+        cvs._commit('commit2')
+        assert log_path.read_text().split() == ['test2.txt']
+
+    def test_hooks_cache_and_failure(self, hook_command):
+        command, log_path = hook_command
+        cvs._init()
+        cvs._add_hook('check', command, batch_size=1)
+        self.write('test1.txt', 'text1')
+        self.write('test2.txt', 'bad')
+        cvs._add(['.'])
+        with pytest.raises(exceptions.HookException, match="test2.txt"):
+            cvs._commit('commit1')
+        assert not cvs._get_commits('main')
+
+        log_path.write_text('')
+        self.write('test2.txt', 'good')
+        report = cvs._run_hooks([os.path.join(cvs.CURRENT_DIR, 'test1.txt'),
+                                 os.path.join(cvs.CURRENT_DIR, 'test2.txt')])
+        assert report['check']['files'] == 1
+        assert report['check']['cached'] == 1
+        assert log_path.read_text().split() == ['test2.txt']
+        cvs._commit('commit1')
+        assert len(cvs._get_commits('main')) == 1
+
+    def test_no_verify(self, hook_command):
+        command, log_path = hook_command
+        cvs._init()
+        cvs._add_hook('check', command)
+        with pytest.raises(exceptions.HookException):
+            cvs._add_hook('check', command)
+        self.write('test1.txt', 'bad')
+        cvs._add(['.'])
+        cvs._commit('commit1', no_verify=True)
+        assert not log_path.exists()
+        cvs._remove_hook('check')
+        assert cvs._list_hooks() == []
+
+
+class TestCommitIds(InitDirs):
+    @staticmethod
+    def commit_file(name, text, message):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+        cvs._add(['.'])
+        cvs._commit(message)
+
+    def test_unique_ids(self):
+        cvs._init()
+        for i in range(5):
+            self.commit_file('test1.txt', f'text{i}', f'commit{i}')
+        commit_ids = [commit[0] for commit in cvs._get_commits('main')]
+        assert len(set(commit_ids)) == 5
+        assert all(len(i) == cvs.COMMIT_ID_WIDTH for i in commit_ids)
+        cvs._branch('second_branch')
+        cvs._cherry_pick([commit_ids[-1], commit_ids[-1]])
+        assert len(cvs._get_commits('second_branch')) == 2
+
+    def test_resolve_prefix(self):
+        cvs._init()
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        commit_id = cvs._get_commits('main')[0][0]
+        cvs._change_commit_message(commit_id[:7], 'new_message')
+        assert cvs._get_commits('main')[0][2] == 'new_message'
+        assert cvs._resolve_revision(commit_id[:4])["id"] == commit_id
+        with pytest.raises(FileNotFoundError):
+            cvs._resolve_commit_id(commit_id[:3])
+
+        with open(cvs.NEW_COMMIT_IDS, 'a') as f:
+            f.write(commit_id[:6] + 'x' * 34 + '\n')
+        with pytest.raises(exceptions.RevisionException):
+            cvs._resolve_commit_id(commit_id[:6])
+        assert cvs._resolve_commit_id(commit_id[:7]) == commit_id
+
+    def test_id_index(self, monkeypatch):
+        cvs._init()
+        monkeypatch.setattr(cvs, 'NEW_COMMIT_IDS_LIMIT', 2)
+        for i in range(4):
+            self.commit_file('test1.txt', f'text{i}', f'commit{i}')
+        commit_ids = [commit[0] for commit in cvs._get_commits('main')]
+        with open(cvs.COMMIT_IDS) as f:
+            assert [line.rstrip() for line in f] == sorted(commit_ids[1:])
+        assert sorted(cvs._find_commit_ids('')) == sorted(commit_ids)
+        assert not cvs._fsck(quick=True)["errors"]
+
+        cvs._write_commit_ids({'1715000000000': None, commit_ids[0]: None})
+        assert cvs._find_commit_ids('1715') == ['1715000000000']
+
+
+class TestAsyncApi(InitDirs):
+    @staticmethod
+    def write(name, text):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+
+    def test_operations_and_progress(self):
+        cvs._init()
+        self.write('test1.txt', 'text1')
+        self.write('test2.txt', 'text2')
+        events = []
+
+        async def main():
+            repository = async_api.Repository(cvs.CURRENT_DIR)
+            await repository.add(['.'])
+            await repository.commit('commit1', progress=lambda *e: events.append(e))
+            self.write('test1.txt', 'changed')
+            results = await asyncio.gather(
+                *[repository.status(progress=lambda *e: events.append(e))
+                  for _ in range(3)], repository.log())
+            await repository.branch('second_branch')
+            return results
+
+        *statuses, log = asyncio.run(main())
+        assert statuses[0] == statuses[1] == statuses[2]
+        assert any('test1.txt' in line for line in statuses[0])
+        assert "'commit1'" in "".join(log)
+        assert ('copy', 0, 2) in events
+        assert ('hash', 1, 2) in events
+        assert cvs._get_branches() == ['main', 'second_branch']
+
+    def test_read_write_lock(self):
+        order = []
+
+        async def reader(lock, name):
+            async with lock.read():
+                order.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} end")
+
+        async def writer(lock):
+            async with lock.write():
+                order.append("writer start")
+                await asyncio.sleep(0.01)
+                order.append("writer end")
+
+        async def main():
+            lock = async_api.ReadWriteLock()
+            first = asyncio.create_task(reader(lock, "first"))
+            await asyncio.sleep(0)
+            await asyncio.gather(first, writer(lock), reader(lock, "second"))
+
+        asyncio.run(main())
+        assert order == ["first start", "first end", "writer start",
+                         "writer end", "second start", "second end"]
+
+    def test_cancel(self):
+        cvs._init()
+        self.write('test1.txt', 'text1')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        self.write('test1.txt', 'changed')
+        cancelled = threading.Event()
+        cancelled.set()
+        with cvs._progress_context(cancelled=cancelled):
+            with pytest.raises(exceptions.CancelledException):
+                cvs._commit('commit2')
+        assert len(cvs._get_commits('main')) == 1
+
+        async def main():
+            repository = async_api.Repository(cvs.CURRENT_DIR)
+            async with repository._lock.read():
+                task = asyncio.create_task(repository.commit('commit2'))
+                await asyncio.sleep(0.01)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+
+        asyncio.run(main())
+        assert len(cvs._get_commits('main')) == 1
+
+    def test_statuses_of_chunked_file(self):
+        cvs._init()
+        cvs._config('chunk_threshold', '1024')
+        cvs._config('chunk_min_size', '64')
+        cvs._config('chunk_avg_size', '256')
+        cvs._config('chunk_max_size', '1024')
+        path = os.path.join(cvs.CURRENT_DIR, 'data.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(50000))
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        chunks = sorted(Path(cvs.CHUNKS).rglob('*'))
+        with open(path, 'ab') as f:
+            f.write(os.urandom(5000))
+
+        async def main():
+            repository = async_api.Repository(cvs.CURRENT_DIR)
+            return await asyncio.gather(*[repository.status() for _ in range(8)])
+
+        statuses = asyncio.run(main())
+        assert all(status == statuses[0] for status in statuses)
+        # Status hashes chunks, but doesn't write them
+        assert sorted(Path(cvs.CHUNKS).rglob('*')) == chunks
+        cvs._commit('commit2')
+        manifest = ut.read_json_file(
+            cvs._get_stored_file(cvs._get_last_commit('main')["files"][path][0]))
+        copy_path = os.path.join(cvs.CURRENT_DIR, 'copy.bin')
+        ut.join_chunks(copy_path, cvs.CHUNKS, manifest)
+        assert ut.get_file_hash(copy_path) == ut.get_file_hash(path)
+
+
+class TestAlternates(InitDirs):
+    @pytest.fixture
+    def store(self, tmp_path_factory):
+        return str(tmp_path_factory.mktemp("store"))
+
+    @staticmethod
+    def commit_file(name, text, message):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+        cvs._add(['.'])
+        cvs._commit(message)
+
+    def test_commit_uses_store(self, store):
+        cvs._init()
+        cvs._add_alternate(store)
+        assert cvs._get_alternates() == [store]
+        source = os.path.join(store, 'source.txt')
+        with open(source, 'w') as f:
+            f.write('text1')
+        file_hash = ut.get_file_hash(source)
+        ut.store_shared_object(source, cvs._get_shared_path(store, file_hash))
+
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        self.commit_file('test2.txt', 'text2', 'commit2')
+        files = cvs._get_last_commit('main')['files']
+        path1 = os.path.join(cvs.CURRENT_DIR, 'test1.txt')
+        path2 = os.path.join(cvs.CURRENT_DIR, 'test2.txt')
+        assert files[path1][0] == cvs._get_shared_path(store, file_hash)
+        assert files[path2][0].startswith(cvs.REPOSITORY_PATHS["BRANCHES"])
+
+        # Stored copy, which was removed, is read from store
+        stored_path2 = cvs._get_stored_file(files[path2][0])
+        ut.store_shared_object(stored_path2,
+                               cvs._get_shared_path(store, files[path2][1]))
+        os.remove(stored_path2)
+        os.remove(path1)
+        os.remove(path2)
+        cvs._restore_files(files)
+        for path, text in ((path1, 'text1'), (path2, 'text2')):
+            with open(path) as f:
+                assert f.read() == text
+
+    def test_repack_shared(self, store, tmp_path_factory):
+        other = str(tmp_path_factory.mktemp("other"))
+        for root in (cvs.CURRENT_DIR, other):
+            with cvs._use_repository(root):
+                cvs._init()
+                self.commit_file('test1.txt', 'text1', 'commit1')
+                self.commit_file('test2.txt', 'text2', 'commit2')
+
+        report = cvs._repack_shared(store)
+        assert report['copied'] == 2 and report['shared'] == 0
+        assert report['bytes'] == 10
+        with cvs._use_repository(other):
+            assert cvs._repack_shared(store) == {"copied": 0, "shared": 2,
+                                                 "bytes": 10}
+        assert not list(cvs._get_stored_files())
+        for info in cvs._get_last_commit('main')['files'].values():
+            assert info[0].startswith(store)
+        assert not cvs._fsck()["errors"]
+
+        os.remove(os.path.join(cvs.CURRENT_DIR, 'test1.txt'))
+        cvs._restore_files(cvs._get_last_commit('main')['files'])
+        with open(os.path.join(cvs.CURRENT_DIR, 'test1.txt')) as f:
+            assert f.read() == 'text1'
+
+    def test_push_shared_objects(self, store, tmp_path_factory):
+        remote = str(tmp_path_factory.mktemp("remote"))
+        with cvs._use_repository(remote):
+            cvs._init()
+            cvs._add_alternate(store)
+        cvs._init()
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        cvs._branch('second_branch')
+        self.commit_file('test2.txt', 'text2', 'commit2')
+        cvs._repack_shared(store)
+        cvs._add_remote('origin', remote)
+        assert cvs._push('origin') == {"commits": 2, "files": 0}
+        with cvs._use_repository(remote):
+            for info in cvs._get_last_commit('second_branch')['files'].values():
+                assert info[0] == cvs._get_shared_path(store, info[1])
+
+
+class TestWorktrees(InitDirs):
+    @pytest.fixture
+    def repository(self, monkeypatch, tmp_path_factory):
+        """Repository with paths relative to its root, like in command line,
+        and path for working tree"""
+        monkeypatch.chdir(cvs.CURRENT_DIR)
+        with cvs._use_repository(os.curdir):
+            cvs._init()
+            self.commit_file('test1.txt', 'text1', 'commit1')
+            cvs._branch('second_branch')
+            self.commit_file('test2.txt', 'text2', 'commit2')
+            cvs._checkout('main')
+            yield str(tmp_path_factory.mktemp("worktrees") / 'second')
+
+    @staticmethod
+    def commit_file(name, text, message):
+        with open(name, 'w') as f:
+            f.write(text)
+        cvs._add(['.'])
+        cvs._commit(message)
+
+    def test_add_worktree(self, repository, monkeypatch):
+        root = os.getcwd()
+        with pytest.raises(exceptions.WorktreeException):
+            cvs._add_worktree('nested', 'second_branch')
+        assert not os.path.exists('nested')
+        cvs._add_worktree(repository, 'second_branch')
+        assert cvs._get_checked_out_branches() == {root: 'main',
+                                                   repository: 'second_branch'}
+        with pytest.raises(exceptions.WorktreeException):
+            cvs._add_worktree(repository + '_other', 'second_branch')
+        with pytest.raises(exceptions.CheckoutException):
+            cvs._checkout('second_branch')
+        assert not os.path.exists('test2.txt')
+
+        monkeypatch.chdir(repository)
+        with cvs._use_repository(os.curdir):
+            with open('test2.txt') as f:
+                assert f.read() == 'text2'
+            assert cvs._get_repository_root() == root
+            self.commit_file('test1.txt', 'changed', 'commit3')
+            assert not os.path.exists(os.path.join('.cvs', 'commit_graph.jsonl'))
+        monkeypatch.chdir(root)
+
+        assert [i[2] for i in cvs._get_commits('second_branch')] == [
+            'commit3', 'commit2']
+        with open('test1.txt') as f:
+            assert f.read() == 'text1'
+        assert not cvs._fsck()["errors"]
+
+    def test_remove_worktree(self, repository, monkeypatch):
+        root = os.getcwd()
+        cvs._add_worktree(repository, 'second_branch')
+        with pytest.raises(exceptions.BranchException):
+            cvs._delete_branch('second_branch')
+        with open(os.path.join(repository, 'test3.txt'), 'w') as f:
+            f.write('text3')
+        with pytest.raises(exceptions.WorktreeException):
+            cvs._remove_worktree(repository)
+
+        os.remove(os.path.join(repository, 'test3.txt'))
+        cvs._remove_worktree(repository)
+        assert not os.path.exists(repository)
+        assert cvs._get_checked_out_branches() == {root: 'main'}
+        assert os.path.exists(os.path.join(cvs.BRANCHES, 'second_branch'))
+        cvs._checkout('second_branch')
+        with open('test2.txt') as f:
+            assert f.read() == 'text2'
+
+    def test_lock_is_shared_with_worktree(self, repository, monkeypatch):
+        root = os.getcwd()
+        cvs._add_worktree(repository, 'second_branch')
+        cvs._config('lock_timeout', '0.2')
+        # Lock file of another process, which changes repository
+        lock_path = os.path.join(root, cvs.LOCK)
+        with open(lock_path, 'w') as f:
+            f.write('0')
+
+        monkeypatch.chdir(repository)
+        with cvs._use_repository(os.curdir):
+            with pytest.raises(exceptions.LockException):
+                self.commit_file('test2.txt', 'changed', 'commit3')
+            assert os.path.exists(lock_path)
+            os.remove(lock_path)
+            self.commit_file('test2.txt', 'changed', 'commit3')
+        assert not os.path.exists(lock_path)
+        monkeypatch.chdir(root)
+        assert cvs._get_last_commit('second_branch')["message"] == 'commit3'
+
+    def test_stale_lock_is_removed(self, repository):
+        cvs._config('lock_timeout', '0')
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        with open(cvs.LOCK, 'w') as f:
+            json.dump({"pid": process.pid, "host": socket.gethostname()}, f)
+        self.commit_file('test3.txt', 'text3', 'commit3')
+        assert not os.path.exists(cvs.LOCK)
+
+        # Process of another host can't be checked
+        with open(cvs.LOCK, 'w') as f:
+            json.dump({"pid": process.pid, "host": "other-host"}, f)
+        with pytest.raises(exceptions.LockException):
+            self.commit_file('test3.txt', 'changed', 'commit4')
+        os.remove(cvs.LOCK)
+
+    def test_add_worktree_by_absolute_path(self, repository, tmp_path_factory):
+        path = str(tmp_path_factory.mktemp("other") / 'second')
+        # Repository is opened by absolute path like in GUI
+        with cvs._use_repository(os.path.abspath(os.curdir)):
+            cvs._add_worktree(path, 'second_branch')
+        with open(os.path.join(path, 'test2.txt')) as f:
+            assert f.read() == 'text2'
+        with open(os.path.join(path, cvs.STAGING_AREA)) as f:
+            assert sorted(json.load(f)["staging_files"]["UNCHANGED"]) == \
+                ['test1.txt', 'test2.txt']
+
+    def test_add_worktree_with_absolute_commit_paths(self, tmp_path_factory):
+        cvs._init()
+        with open(os.path.join(cvs.CURRENT_DIR, 'test1.txt'), 'w') as f:
+            f.write('text1')
+        cvs._add(['.'])
+        cvs._commit('commit1')
+        cvs._branch('second_branch')
+        cvs._checkout('main')
+        path = str(tmp_path_factory.mktemp("worktrees") / 'second')
+        with pytest.raises(exceptions.WorktreeException):
+            cvs._add_worktree(path, 'second_branch')
+        assert not os.path.exists(path)
+
+    def test_status_does_not_write_staging_area(self, repository, monkeypatch):
+        cvs._config('lock_timeout', '0')
+        with open(cvs.LOCK, 'w') as f:
+            f.write('0')
+        with open(cvs.STAGING_AREA) as f:
+            staging_area = f.read()
+        with open('test3.txt', 'w') as f:
+            f.write('text3')
+        assert any('test3.txt' in line for line in cvs._status())
+        cvs._diff()
+        cvs._log()
+        with open(cvs.STAGING_AREA) as f:
+            assert f.read() == staging_area
+        with pytest.raises(exceptions.LockException):
+            cvs._add(['.'])
+        os.remove(cvs.LOCK)
+
+
+class TestStats(InitDirs):
+    @staticmethod
+    def commit_file(name, text, message):
+        with open(os.path.join(cvs.CURRENT_DIR, name), 'w') as f:
+            f.write(text)
+        cvs._add(['.'])
+        cvs._commit(message)
+
+    @staticmethod
+    def assert_recomputed(stats=None):
+        stats = stats or cvs._get_stats()
+        recomputed = cvs._get_stats(recompute=True)
+        # Path of content, which several files have, is any of them
+        largest = [entry[:2] for entry in stats.pop("largest")]
+        assert largest == [entry[:2] for entry in recomputed.pop("largest")]
+        assert stats == recomputed
+
+    def test_incremental_counters(self):
+        cvs._init()
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        self.commit_file('test1.txt', 'text2', 'commit2')
+        # Content of older commit is stored again
+        self.commit_file('test1.txt', 'text1', 'commit3')
+        self.commit_file('test2.txt', 'text1', 'commit4')
+        stats = cvs._get_stats()
+        assert stats["branches"] == {"main": {"commits": 4, "files": 2}}
+        assert (stats["stored_files"], stats["unique_contents"]) == (3, 2)
+        assert stats["stored_bytes"] == 15 and stats["unique_bytes"] == 10
+
+        cvs._branch('second_branch')
+        assert cvs._get_stats()["branches"]["second_branch"] == \
+            {"commits": 0, "files": 2}
+        self.commit_file('test1.txt', 'changed text1', 'commit5')
+        commit_id = cvs._get_commits('second_branch')[0][0]
+        cvs._checkout('main')
+        self.commit_file('test3.txt', 'longer text3', 'commit6')
+        cvs._cherry_pick([commit_id])
+        cvs._merge('second_branch')
+        stats = cvs._get_stats()
+        assert stats["branches"]["main"] == {"commits": 7, "files": 3}
+        assert stats["largest"][0][:2] == [13, ut.get_file_hash(
+            os.path.join(cvs.CURRENT_DIR, 'test1.txt'))]
+        self.assert_recomputed(stats)
+
+    def test_gc_and_deleted_branch(self):
+        cvs._init()
+        cvs._config('chunk_threshold', '1000')
+        for i in range(3):
+            self.commit_file('test1.txt', f'text{i}', f'commit{i}')
+        with open(os.path.join(cvs.CURRENT_DIR, 'data.bin'), 'wb') as f:
+            f.write(os.urandom(5000))
+        cvs._add(['.'])
+        cvs._commit('chunked')
+        cvs._branch('second_branch')
+        self.commit_file('test2.txt', 'other text', 'commit4')
+        cvs._checkout('main')
+        cvs._delete_branch('second_branch')
+        stats = cvs._get_stats()
+        assert "second_branch" not in stats["branches"]
+        # Files of deleted branch are counted, until gc removes them
+        assert stats["stored_files"] == 5
+        self.assert_recomputed()
+
+        cvs._gc(keep_last=1)
+        stats = cvs._get_stats()
+        assert stats["branches"]["main"]["commits"] == 1
+        assert stats["stored_files"] == 2
+        self.assert_recomputed(stats)
+
+    def test_recompute_in_pool(self, monkeypatch):
+        cvs._init()
+        for i in range(3):
+            self.commit_file(f'test{i}.txt', f'text{i}', f'commit{i}')
+        cvs._branch('second_branch')
+        expected = cvs._get_stats()
+        os.remove(cvs.STATS)
+        monkeypatch.setattr(cvs, 'STATS_POOL_THRESHOLD', 1)
+        assert cvs._get_stats() == expected
+
+    def test_pushed_stats(self, tmp_path_factory):
+        remote_path = str(tmp_path_factory.mktemp("remote"))
+        with cvs._use_repository(remote_path):
+            cvs._init()
+        cvs._init()
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        cvs._branch('second_branch')
+        self.commit_file('test2.txt', 'text2', 'commit2')
+        cvs._add_remote('origin', remote_path)
+        cvs._push('origin')
+        with cvs._use_repository(remote_path):
+            stats = cvs._get_stats()
+            assert stats["branches"]["second_branch"] == \
+                {"commits": 1, "files": 2}
+            assert stats["stored_files"] == 2
+            self.assert_recomputed(stats)
+
+
+class TestRemoteCommands(InitDirs):
+    @pytest.fixture
+    def remote_path(self, tmp_path_factory):
+        path = str(tmp_path_factory.mktemp("remote"))
+        with cvs._use_repository(path):
+            cvs._init()
+        return path
+
+    @staticmethod
+    def commit_file(name, text, message):
+        path = os.path.join(cvs.CURRENT_DIR, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        cvs._add(['.'])
+        cvs._commit(message)
+        return path
+
+    def test_add_remote(self, remote_path):
+        cvs._init()
+        cvs._add_remote('origin', remote_path)
+        assert cvs._get_remotes() == {'origin': remote_path}
+        with pytest.raises(exceptions.RemoteException):
+            cvs._add_remote('origin', remote_path)
+        with pytest.raises(exceptions.RemoteException):
+            cvs._add_remote('other', os.path.join(remote_path, 'missing'))
+
+    def test_push(self, remote_path):
+        cvs._init()
+        self.commit_file('test1.txt', 'text1', 'commit1')
+        cvs._branch('second_branch')
+        self.commit_file('test2.txt', 'text2', 'commit2')
+        cvs._add_remote('origin', remote_path)
+
+        report = cvs._push('origin')
+        assert report == {"commits": 2, "files": 2}
+        local_head = cvs._get_last_commit('second_branch')
+        local_base = cvs._get_last_commit('main')
+        with cvs._use_repository(remote_path):
+            remote_head = cvs._get_last_commit('second_branch')
+            assert remote_head["id"] == local_head["id"]
+            # Pushed paths are relative to the root of remote repository
+            stored_path = remote_head["files"]['test2.txt'][0]
+            assert not os.path.isabs(stored_path)
+            with open(os.path.join(remote_path, stored_path)) as f:
+                assert f.read() == 'text2'
+            # Empty checked out branch is moved to the pushed base commit
+            # and its files are written to remote working directory
+            assert cvs._get_last_commit('main')["id"] == local_base["id"]
+            assert len(cvs._get_commits('main')) == 1
+            assert cvs._fsck()["errors"] == []
+        with open(os.path.join(remote_path, 'test1.txt')) as f:
+            assert f.read() == 'text1'
+
+        self.commit_file('test3.txt', 'text3', 'commit3')
+        cvs._checkout('main')
+        assert cvs._push('origin', 'second_branch') == {"commits": 1, "files": 1}
+        self.commit_file('test1.txt', 'changed', 'commit4')
+        with pytest.raises(exceptions.RemoteException):
+            cvs._push('origin', 'main')
+
+    def test_fetch(self, remote_path):
+        cvs._init()
+        with cvs._use_repository(remote_path):
+            self.commit_file('test1.txt', 'text1', 'commit1')
+            self.commit_file('test1.txt', 'text2', 'commit2')
+        cvs._add_remote('origin', remote_path)
+        assert cvs._fetch('origin') == {"commits": 2, "files": 2}
+        with open(os.path.join(cvs.CURRENT_DIR, 'test1.txt')) as f:
+            assert f.read() == 'text2'
+        staging_files = cvs._update_staging_area()["staging_files"]
+        assert not staging_files[cvs.FileState.UNTRACKED.name]
+        assert not staging_files[cvs.FileState.MODIFIED.name]
+        assert len(cvs._get_commits('main')) == 2
+        assert cvs._fetch('origin') == {"commits": 0, "files": 0}
+
+    def test_fetch_moves_branch_of_base_commit(self, remote_path):
+        cvs._init()
+        with cvs._use_repository(remote_path):
+            self.commit_file('test1.txt', 'text1', 'commit1')
+            cvs._branch('feat')
+            self.commit_file('test2.txt', 'text2', 'commit2')
+        cvs._add_remote('origin', remote_path)
+        with open(os.path.join(cvs.CURRENT_DIR, 'test3.txt'), 'w') as f:
+            f.write('text3')
+        cvs._add(['.'])
+        with pytest.raises(exceptions.RemoteException):
+            cvs._fetch('origin', 'feat')
+
+        cvs._reset()
+        os.remove(os.path.join(cvs.CURRENT_DIR, 'test3.txt'))
+        assert cvs._fetch('origin', 'feat') == {"commits": 2, "files": 2}
+        assert [i[2] for i in cvs._get_commits('main')] == ['commit1']
+        with open(os.path.join(cvs.CURRENT_DIR, 'test1.txt')) as f:
+            assert f.read() == 'text1'
+        assert cvs._fsck()["errors"] == []
+
+    def test_fetch_diverged_branch(self, remote_path):
+        cvs._init()
+        with cvs._use_repository(remote_path):
+            self.commit_file('test1.txt', 'remote', 'commit1')
+        self.commit_file('test1.txt', 'local', 'commit1')
+        cvs._add_remote('origin', remote_path)
+        with pytest.raises(exceptions.RemoteException):
+            cvs._fetch('origin')
@@ -20,3 +20,43 @@ class CheckoutException(Exception):
 
 class CherryPickException(Exception):
     message: str
+
+
+class ConfigException(Exception):
+    message: str
+
+
+class MergeException(Exception):
+    message: str
+
+
+class RemoteException(Exception):
+    message: str
+
+
+class HookException(Exception):
+    message: str
+
+
+class RevisionException(Exception):
+    message: str
+
+
+class CancelledException(Exception):
+    message: str
+
+
+class RepackException(Exception):
+    message: str
+
+
+class WorktreeException(Exception):
+    message: str
+
+
+class GrepException(Exception):
+    message: str
+
+
+class LockException(Exception):
+    message: str
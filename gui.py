@@ -1,8 +1,14 @@
+import glob
 import os
 import tkinter as tk
-from tkinter import filedialog, messagebox, simpledialog
+from tkinter import filedialog, messagebox, simpledialog, ttk
 import cvs
 import exceptions
+import utils as ut
+
+# Prefix of placeholder child, which makes a directory row expandable
+# before its content is actually loaded
+DUMMY_PREFIX = "::dummy::"
 
 
 class CVSApp:
@@ -14,7 +20,12 @@ class CVSApp:
         self.root.resizable(False, False)
 
         # self.current_dir = None
-        self.items = []
+        # File path -> state name, as it is shown in the tree
+        self.file_states = dict()
+        # Directory id -> {child id: is directory}
+        self.tree_index = dict()
+        # Directories, which rows have been already created
+        self.loaded_dirs = set()
         self.init_menu()
 
         # Frame for file list
@@ -23,13 +34,16 @@ class CVSApp:
         # Scrollbar
         self.scrollbar = tk.Scrollbar(self.frame)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        # Canvas to contain the checklist
-        self.canvas = tk.Canvas(self.frame, yscrollcommand=self.scrollbar.set)
-        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.scrollbar.config(command=self.canvas.yview)
-        # Frame inside the canvas
-        self.check_frame = tk.Frame(self.canvas)
-        self.canvas.create_window((0, 0), window=self.check_frame, anchor='nw')
+        # Tree creates widgets only for loaded rows and draws visible ones
+        self.tree = ttk.Treeview(self.frame, columns=("state",),
+                                 selectmode="extended",
+                                 yscrollcommand=self.scrollbar.set)
+        self.tree.heading("#0", text="File")
+        self.tree.heading("state", text="State")
+        self.tree.column("state", width=100, stretch=False)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.tree.bind("<<TreeviewOpen>>", self.on_open_directory)
+        self.scrollbar.config(command=self.tree.yview)
         # Text field
         self.text_field = tk.Text(self.root, width=42, height=2, border=5)
         self.text_field.pack(side=tk.LEFT, fill=tk.X)
@@ -59,12 +73,7 @@ class CVSApp:
 
     @staticmethod
     def init_cvs_directories(directory):
-        cvs.MAIN_BRANCH = os.path.join(directory, '.cvs/branches/main')
-        cvs.BRANCHES = os.path.join(directory, '.cvs/branches')
-        cvs.BRANCHES_LOG = os.path.join(directory, '.cvs/branches_log')
-        cvs.STAGING_AREA = os.path.join(directory, '.cvs/staging_area.json')
-        cvs.GITIGNORE = os.path.join(directory, '.cvs/cvsignore.json')
-        cvs.CURRENT_DIR = os.path.join(directory)
+        cvs._set_repository(directory)
 
     def init(self):
         if cvs.CURRENT_DIR == '.' or not cvs.CURRENT_DIR:
@@ -92,7 +101,11 @@ class CVSApp:
                     cvs._add(items, console_info=True)
                 except:
                     pass
-                cvs._commit(self.text_field.get("1.0", "end"), console_info=True)
+                try:
+                    cvs._commit(self.text_field.get("1.0", "end"), console_info=True)
+                except exceptions.HookException as e:
+                    messagebox.showinfo('Error', str(e))
+                    return
                 messagebox.showinfo('Success', 'Commit successful')
                 self.init_cherry_pick()
 
@@ -101,6 +114,7 @@ class CVSApp:
         print(directory)
         self.init_cvs_directories(directory)
         if directory:
+            self.clear_file_list()
             self.populate_file_list()
             self.init_menu()
 
@@ -125,7 +139,7 @@ class CVSApp:
     def init_cherry_pick(self):
         try:
             cvs._check_repository_existence()
-            staging_area = cvs._update_staging_area()
+            staging_area = cvs._update_staging_area(save=False)
             current_branch = staging_area["current_branch"]
             self.cherry_menu.destroy()
             self.cherry_menu = tk.Menu(self.menu, tearoff=0)
@@ -142,27 +156,163 @@ class CVSApp:
         cvs._cherry_pick(commit_id, console_info=True)
         self.populate_file_list()
 
-    def populate_file_list(self):
-        # Clear the previous list
-        for widget in self.check_frame.winfo_children():
-            widget.destroy()
+    def populate_file_list(self, pathspecs=None):
+        """Synchronizes the tree with the current file states.
+        Only rows of loaded directories, which states or content were
+        changed since previous call, are touched. Only loaded directories
+        (or pathspecs, if they are given) are scanned, files of other
+        directories keep states from the staging area"""
+        if pathspecs is None:
+            pathspecs = self.get_loaded_paths()
+        new_states = self.get_file_states(pathspecs)
+        new_index = self.build_tree_index(new_states)
+
+        for directory in list(self.loaded_dirs):
+            if directory not in new_index:
+                continue
+            old_children = self.tree_index.get(directory, dict())
+            new_children = new_index[directory]
+            for child in old_children.keys() - new_children.keys():
+                if self.tree.exists(child):
+                    self.tree.delete(child)
+                self.forget_directory(child)
+            # Rows are sorted, so every added row is inserted at its
+            # position among all children
+            order = sorted(new_children, key=self.get_row_key(new_children))
+            added = new_children.keys() - old_children.keys()
+            for position, child in enumerate(order):
+                if child in added:
+                    self.insert_row(directory, child, new_children[child],
+                                    new_states.get(child, ""), position)
+
+        for path, state in new_states.items():
+            if self.file_states.get(path) != state and self.tree.exists(path):
+                self.tree.set(path, "state", state)
 
-        self.items.clear()
+        self.file_states = new_states
+        self.tree_index = new_index
+        if "" not in self.loaded_dirs:
+            self.load_directory("")
 
-        # Add files to the checklist
-        for filename in os.listdir(cvs.CURRENT_DIR):
-            if filename[0] == '.':
+    def clear_file_list(self):
+        self.tree.delete(*self.tree.get_children())
+        self.file_states = dict()
+        self.tree_index = dict()
+        self.loaded_dirs = set()
+
+    def forget_directory(self, directory):
+        self.loaded_dirs = {i for i in self.loaded_dirs
+                            if i != directory
+                            and not i.startswith(directory + os.sep)}
+
+    def get_loaded_paths(self):
+        """Returns pathspecs of paths, which states can change in loaded
+        directories: their known files, present files and new
+        subdirectories. None is returned, if nothing is loaded yet,
+        so the whole tree is scanned"""
+        if "" not in self.loaded_dirs:
+            return None
+        root = os.path.normpath(cvs.CURRENT_DIR)
+        paths = []
+        for directory in self.loaded_dirs:
+            children = self.tree_index.get(directory, dict())
+            paths += [child for child, is_dir in children.items() if not is_dir]
+            try:
+                entries = list(os.scandir(directory or root))
+            except FileNotFoundError:
                 continue
-            var = tk.BooleanVar()
-            chk = tk.Checkbutton(self.check_frame, text=filename, variable=var)
-            chk.pack(anchor='w')
-            self.items.append((os.path.join(cvs.CURRENT_DIR, filename), var))
+            for entry in entries:
+                path = os.path.join(directory or root, entry.name)
+                if not entry.is_dir() or path not in children:
+                    paths.append(path)
+        # Pathspecs are patterns, so names like "a[1].txt" are escaped
+        return [glob.escape(os.path.relpath(path, root)) for path in paths]
 
-        self.check_frame.update_idletasks()
-        self.canvas.config(scrollregion=self.canvas.bbox("all"))
+    @staticmethod
+    def get_file_states(pathspecs=None):
+        """Returns dict where key is file path and value is its state name.
+        States are taken from the staging area, if repository exists,
+        otherwise all files are shown without state. If pathspecs are
+        given, only matching files are scanned"""
+        try:
+            cvs._check_repository_existence()
+        except exceptions.RepositoryException:
+            ignore = {"START": ["."], "FORMATS": [],
+                      "FILES": [], "DIRECTORIES": []}
+            return {file: "" for file in ut.get_files(cvs.CURRENT_DIR, ignore)}
+        staging_area = cvs._update_staging_area(
+            cvs._get_pathspec_patterns(pathspecs), save=False)
+        states = dict()
+        for state, files in staging_area["staging_files"].items():
+            for file in files:
+                states[file] = state
+        return states
+
+    @staticmethod
+    def build_tree_index(states):
+        """Returns dict where key is directory id ("" for root) and
+        value is dict of its children ids to flag, is child a directory"""
+        index = {"": dict()}
+        root = os.path.normpath(cvs.CURRENT_DIR)
+        for path in states:
+            relative = os.path.relpath(path, root)
+            parts = relative.split(os.sep)
+            parent = ""
+            current = root
+            for part in parts[:-1]:
+                current = os.path.join(current, part)
+                index[parent][current] = True
+                parent = current
+                index.setdefault(parent, dict())
+            index[parent][path] = False
+        return index
+
+    @staticmethod
+    def get_row_key(children):
+        # Directories go first as in file managers
+        return lambda child: (not children[child], child)
+
+    def insert_row(self, parent, item_id, is_dir, state, index=tk.END):
+        self.tree.insert(parent, index, iid=item_id,
+                         text=os.path.basename(item_id),
+                         values=(state,), open=False)
+        if is_dir:
+            self.tree.insert(item_id, tk.END, iid=DUMMY_PREFIX + item_id)
+
+    def load_directory(self, directory):
+        """Creates rows for direct children of directory"""
+        dummy = DUMMY_PREFIX + directory
+        if directory and self.tree.exists(dummy):
+            self.tree.delete(dummy)
+        children = self.tree_index.get(directory, dict())
+        for child in sorted(children, key=self.get_row_key(children)):
+            self.insert_row(directory, child, children[child],
+                            self.file_states.get(child, ""))
+        self.loaded_dirs.add(directory)
+
+    def on_open_directory(self, _event):
+        directory = self.tree.focus()
+        if directory and directory not in self.loaded_dirs:
+            # Closed directories are not scanned on refresh
+            self.populate_file_list(self.get_loaded_paths()
+                                    + [glob.escape(os.path.relpath(
+                                        directory, cvs.CURRENT_DIR))])
+            if self.tree.exists(directory):
+                self.load_directory(directory)
 
     def get_items(self):
-        return [filename for filename, var in self.items if var.get()]
+        """Returns selected files, directories are replaced
+        with all files inside them"""
+        items = []
+        stack = list(self.tree.selection())
+        while stack:
+            item_id = stack.pop()
+            if item_id in self.file_states:
+                items.append(item_id)
+            else:
+                stack.extend(self.tree_index.get(item_id, dict()))
+        return [file for file in dict.fromkeys(items)
+                if self.file_states[file] != cvs.FileState.DELETED.name]
 
     def create_branch(self):
         branch_name = simpledialog.askstring("Create branch", "Enter branch name")
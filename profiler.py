@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+
+# Environment variable with path of the Chrome trace file
+TRACE_ENV = "CVS_TRACE"
+
+ENABLED = False
+_spans = []
+_counters = dict()
+_start = 0
+_lock = threading.Lock()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter_ns()
+        with _lock:
+            _spans.append((self.name, self.start, end,
+                           threading.get_ident()))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable():
+    """Starts collecting spans and counters from scratch"""
+    global ENABLED, _start
+    reset()
+    _start = time.perf_counter_ns()
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    global _spans, _counters
+    _spans = []
+    _counters = dict()
+
+
+def span(name):
+    """Returns context manager, which measures time of the block.
+    Shared no-op object is returned, when profiling is disabled"""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_counters():
+    return dict(_counters)
+
+
+def get_spans():
+    """Returns dict where key is span name and value is list of two
+    elements (number of calls, total time in seconds)"""
+    result = dict()
+    for name, start, end, _ in _spans:
+        calls, total = result.get(name, (0, 0))
+        result[name] = (calls + 1, total + end - start)
+    return {name: (calls, total / 1e9)
+            for name, (calls, total) in result.items()}
+
+
+def summary():
+    """Returns list of lines with human-readable report"""
+    lines = ["Profile:\n"]
+    spans = get_spans()
+    for name in sorted(spans, key=lambda n: -spans[n][1]):
+        calls, total = spans[name]
+        lines.append(f" - {name}: {total * 1000:.2f} ms in {calls} call(s)\n")
+    if _counters:
+        lines.append("Counters:\n")
+        for name in sorted(_counters):
+            lines.append(f" - {name}: {_counters[name]}\n")
+    return lines
+
+
+def write_trace(path):
+    """Writes collected data in Chrome trace event format,
+    which can be opened in chrome://tracing or Perfetto"""
+    pid = os.getpid()
+    events = []
+    end = _start
+    for name, start, finish, tid in _spans:
+        events.append({
+            "name": name,
+            "cat": name.split(".")[0],
+            "ph": "X",
+            "ts": (start - _start) / 1000,
+            "dur": (finish - start) / 1000,
+            "pid": pid,
+            "tid": tid
+        })
+        end = max(end, finish)
+    if _counters:
+        events.append({
+            "name": "counters",
+            "ph": "C",
+            "ts": (end - _start) / 1000,
+            "pid": pid,
+            "args": dict(_counters)
+        })
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,151 @@
+import json
+import re
+import sys
+
+import profiler as prof
+
+# Codes of file states, they are equal to values of cvs.FileState
+STATE_CODES = {"UNTRACKED": 1, "NEW": 2, "UNCHANGED": 3, "MODIFIED": 4,
+               "DELETED": 5}
+STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+HASH_SIZE = 32
+
+
+class FileTable:
+    """Files of commit stored by columns: interned paths and stored paths,
+    sha256 hashes as one bytes object of 32 byte records and state codes"""
+    __slots__ = ("paths", "stored_paths", "hashes", "states")
+
+    def __init__(self, paths, stored_paths, hashes, states):
+        self.paths = paths
+        self.stored_paths = stored_paths
+        self.hashes = hashes
+        self.states = states
+
+    @classmethod
+    def from_json(cls, files):
+        intern = sys.intern
+        infos = files.values()
+        paths = tuple(map(intern, files))
+        stored_paths = tuple(intern(info[0]) for info in infos)
+        hashes = bytes.fromhex("".join([info[1] for info in infos]))
+        states = bytes([STATE_CODES[info[2]] for info in infos])
+        return cls(paths, stored_paths, hashes, states)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def get_hash(self, i):
+        return self.hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE].hex()
+
+    def items(self):
+        """Yields path and list (stored path, hash, state name)
+        like files of commit in JSON"""
+        for i, path in enumerate(self.paths):
+            yield path, [self.stored_paths[i], self.get_hash(i),
+                         STATE_NAMES[self.states[i]]]
+
+    def to_json(self):
+        return dict(self.items())
+
+
+class CommitRecord:
+    """Commit of branch log with compact files. Unknown fields
+    are kept in extra dict"""
+    __slots__ = ("id", "time", "branch", "message", "parent_commit_id",
+                 "parent_commit_branch", "merge_parent_id",
+                 "merge_parent_branch", "files", "extra")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_json(cls, commit):
+        intern = sys.intern
+        fields = {name: intern(value) if isinstance(value, str) else value
+                  for name, value in commit.items() if name != "files"}
+        extra = {name: fields.pop(name) for name in list(fields)
+                 if name not in cls.__slots__}
+        return cls(files=FileTable.from_json(commit["files"]),
+                   extra=extra or None, **fields)
+
+    def to_json(self):
+        commit = {
+            "time": self.time,
+            "parent_commit_branch": self.parent_commit_branch,
+            "parent_commit_id": self.parent_commit_id,
+            "branch": self.branch,
+            "id": self.id,
+            "message": self.message,
+            "files": self.files.to_json()
+        }
+        if self.merge_parent_id:
+            commit["merge_parent_id"] = self.merge_parent_id
+            commit["merge_parent_branch"] = self.merge_parent_branch
+        if self.extra:
+            commit.update(self.extra)
+        return commit
+
+
+def read_branch_log(path):
+    """Reads branch log, which commits are CommitRecord objects. Commits
+    are found by position, values of top-level "commits" object, so
+    files named like commit fields are never mistaken for commits.
+    Every commit is converted right after it is parsed, so dicts of
+    only one commit exist at a time"""
+    with prof.span("json.read"), open(path, 'r') as f:
+        text = f.read()
+    branch_log, index = _parse_object(text, _skip_whitespace(text, 0),
+                                      _parse_branch_log_value)
+    if _skip_whitespace(text, index) != len(text):
+        raise json.JSONDecodeError("Extra data", text, index)
+    return branch_log
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"[ \t\n\r]*")
+
+
+def _skip_whitespace(text, index):
+    return _whitespace.match(text, index).end()
+
+
+def _expect(text, index, char):
+    if text[index:index + 1] != char:
+        raise json.JSONDecodeError(f"Expecting '{char}'", text, index)
+    return _skip_whitespace(text, index + 1)
+
+
+def _parse_object(text, index, parse_value):
+    """Parses JSON object at index, values are parsed by function (text,
+    index, key), which returns value and index after it. Returns object
+    and index after it"""
+    result = dict()
+    index = _expect(text, index, "{")
+    if text[index:index + 1] == "}":
+        return result, index + 1
+    while True:
+        if text[index:index + 1] != '"':
+            raise json.JSONDecodeError("Expecting property name", text, index)
+        key, index = _decoder.raw_decode(text, index)
+        index = _expect(text, _skip_whitespace(text, index), ":")
+        result[key], index = parse_value(text, index, key)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] == "}":
+            return result, index + 1
+        index = _expect(text, index, ",")
+
+
+def _parse_branch_log_value(text, index, key):
+    if key == "commits":
+        return _parse_object(text, index, _parse_commit)
+    return _decoder.raw_decode(text, index)
+
+
+def _parse_commit(text, index, key):
+    commit, index = _decoder.raw_decode(text, index)
+    return CommitRecord.from_json(commit), index
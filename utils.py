@@ -1,21 +1,160 @@
+import bisect
+import collections
+import difflib
 import hashlib
+import io
 import json
 import os
+import re
 import shutil
+import tarfile
+import threading
+import time
+import zipfile
 from pathlib import Path
 
+import profiler as prof
+
+# Table, which marks half of byte values chosen by their sha256, for
+# content-defined chunking. Buffer is translated by it and runs of marked
+# bytes are found by bytes.find, so file is scanned at C speed
+_MARK_TABLE = bytes(int(hashlib.sha256(bytes([i])).digest()[0] < 128)
+                    for i in range(256))
+_READ_SIZE = 1 << 20
+# Size of file beginning, which is checked for zero bytes to detect binaries
+_BINARY_CHECK_SIZE = 8192
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@")
+
 
 def read_json_file(path):
-    with open(path, 'r') as f:
-        return json.load(f)
+    with prof.span("json.read"), open(path, 'r') as f:
+        text = f.read()
+        prof.count("json_bytes_read", len(text))
+        return json.loads(text)
 
 
 def write_json_file(path, data):
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=4)
+    with prof.span("json.write"), open(path, 'w') as f:
+        text = json.dumps(data, indent=4)
+        prof.count("json_bytes_written", len(text))
+        f.write(text)
+
+
+def write_json_file_atomic(path, data):
+    """Writes file, which is either old or new one even after crash"""
+    temp_path = f"{path}.tmp"
+    with prof.span("json.write"), open(temp_path, 'w') as f:
+        text = json.dumps(data, indent=4)
+        prof.count("json_bytes_written", len(text))
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        prof.count("fsyncs")
+    os.replace(temp_path, path)
+
+
+def replace_json_file(path, data):
+    """Writes file through temporary file, which is unique for thread, so
+    concurrent readers and writers see either old or new file. Unlike
+    write_json_file_atomic it doesn't wait for disk"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with prof.span("json.write"), open(temp_path, 'w') as f:
+        text = json.dumps(data, indent=4)
+        prof.count("json_bytes_written", len(text))
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def store_shared_object(source, destination):
+    """Copies file to shared object store. File appears under its final
+    name only when it is complete, so other repositories never read
+    partial copies"""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.copy2(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+def write_lines_atomic(path, lines):
+    """Writes text file from lines like write_json_file_atomic"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
 
+def write_bundle(f, metadata, files):
+    """Writes tar stream, which contains metadata and files. Files are
+    pairs (name in bundle, path)"""
+    with prof.span("bundle.write"), tarfile.open(fileobj=f, mode="w|") as tar:
+        data = json.dumps(metadata).encode()
+        info = tarfile.TarInfo("metadata.json")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        for name, path in files:
+            tar.add(path, arcname=name)
+            prof.count("bytes_copied", os.path.getsize(path))
 
-def _item_in_ignore(item, ignore_list):
+
+def read_bundle(f, get_destination):
+    """Reads tar stream, which was written by write_bundle, and returns
+    metadata. Every file is extracted to path returned by get_destination
+    for its name in bundle"""
+    metadata = None
+    with prof.span("bundle.read"), tarfile.open(fileobj=f, mode="r|") as tar:
+        for member in tar:
+            source = tar.extractfile(member)
+            if member.name == "metadata.json":
+                metadata = json.load(source)
+                continue
+            destination = get_destination(member.name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            temp_path = f"{destination}.tmp"
+            with open(temp_path, "wb") as d:
+                shutil.copyfileobj(source, d)
+            os.replace(temp_path, destination)
+    return metadata
+
+
+def write_archive(f, files, archive_format="tar", mtime=None, chunks_dir=None):
+    """Writes tar, tar.gz or zip archive to file object, which may be
+    not seekable. Files are tuples (name in archive, stored path, chunked),
+    content is copied from storage by blocks"""
+    mtime = int(time.time() if mtime is None else mtime)
+    with prof.span("archive.write"):
+        if archive_format == "zip":
+            _write_zip(f, files, mtime, chunks_dir)
+            return
+        mode = "w|gz" if archive_format == "tar.gz" else "w|"
+        with tarfile.open(fileobj=f, mode=mode) as tar:
+            for name, path, chunked in files:
+                info = tarfile.TarInfo(name)
+                info.size = get_stored_size(path, chunked)
+                info.mtime = mtime
+                info.mode = 0o644
+                with open_stored_file(path, chunks_dir, chunked) as source:
+                    tar.addfile(info, source)
+                prof.count("bytes_copied", info.size)
+
+
+def _write_zip(f, files, mtime, chunks_dir):
+    date_time = time.localtime(mtime)[:6]
+    with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, path, chunked in files:
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            # Known size lets zipfile choose zip64 records in advance
+            info.file_size = get_stored_size(path, chunked)
+            with open_stored_file(path, chunks_dir, chunked) as source, \
+                    archive.open(info, "w") as destination:
+                shutil.copyfileobj(source, destination, _READ_SIZE)
+            prof.count("bytes_copied", info.file_size)
+
+
+def item_in_ignore(item, ignore_list):
     item = Path(item)
     name = item.name
     if any(name.startswith(i) for i in ignore_list["START"]):
@@ -28,28 +167,456 @@ def _item_in_ignore(item, ignore_list):
 
 def get_file_hash(path):
     h = hashlib.new('sha256')
-    with open(path, "r") as f:
-        for line in f:
-            h.update(line.encode())
+    size = 0
+    with open(path, "rb") as f:
+        while data := f.read(_READ_SIZE):
+            size += len(data)
+            h.update(data)
+    prof.count("files_hashed")
+    prof.count("bytes_hashed", size)
     return h.hexdigest()
 
 
-def copy_files(copy_to, files_to_copy):
-    """Receives files paths and directory to which files will be copied"""
-    for item in files_to_copy:
-        shutil.copy2(Path(item), copy_to)
+def try_get_file_hash(path):
+    """Returns hash of file or None, if it can't be read"""
+    try:
+        return get_file_hash(path)
+    except OSError:
+        return None
+
+
+def _find_chunk_end(marks, start, min_size, max_size, run):
+    """Returns end of the chunk, which begins at start. Boundary is placed
+    after the first run of marked bytes of given length, which ends at
+    least min_size bytes after start. It depends only on the last bytes,
+    so equal regions are split equally"""
+    limit = min(len(marks), start + max_size)
+    if limit <= start + min_size:
+        return limit
+    found = marks.find(b"\x01" * run, max(start, start + min_size - run), limit)
+    return limit if found < 0 else found + run
+
+
+def iter_chunks(f, min_size, avg_size, max_size):
+    """Splits rest of binary file object into content-defined chunks and
+    yields them one by one. Equal regions of different files or versions
+    are split equally, so insertion of bytes changes only chunks around it"""
+    # Run of n marked bytes is met once in about 2 ** (n + 1) bytes
+    run = max(1, avg_size.bit_length() - 2)
+    buffer = b""
+    marks = b""
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            buffer = buffer[start:]
+            marks = marks[start:]
+            start = 0
+            while not eof and len(buffer) < max_size:
+                data = f.read(max(max_size, _READ_SIZE))
+                eof = not data
+                buffer += data
+                marks += data.translate(_MARK_TABLE)
+        if start == len(buffer):
+            return
+        end = _find_chunk_end(marks, start, min_size, max_size, run)
+        yield buffer[start:end]
+        start = end
+
+
+def get_chunk_path(chunks_dir, chunk_hash):
+    return os.path.join(chunks_dir, chunk_hash[:2], chunk_hash)
+
+
+def hash_chunks(path, min_size, avg_size, max_size, previous=None):
+    """Splits file into chunks without writing them. Returns file hash
+    and list of chunks, where every chunk is list of two elements
+    (chunk hash, size). Leading chunks of previous list of the file,
+    which content is not changed, are taken without searching for
+    boundaries. Their bytes are still read and hashed, because the file
+    hash and the check of the chunk need them"""
+    file_hash = hashlib.new('sha256')
+    chunks = []
+    with prof.span("chunk"), open(path, "rb") as f:
+        # The last previous chunk could be cut by the end of file
+        for chunk_hash, size in (previous or [])[:-1]:
+            data = f.read(size)
+            if hashlib.sha256(data).hexdigest() != chunk_hash:
+                f.seek(-len(data), io.SEEK_CUR)
+                break
+            file_hash.update(data)
+            chunks.append([chunk_hash, size])
+            prof.count("chunks_reused")
+            prof.count("bytes_hashed", size)
+        for data in iter_chunks(f, min_size, avg_size, max_size):
+            file_hash.update(data)
+            chunks.append([hashlib.sha256(data).hexdigest(), len(data)])
+            prof.count("bytes_hashed", len(data))
+    prof.count("files_hashed")
+    return file_hash.hexdigest(), chunks
+
+
+def store_chunks(path, chunks_dir, chunks):
+    """Writes chunks of file, which are not in chunks directory yet.
+    Chunks are list made by hash_chunks, existing ones are skipped without
+    reading. Returns False, if file content doesn't match the list.
+    Chunk written by another thread or process at the same time is kept"""
+    with prof.span("chunk.store"), open(path, "rb") as f:
+        for chunk_hash, size in chunks:
+            chunk_path = get_chunk_path(chunks_dir, chunk_hash)
+            if os.path.exists(chunk_path):
+                f.seek(size, io.SEEK_CUR)
+                continue
+            data = f.read(size)
+            if hashlib.sha256(data).hexdigest() != chunk_hash:
+                return False
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            temp_path = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as chunk:
+                chunk.write(data)
+            try:
+                os.replace(temp_path, chunk_path)
+            except OSError:
+                os.remove(temp_path)
+                if not os.path.exists(chunk_path):
+                    raise
+            prof.count("chunks_written")
+            prof.count("bytes_copied", len(data))
+    return True
+
+
+class ChunkedFile(io.RawIOBase):
+    """Seekable read-only file, which content is a sequence of chunks"""
+
+    def __init__(self, chunks_dir, chunks):
+        super().__init__()
+        self.chunks_dir = chunks_dir
+        self.chunks = chunks
+        self.offsets = []
+        self.size = 0
+        for _, size in chunks:
+            self.offsets.append(self.size)
+            self.size += size
+        self.position = 0
+        self.current = None
+        self.current_index = -1
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        if index != self.current_index:
+            if self.current:
+                self.current.close()
+            chunk_path = get_chunk_path(self.chunks_dir, self.chunks[index][0])
+            self.current = open(chunk_path, "rb")
+            self.current_index = index
+        chunk_end = self.offsets[index] + self.chunks[index][1]
+        self.current.seek(self.position - self.offsets[index])
+        data = self.current.read(min(len(buffer), chunk_end - self.position))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if self.current:
+            self.current.close()
+            self.current = None
+        super().close()
+
 
+def open_stored_file(path, chunks_dir=None, chunked=False):
+    """Opens file for binary reading, chunked files are read
+    by list of chunks, which is stored in path"""
+    if not chunked:
+        return open(path, "rb")
+    return io.BufferedReader(ChunkedFile(chunks_dir, read_json_file(path)))
 
-def get_files(path, ignore):
+
+def copy_stored_file(f, path, chunks_dir=None, chunked=False):
+    """Writes content of stored file to file object by blocks"""
+    with open_stored_file(path, chunks_dir, chunked) as source:
+        shutil.copyfileobj(source, f, _READ_SIZE)
+
+
+def get_stored_size(path, chunked=False):
+    if not chunked:
+        return os.path.getsize(path)
+    return sum(size for _, size in read_json_file(path))
+
+
+def join_chunks(copy_to, chunks_dir, chunks):
+    """Writes file from chunks reading them one by one"""
+    with prof.span("copy"), open(copy_to, "wb") as f:
+        for chunk_hash, size in chunks:
+            with open(get_chunk_path(chunks_dir, chunk_hash), "rb") as chunk:
+                shutil.copyfileobj(chunk, f)
+            prof.count("bytes_copied", size)
+
+
+def copy_files(copy_to, files_to_copy, progress=None):
+    """Receives files paths and directory to which files will be copied.
+    Progress is called with numbers of copied and all files"""
+    with prof.span("copy"):
+        for i, item in enumerate(files_to_copy):
+            if progress:
+                progress(i, len(files_to_copy))
+            shutil.copy2(Path(item), copy_to)
+            if prof.ENABLED:
+                prof.count("files_copied")
+                prof.count("bytes_copied", os.path.getsize(item))
+
+
+def copy_files_as(files_to_copy, progress=None):
+    """Receives list of pairs (source path, destination path)"""
+    with prof.span("copy"):
+        for i, (source, destination) in enumerate(files_to_copy):
+            if progress:
+                progress(i, len(files_to_copy))
+            shutil.copy2(source, destination)
+            if prof.ENABLED:
+                prof.count("files_copied")
+                prof.count("bytes_copied", os.path.getsize(source))
+
+
+def _get_line_matches(base, other):
+    """Returns dict where key is index of base line and value is index
+    of the same line in other, for lines, which were not changed"""
+    matches = dict()
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    for base_start, other_start, size in matcher.get_matching_blocks():
+        for i in range(size):
+            matches[base_start + i] = other_start + i
+    return matches
+
+
+def _conflict_lines(lines):
+    if lines and not lines[-1].endswith("\n"):
+        return lines[:-1] + [lines[-1] + "\n"]
+    return lines
+
+
+def merge_lines(base, ours, theirs, ours_name="ours", theirs_name="theirs"):
+    """Three-way merge of lists of lines. Returns merged lines and flag,
+    whether there were conflicts, which are marked in result"""
+    ours_matches = _get_line_matches(base, ours)
+    theirs_matches = _get_line_matches(base, theirs)
+    result = []
+    conflict = False
+    base_pos = ours_pos = theirs_pos = 0
+    while True:
+        # Next base line, which is unchanged in both versions
+        stable = base_pos
+        while stable < len(base) and not (
+                ours_matches.get(stable, -1) >= ours_pos
+                and theirs_matches.get(stable, -1) >= theirs_pos):
+            stable += 1
+        if stable == len(base):
+            ours_end, theirs_end = len(ours), len(theirs)
+        else:
+            ours_end, theirs_end = ours_matches[stable], theirs_matches[stable]
+
+        base_part = base[base_pos:stable]
+        ours_part = ours[ours_pos:ours_end]
+        theirs_part = theirs[theirs_pos:theirs_end]
+        if ours_part == theirs_part or theirs_part == base_part:
+            result += ours_part
+        elif ours_part == base_part:
+            result += theirs_part
+        else:
+            conflict = True
+            result.append(f"<<<<<<< {ours_name}\n")
+            result += _conflict_lines(ours_part)
+            result.append("=======\n")
+            result += _conflict_lines(theirs_part)
+            result.append(f">>>>>>> {theirs_name}\n")
+
+        if stable == len(base):
+            return result, conflict
+        result.append(base[stable])
+        base_pos = stable + 1
+        ours_pos = ours_end + 1
+        theirs_pos = theirs_end + 1
+
+
+def _open_diff_source(source, chunks_dir):
+    if source is None:
+        return io.BytesIO(b"")
+    return open_stored_file(source[0], chunks_dir, source[1])
+
+
+def _get_size(f):
+    size = f.seek(0, io.SEEK_END)
+    f.seek(0)
+    return size
+
+
+def _get_common_suffix(old, new, old_start, new_start, block_size=_READ_SIZE):
+    """Returns length of equal endings of files after given positions.
+    Files are read backwards by blocks"""
+    old_end = _get_size(old)
+    new_end = _get_size(new)
+    limit = min(old_end - old_start, new_end - new_start)
+    length = 0
+    while length < limit:
+        size = min(block_size, limit - length)
+        old.seek(old_end - length - size)
+        new.seek(new_end - length - size)
+        old_block = old.read(size)
+        new_block = new.read(size)
+        if old_block == new_block:
+            length += size
+            continue
+        i = size
+        while i > 0 and old_block[i - 1] == new_block[i - 1]:
+            i -= 1
+        return length + size - i
+    return length
+
+
+def _is_line_start(f, position, start):
+    if position == start:
+        return True
+    f.seek(position - 1)
+    return f.read(1) == b"\n"
+
+
+def _decode_lines(data):
+    return data.decode(errors="replace").splitlines(keepends=True)
+
+
+def diff_files(old, new, old_label, new_label, chunks_dir=None, context=3):
+    """Returns lines of unified diff of two files. File is tuple of two
+    elements (path, is it chunked) or None for absent file. Equal
+    beginnings and endings of files are streamed, only different middle
+    part is loaded into memory"""
+    with _open_diff_source(old, chunks_dir) as a, \
+            _open_diff_source(new, chunks_dir) as b:
+        if (b"\0" in a.read(_BINARY_CHECK_SIZE)
+                or b"\0" in b.read(_BINARY_CHECK_SIZE)):
+            return [f"Binary files {old_label} and {new_label} differ\n"]
+        a.seek(0)
+        b.seek(0)
+
+        before = collections.deque(maxlen=context)
+        line_number = 0
+        start = 0
+        while True:
+            old_line = a.readline()
+            new_line = b.readline()
+            if old_line != new_line or not old_line:
+                break
+            before.append(old_line)
+            line_number += 1
+            start += len(old_line)
+
+        suffix = _get_common_suffix(a, b, start, start)
+        old_end = _get_size(a) - suffix
+        new_end = _get_size(b) - suffix
+        a.seek(old_end)
+        tail = a.read(suffix)
+        # Common ending must begin from a new line in both files
+        if not (_is_line_start(a, old_end, start)
+                and _is_line_start(b, new_end, start)):
+            shift = tail.find(b"\n") + 1 if b"\n" in tail else len(tail)
+            old_end += shift
+            new_end += shift
+            tail = tail[shift:]
+        after = _decode_lines(tail)[:context]
+
+        a.seek(start)
+        b.seek(start)
+        old_lines = _decode_lines(a.read(old_end - start))
+        new_lines = _decode_lines(b.read(new_end - start))
+
+    before = _decode_lines(b"".join(before))
+    offset = line_number - len(before)
+    result = []
+    for line in difflib.unified_diff(before + old_lines + after,
+                                     before + new_lines + after,
+                                     old_label, new_label, n=context):
+        match = _HUNK_HEADER.match(line)
+        if match:
+            line = (f"@@ -{int(match[1]) + offset}{match[2] or ''} "
+                    f"+{int(match[3]) + offset}{match[4] or ''} @@\n")
+        elif not line.endswith("\n"):
+            line += "\n"
+        result.append(line)
+    return result
+
+
+def get_similarity(path, stored_path, chunks_dir=None, chunked=False,
+                   threshold=0.0):
+    """Returns share of equal lines of file and stored file from 0 to 1.
+    Binary files are not similar. Exact ratio is computed only if quick
+    upper bound reaches threshold"""
+    with open(path, "rb") as f:
+        new = f.read()
+    with open_stored_file(stored_path, chunks_dir, chunked) as f:
+        old = f.read()
+    if b"\0" in new[:_BINARY_CHECK_SIZE] or b"\0" in old[:_BINARY_CHECK_SIZE]:
+        return 0.0
+    matcher = difflib.SequenceMatcher(None, old.splitlines(), new.splitlines(),
+                                      autojunk=False)
+    ratio = matcher.quick_ratio()
+    if ratio < threshold:
+        return ratio
+    return matcher.ratio()
+
+
+def grep_stored_file(path, pattern, chunks_dir=None, chunked=False,
+                     flags=0):
+    """Returns list of (line number, line) of stored file, which match
+    bytes regular expression. File is read line by line, binary files
+    are skipped"""
+    regex = re.compile(pattern, flags)
+    matches = []
+    with open_stored_file(path, chunks_dir, chunked) as f:
+        if b"\0" in f.peek(_BINARY_CHECK_SIZE)[:_BINARY_CHECK_SIZE]:
+            return matches
+        for line_number, line in enumerate(f, 1):
+            if regex.search(line):
+                matches.append((line_number,
+                                line.rstrip(b"\r\n").decode(errors="replace")))
+    prof.count("files_searched")
+    return matches
+
+
+def get_files(path, ignore, include=None):
+    """Yields paths of not ignored files. Optional include function
+    receives item path and flag, is it directory, and returns whether
+    file or directory must be visited"""
     dirs = [Path(path)]
     while len(dirs) > 0:
         p = dirs.pop()
         for item in p.iterdir():
-            if _item_in_ignore(item, ignore):
+            if item_in_ignore(item, ignore):
                 continue
-            if item.is_dir():
+            is_dir = item.is_dir()
+            if include and not include(str(item), is_dir):
+                continue
+            if is_dir:
                 dirs.append(item)
                 continue
+            if prof.ENABLED:
+                prof.count("files_scanned")
             yield str(item)
 
 
@@ -58,7 +625,7 @@ def clear_directory(directory, ignore):
     ind = 0
     while ind < len(dirs):
         for item in dirs[ind].iterdir():
-            if _item_in_ignore(item, ignore):
+            if item_in_ignore(item, ignore):
                 continue
             if item.is_dir():
                 dirs.append(item)